@@ -0,0 +1,181 @@
+"""
+Latency model of AWS and of the hosts for the offline benchmarks.
+
+Every figure is in seconds of a real deploy and is multiplied by the benchmark scale,
+so `--scale 0.1` runs the same deploy ten times faster with the same proportions.
+"""
+import copy
+import json
+import threading
+import time
+
+DEFAULT_PROFILE = {
+    # AWS API round trips: exact operation name first, then its verb (Describe, Create, ...), then 'default'
+    'api': {
+        'default': 0.08,
+        'Describe': 0.12,
+        'Create': 0.25,
+        'Delete': 0.2,
+        'RunInstances': 1.2,
+        'CreateNatGateway': 0.5,
+        'AllocateAddress': 0.2,
+        'CreateKeyPair': 0.3,
+        'CreateImage': 0.6,
+    },
+    # Time until a resource reaches its target state
+    'ready': {
+        'nat_gateway': 90.0,
+        'nat_gateway_delete': 55.0,
+        'instance': 35.0,
+        'instance_terminate': 25.0,
+        'bake': 420.0,
+    },
+    # Remote commands and services of the SSH stand-in (benchmarks.ssh_server)
+    'remote': {
+        'command': 0.05,
+        'bundle': 1.5,
+        'docker_install': 70.0,
+        'jenkins_install': 45.0,
+        'compose_up': 25.0,
+        'nginx_config': 1.0,
+        'gitea_admin': 3.0,
+        'service_start': 15.0,
+        'jenkins_password': 20.0,
+        'bootstrap': 180.0,
+        'output_lines': 40,
+    },
+}
+
+
+def load_profile(path=None, scale=1.0):
+    """
+    DEFAULT_PROFILE updated with the JSON file at `path` (same layout, missing keys keep their default),
+    every duration multiplied by `scale`.
+    """
+    profile = copy.deepcopy(DEFAULT_PROFILE)
+    if path != None:
+        with open(path) as f:
+            for section, values in json.load(f).items():
+                profile.setdefault(section, {}).update(values)
+    for section in profile.values():
+        for key, value in section.items():
+            if key != 'output_lines':
+                section[key] = value * scale
+    return profile
+
+
+def _verb(operation_name):
+    for index, char in enumerate(operation_name[1:], 1):
+        if char.isupper():
+            return operation_name[:index]
+    return operation_name
+
+
+class AwsModel:
+    """
+    botocore hooks turning the instant answers of moto into the timing of real AWS:
+    every call is delayed by its API latency, and describes report NAT Gateways and instances
+    as pending (or deleting / shutting down) until their ready delay has passed.
+    Golden image bake instances (Name '*-builder') stop on their own after the bake delay.
+    """
+
+    def __init__(self, profile):
+        self._lock = threading.Lock()
+        self.reset(profile)
+
+    def reset(self, profile):
+        """
+        Forget every resource, e.g. for the next scenario on a fresh moto backend.
+        """
+        with self._lock:
+            self.profile = profile
+            self._created = {}
+            self._deleted = {}
+            self._builders = set()
+            self._launched = {}
+
+    def latency(self, operation_name):
+        api = self.profile['api']
+        return api.get(operation_name, api.get(_verb(operation_name), api['default']))
+
+    def launch_time(self, private_dns_name):
+        """
+        When the instance with `private_dns_name` was launched, for other names (e.g. the bastion's public IP)
+        the latest launch. None before any launch.
+        """
+        with self._lock:
+            return self._launched.get(private_dns_name, max(self._launched.values(), default=None))
+
+    def install(self, client, account):
+        if client.meta.service_model.service_name != 'ec2':
+            return
+
+        def before_call(model, **kwargs):
+            time.sleep(self.latency(model.name))
+
+        def after_call(model, parsed=None, **kwargs):
+            if parsed == None or 'Error' in parsed:
+                return
+            self._observe(model.name, parsed)
+
+        def modify_vpc_endpoint_params(params, **kwargs):
+            # moto can't delete an endpoint once route tables were added this way; the call is still timed
+            params.pop('AddRouteTableIds', None)
+
+        client.meta.events.register('provide-client-params.ec2.ModifyVpcEndpoint', modify_vpc_endpoint_params,
+                                    unique_id='dotp-bench-endpoint-routes')
+        client.meta.events.register('before-call', before_call, unique_id='dotp-bench-latency')
+        client.meta.events.register('after-call', after_call, unique_id='dotp-bench-ready')
+
+    def _observe(self, operation_name, parsed):
+        now = time.monotonic()
+        with self._lock:
+            if operation_name == 'RunInstances':
+                for instance in parsed['Instances']:
+                    self._created[instance['InstanceId']] = now
+                    self._launched[instance['PrivateDnsName']] = now
+                    tags = {tag['Key']: tag['Value'] for tag in instance.get('Tags', [])}
+                    if tags.get('Name', '').endswith('-builder'):
+                        self._builders.add(instance['InstanceId'])
+            elif operation_name == 'CreateNatGateway':
+                self._created[parsed['NatGateway']['NatGatewayId']] = now
+            elif operation_name == 'TerminateInstances':
+                for instance in parsed['TerminatingInstances']:
+                    self._deleted.setdefault(instance['InstanceId'], now)
+            elif operation_name == 'DeleteNatGateway':
+                self._deleted.setdefault(parsed['NatGatewayId'], now)
+            elif operation_name == 'DescribeInstances':
+                for reservation in parsed['Reservations']:
+                    for instance in reservation['Instances']:
+                        state = self._instance_state(instance['InstanceId'], now)
+                        if state != None:
+                            instance['State'] = state
+            elif operation_name == 'DescribeNatGateways':
+                for nat_gateway in parsed['NatGateways']:
+                    state = self._nat_gateway_state(nat_gateway['NatGatewayId'], now)
+                    if state != None:
+                        nat_gateway['State'] = state
+
+    def _instance_state(self, instance_id, now):
+        ready = self.profile['ready']
+        if instance_id in self._deleted:
+            if now - self._deleted[instance_id] < ready['instance_terminate']:
+                return {'Code': 32, 'Name': 'shutting-down'}
+            return None
+        created = self._created.get(instance_id)
+        if created == None:
+            return None
+        if now - created < ready['instance']:
+            return {'Code': 0, 'Name': 'pending'}
+        if instance_id in self._builders and now - created >= ready['bake']:
+            return {'Code': 80, 'Name': 'stopped'}
+        return None
+
+    def _nat_gateway_state(self, nat_gateway_id, now):
+        ready = self.profile['ready']
+        if nat_gateway_id in self._deleted:
+            return 'deleting' if now - self._deleted[nat_gateway_id] < ready['nat_gateway_delete'] else None
+        created = self._created.get(nat_gateway_id)
+        if created != None and now - created < ready['nat_gateway']:
+            return 'pending'
+        return None
@@ -0,0 +1,317 @@
+"""
+Offline benchmark of a full deploy (create_dotp.run) and teardown (utils.clear_vpc.main).
+
+    pip install -r benchmarks/requirements.txt
+    python -m benchmarks.run                      # every scenario, compared with benchmarks/baseline.json
+    python -m benchmarks.run ssh --scale 0.05     # one scenario, faster
+    python -m benchmarks.run --update-baseline    # store the results as the new baseline
+
+AWS is moto with the latencies and ready delays of benchmarks.latency, the hosts are the local SSH server of
+benchmarks.ssh_server, so no AWS credentials or network are needed. For every scenario it reports the wall-clock
+time, the critical path (from the run trace), AWS API calls, remote commands and the peak memory allocated by Python,
+and exits with 1 when a run fails or a figure is worse than the baseline by more than the tolerance.
+"""
+import argparse
+import json
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from concurrent.futures import wait
+
+# Traces, SSH keys and the home directory of the runs live in a scratch directory,
+# set before utils.tracing reads DOTP_TRACE_DIR
+WORK_DIR = tempfile.mkdtemp(prefix="dotp-bench-")
+os.environ['DOTP_TRACE_DIR'] = os.path.join(WORK_DIR, 'traces')
+os.environ['HOME'] = WORK_DIR
+
+import boto3
+import logging
+from moto import mock_aws
+from moto.core.botocore_stubber import BotocoreStubber
+import create_dotp
+from benchmarks.latency import AwsModel, load_profile
+from benchmarks.ssh_server import SshServer
+from utils import aws_clients, clear_vpc, functions_ec2, images, readiness, waiters
+from utils.aws_clients import get_client, use_session
+from utils.functions_ec2 import get_ec2_custom_template, wait_for_port
+from utils.ssh_sessions import SessionManager
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BASELINE = os.path.join(REPO_DIR, 'benchmarks', 'baseline.json')
+
+# name -> create_dotp.run arguments, golden image present before the run
+SCENARIOS = {
+    'ssh': ({'multiple_vms': True, 'bootstrap': 'ssh'}, False),
+    'ssh-golden': ({'multiple_vms': True, 'bootstrap': 'ssh'}, True),
+    'cloud-init': ({'multiple_vms': True, 'bootstrap': 'cloud-init'}, False),
+}
+# Figures compared with the baseline, higher is worse, with the absolute noise allowed on top of the tolerance
+# (kept below the baseline values themselves, a regression of a small figure still fails)
+GATED = {'wall_seconds': 1.0, 'critical_path_seconds': 1.0, 'api_calls': 2, 'remote_commands': 5,
+         'peak_memory_mb': 0.5, 'teardown_seconds': 1.0, 'teardown_api_calls': 2}
+INSTANCE_TEMPLATE = 'free-ec2-instance'
+PROJECT = 'dotp-bench'
+
+
+def _serialized(call):
+    lock = threading.Lock()
+
+    def serialized_call(*args, **kwargs):
+        with lock:
+            return call(*args, **kwargs)
+    return serialized_call
+
+
+# moto isn't thread safe; requests are answered one at a time, their modeled latency still overlaps
+BotocoreStubber.__call__ = _serialized(BotocoreStubber.__call__)
+
+
+class LocalSessions(SessionManager):
+    """
+    SessionManager reaching the bastion on the local SSH server; private hosts still go through it.
+    """
+    port = None
+
+    def _sock(self, host):
+        if host == self.bastion_host:
+            return socket.create_connection(('127.0.0.1', self.port), timeout=self.timeout)
+        return super()._sock(host)
+
+
+def scaled_target(scale):
+    """
+    readiness.Target with its backoff delays multiplied by `scale`.
+    """
+    class ScaledTarget(readiness.Target):
+        def __init__(self, name, probe, timeout=300, delay=0.5, max_delay=10.0, host=None):
+            super().__init__(name, probe, timeout=timeout, delay=delay * scale, max_delay=max_delay * scale, host=host)
+    return ScaledTarget
+
+
+def _load_trace(name, before):
+    directory = os.environ['DOTP_TRACE_DIR']
+    paths = sorted(set(os.listdir(directory)) - before)
+    paths = [path for path in paths if path.startswith(name + '-')]
+    if not paths:
+        raise RuntimeError(f"No '{name}' trace was written.")
+    with open(os.path.join(directory, paths[-1])) as f:
+        return json.load(f)
+
+
+def _trace_files():
+    directory = os.environ['DOTP_TRACE_DIR']
+    return set(os.listdir(directory)) if os.path.isdir(directory) else set()
+
+
+def critical_path(trace):
+    """
+    Longest chain of work spans (steps, and API calls / remote commands / probes / waits made outside of a step)
+    where each one started right after the previous one ended. Returns [(span, wait before it)].
+    """
+    spans = trace['spans']
+    containers = {span['id'] for span in spans if span['kind'] in ('run', 'phase')}
+    work = [span for span in spans
+            if span['kind'] == 'step' or (span['kind'] in ('api', 'remote', 'probe', 'internal') and span['parent'] in containers)]
+    if not work:
+        return []
+
+    def end(span):
+        return span['start'] + span['duration']
+
+    path = [max(work, key=end)]
+    while True:
+        before = [span for span in work if end(span) <= path[-1]['start'] + 0.01 and span['start'] < path[-1]['start']]
+        if not before:
+            break
+        path.append(max(before, key=end))
+    path.reverse()
+    root = next(span for span in spans if span['kind'] == 'run')
+    previous_end = root['start']
+    result = []
+    for span in path:
+        result.append((span, max(0.0, span['start'] - previous_end)))
+        previous_end = end(span)
+    return result
+
+
+def _api_calls(trace):
+    calls = {}
+    for span in trace['spans']:
+        if span['kind'] == 'api':
+            calls[span['name']] = calls.get(span['name'], 0) + 1
+    return calls
+
+
+def _failure(trace):
+    root = next(span for span in trace['spans'] if span['kind'] == 'run')
+    if root['status'] != 'ok':
+        return root['error']
+    # create_dotp.run logs errors of the services phase instead of raising them
+    if not any(span['kind'] == 'step' and span['name'] == 'gitea_admin' and span['status'] == 'ok' for span in trace['spans']):
+        errors = [f"{span['name']}: {span['error']}" for span in trace['spans'] if span['status'] != 'ok']
+        return errors[0] if errors else "the services were not brought up"
+    return None
+
+
+def _register_golden_image(image_id):
+    # An image registered with the recipe tags, as left by utils.images.bake_golden_image
+    client = get_client('ec2')
+    digest = images.recipe_digest(image_id)
+    golden_image_id = client.register_image(Name=f"{images.IMAGE_PREFIX}-{digest[:12]}", RootDeviceName='/dev/xvda')['ImageId']
+    client.create_tags(Resources=[golden_image_id], Tags=[{'Key': images.RECIPE_TAG, 'Value': digest},
+                                                          {'Key': images.BASE_TAG, 'Value': image_id}])
+
+
+def run_scenario(name, model, server, profile, region_name):
+    arguments, golden = SCENARIOS[name]
+    with mock_aws():
+        aws_clients.reset()
+        images._bakes.clear()
+        with use_session(boto3.Session(region_name=region_name)):
+            # moto builds its region backend on the first call, keep that out of the figures
+            get_client('ec2').describe_availability_zones()
+            if golden:
+                _register_golden_image(get_ec2_custom_template(INSTANCE_TEMPLATE)[0])
+            model.reset(profile)
+            server.reset(profile)
+
+            before = _trace_files()
+            tracemalloc.start()
+            tic = time.perf_counter()
+            create_dotp.run(_instance_type=INSTANCE_TEMPLATE, project=PROJECT, **arguments)
+            wall = time.perf_counter() - tic
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            trace = _load_trace('create_dotp', before)
+
+            before = _trace_files()
+            tic = time.perf_counter()
+            clear_vpc.main(project=PROJECT)
+            teardown = time.perf_counter() - tic
+            teardown_trace = _load_trace('clear_vpc', before)
+            # A background bake stops once its builder is gone; let it finish before moto goes away
+            wait(list(images._bakes.values()), timeout=60)
+
+    path = critical_path(trace)
+    calls = _api_calls(trace)
+    return {
+        'failure': _failure(trace),
+        'wall_seconds': round(wall, 3),
+        'critical_path_seconds': round(sum(span['duration'] for span, _ in path), 3),
+        'api_calls': sum(calls.values()),
+        'remote_commands': sum(host.commands for host in server.hosts.values()),
+        'peak_memory_mb': round(peak / 2 ** 20, 2),
+        'teardown_seconds': round(teardown, 3),
+        'teardown_api_calls': sum(_api_calls(teardown_trace).values()),
+        'critical_path': [{'name': span['name'], 'kind': span['kind'], 'duration': round(span['duration'], 3),
+                           'wait': round(gap, 3)} for span, gap in path],
+        'api_calls_by_operation': dict(sorted(calls.items(), key=lambda item: item[1], reverse=True)),
+    }
+
+
+def report(name, result, baseline, tolerance):
+    """
+    Print the figures of one scenario next to the baseline; returns the regressed figures.
+    """
+    print(f"\n== {name} " + ("FAILED: " + result['failure'] if result['failure'] else ""))
+    print(f"{'Figure':<28}{'Current':>12}{'Baseline':>12}{'Change':>10}")
+    regressions = []
+    for key in GATED:
+        current, expected = result[key], (baseline or {}).get(key)
+        change = ""
+        if expected:
+            change = f"{(current - expected) / expected * 100:+.1f}%"
+            if current > expected * (1 + tolerance) + GATED[key]:
+                regressions.append(key)
+                change += " !"
+        print(f"{key:<28}{current:>12}{expected if expected != None else '-':>12}{change:>10}")
+    print("Critical path:")
+    for step in result['critical_path']:
+        print(f"  {step['name'][:50]:<52}{step['kind']:<8}{step['duration']:>9.2f}s  (+{step['wait']:.2f}s before)")
+    print("Most called AWS operations:")
+    for operation, count in list(result['api_calls_by_operation'].items())[:5]:
+        print(f"  {operation:<52}{count:>8}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark create_dotp.run and clear_vpc.main against local stand-ins of AWS and the hosts.")
+    parser.add_argument('scenarios', nargs='*', help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)")
+    parser.add_argument('--scale', type=float, default=0.1, help="time scale of the latency profile (default 0.1)")
+    parser.add_argument('--profile', help="JSON file overriding benchmarks.latency.DEFAULT_PROFILE")
+    parser.add_argument('--region', default='eu-central-1')
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=0.25, help="allowed increase over the baseline (default 0.25)")
+    parser.add_argument('--update-baseline', action='store_true', help="write the results to the baseline file")
+    parser.add_argument('--output', help="also write the results as JSON to this file")
+    parser.add_argument('--seed', type=int, default=1, help="seed of the probe jitter")
+    parser.add_argument('--verbose', action='store_true', help="show the log of the runs")
+    args = parser.parse_args(argv)
+    unknown = [name for name in args.scenarios if name not in SCENARIOS]
+    if unknown:
+        parser.error(f"unknown scenario(s): {', '.join(unknown)}")
+
+    logging.getLogger().setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    # Port checks of the SSH server close right after connecting, paramiko logs that as an error
+    logging.getLogger('paramiko').setLevel(logging.INFO if args.verbose else logging.CRITICAL)
+    random.seed(args.seed)
+    profile = load_profile(args.profile, args.scale)
+    # Polling keeps the same proportions to the delays it waits for
+    waiters.INITIAL_DELAY *= args.scale
+    waiters.MAX_DELAY *= args.scale
+    create_dotp.Target = functions_ec2.Target = scaled_target(args.scale)
+
+    # The runs look for ./resources and write keys to ./shadow, read them back from ~/shadow
+    os.chdir(WORK_DIR)
+    os.symlink(os.path.join(REPO_DIR, 'resources'), 'resources')
+    os.makedirs('shadow')
+
+    model = AwsModel(profile)
+    aws_clients.register_client_hook(model.install)
+    server = SshServer(profile, launch_time=model.launch_time)
+    LocalSessions.port = server.port
+    create_dotp.SessionManager = LocalSessions
+    create_dotp.wait_for_port = lambda port, host, timeout: wait_for_port(server.port, '127.0.0.1', timeout)
+
+    baseline = {}
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    if baseline and baseline.get('scale') != args.scale:
+        print(f"Baseline was taken with --scale {baseline.get('scale')}, not compared.")
+        baseline = {}
+
+    results, failed = {}, []
+    try:
+        for name in args.scenarios or list(SCENARIOS):
+            results[name] = run_scenario(name, model, server, profile, args.region)
+            regressions = report(name, results[name], baseline.get('scenarios', {}).get(name), args.tolerance)
+            if results[name]['failure'] or regressions:
+                failed.append(name)
+    finally:
+        server.close()
+
+    output = {'scale': args.scale, 'scenarios': results}
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+    if args.update_baseline and not any(result['failure'] for result in results.values()):
+        scenarios = {**baseline.get('scenarios', {}), **results}
+        with open(args.baseline, 'w') as f:
+            json.dump({'scale': args.scale, 'scenarios': {name: {key: result[key] for key in GATED}
+                                                          for name, result in scenarios.items()}}, f, indent=2)
+            f.write("\n")
+        print(f"\nBaseline written to '{args.baseline}'.")
+    if failed:
+        print(f"\nFailed or regressed: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""
+Local SSH server standing in for the stack's hosts in the offline benchmarks.
+
+Nothing is executed: every command of create_dotp is answered from the 'remote' section of the
+latency profile (benchmarks.latency), with output lines spread over its duration like a real install.
+The bastion is reached on a local port, private hosts through direct-tcpip channels opened on the bastion
+session, exactly like utils.ssh_sessions does on AWS. Other forwarded ports (Gitea's 3000, ...) answer HTTP
+once the service has been brought up on that host.
+"""
+import logging
+import re
+import socket
+import threading
+import time
+import paramiko
+from utils.bootstrap import STATUS_FILE
+from utils.bundle import MARKER
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+BASTION = 'bastion'
+# Forwarded port -> service answering HTTP on it
+SERVICE_PORTS = {3000: 'gitea', 8080: 'jenkins', 8081: 'artifactory'}
+_COMPOSE_ROLE = re.compile(r'resources/(\w+)/docker-compose\.yaml up')
+_BUNDLE_DIGEST = re.compile(r'echo ([0-9a-f]{64}) >')
+
+
+class Host:
+    """
+    State of one simulated host: unpacked bundle, installed docker and the time every service came up.
+    """
+
+    def __init__(self, name, booted):
+        self.name = name
+        self.booted = booted
+        self.digest = None
+        self.docker = False
+        self.started = {}
+        self.commands = 0
+
+
+class _Interface(paramiko.ServerInterface):
+    def __init__(self, server, host):
+        self.server = server
+        self.host = host
+        self.forwards = {}
+
+    def check_auth_publickey(self, username, key):
+        return paramiko.AUTH_SUCCESSFUL
+
+    def get_allowed_auths(self, username):
+        return 'publickey'
+
+    def check_channel_request(self, kind, chanid):
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_direct_tcpip_request(self, chanid, origin, destination):
+        self.forwards[chanid] = destination
+        return paramiko.OPEN_SUCCEEDED
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.server.execute, args=(self.host, channel, command.decode()), daemon=True).start()
+        return True
+
+
+class SshServer:
+    """
+    Serves SSH on 127.0.0.1:`port` (a free port by default) until close().
+    `launch_time(host)` gives the time.monotonic() a host was launched at (None when unknown),
+    cloud-init starts once it runs.
+    """
+
+    def __init__(self, profile, launch_time=lambda host: None, port=0):
+        self.profile = profile
+        self.launch_time = launch_time
+        self.key = paramiko.RSAKey.generate(2048)
+        self.hosts = {}
+        self._lock = threading.Lock()
+        self._channels = []
+        self._sock = socket.create_server(('127.0.0.1', port))
+        self.port = self._sock.getsockname()[1]
+        self._closed = False
+        threading.Thread(target=self._accept, name="bench-sshd", daemon=True).start()
+
+    def reset(self, profile):
+        with self._lock:
+            self.profile = profile
+            self.hosts = {}
+
+    def close(self):
+        self._closed = True
+        self._sock.close()
+
+    def host(self, name):
+        with self._lock:
+            host = self.hosts.get(name)
+            if host == None:
+                launched = self.launch_time(name)
+                booted = time.monotonic() if launched == None else launched + self.profile['ready']['instance']
+                host = self.hosts[name] = Host(name, booted)
+            return host
+
+    def _accept(self):
+        while not self._closed:
+            try:
+                sock, _ = self._sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(sock, BASTION), daemon=True).start()
+
+    def _serve(self, sock, host_name):
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.key)
+        interface = _Interface(self, self.host(host_name))
+        try:
+            transport.start_server(server=interface)
+        except (paramiko.SSHException, EOFError):
+            return  # e.g. a port check closing the connection right away
+        while transport.is_active():
+            channel = transport.accept(1)
+            if channel == None:
+                continue
+            # paramiko closes channels that are garbage collected
+            self._channels.append(channel)
+            destination = interface.forwards.pop(channel.get_id(), None)
+            if destination == None:
+                continue
+            address, port = destination
+            if port == 22:
+                # SSH to a private host through the bastion: a nested server on the channel
+                threading.Thread(target=self._serve, args=(channel, address), daemon=True).start()
+            else:
+                threading.Thread(target=self._http, args=(self.host(address), port, channel), daemon=True).start()
+
+    def _http(self, host, port, channel):
+        try:
+            request = b''
+            while b'\r\n\r\n' not in request:
+                data = channel.recv(4096)
+                if not data:
+                    break
+                request += data
+            if self._service_ready(host, SERVICE_PORTS.get(port)):
+                channel.sendall(b"HTTP/1.0 200 OK\r\nContent-Length: 0\r\n\r\n")
+            else:
+                channel.sendall(b"HTTP/1.0 502 Bad Gateway\r\nContent-Length: 0\r\n\r\n")
+        finally:
+            channel.close()
+
+    def _bootstrapped(self, host):
+        return time.monotonic() - host.booted >= self.profile['remote']['bootstrap']
+
+    def _service_ready(self, host, service, delay_key='service_start'):
+        started = host.started.get(service)
+        if started == None and 'cloud-init' in host.started and self._bootstrapped(host):
+            # cloud-init brought every service of the host up at the end of the bootstrap
+            started = host.booted + self.profile['remote']['bootstrap']
+        return started != None and time.monotonic() - started >= self.profile['remote'][delay_key]
+
+    def execute(self, host, channel, command):
+        try:
+            host.commands += 1
+            exit_status = self._execute(host, channel, command)
+        except Exception as e:
+            logger.warning(f"Benchmark SSH server: '{command}' on '{host.name}' failed: {e}")
+            channel.sendall_stderr(f"{e}\n".encode())
+            exit_status = 1
+        channel.send_exit_status(exit_status)
+        channel.close()
+
+    def _work(self, channel, seconds, label, lines=None):
+        # Output spread over the duration of the command, like a package install streaming its log
+        lines = self.profile['remote']['output_lines'] if lines == None else lines
+        if lines == 0:
+            time.sleep(seconds)
+            return
+        for index in range(lines):
+            time.sleep(seconds / lines)
+            channel.sendall(f"[{label}] step {index + 1}/{lines}\n".encode())
+
+    def _execute(self, host, channel, command):
+        remote = self.profile['remote']
+        if MARKER in command and 'tar xzmf -' not in command:
+            time.sleep(remote['command'])
+            if host.digest == None:
+                channel.sendall_stderr(f"cat: {MARKER}: No such file or directory\n".encode())
+                return 1
+            channel.sendall(f"{host.digest}\n".encode())
+            return 0
+        if 'tar xzmf -' in command:
+            # Drain the bundle stream up to the client's EOF
+            while channel.recv(65536):
+                pass
+            time.sleep(remote['bundle'])
+            match = _BUNDLE_DIGEST.search(command)
+            host.digest = match.group(1) if match else None
+            return 0
+        if STATUS_FILE in command:
+            time.sleep(remote['command'])
+            host.started.setdefault('cloud-init', host.booted)
+            channel.sendall(b"ok\n" if self._bootstrapped(host) else b"running\n")
+            return 0
+        if 'docker_install.sh' in command:
+            self._work(channel, remote['docker_install'], 'docker')
+            host.docker = True
+            return 0
+        if 'jenkins/install.sh' in command:
+            self._work(channel, remote['jenkins_install'], 'jenkins')
+            host.started['jenkins'] = time.monotonic()
+            return 0
+        if 'initialAdminPassword' in command:
+            time.sleep(remote['command'])
+            if not self._service_ready(host, 'jenkins', 'jenkins_password'):
+                channel.sendall_stderr(b"cat: /var/jenkins_home/secrets/initialAdminPassword: No such file or directory\n")
+                return 1
+            channel.sendall(b"0123456789abcdef0123456789abcdef\n")
+            return 0
+        if 'gitea admin user create' in command:
+            time.sleep(remote['gitea_admin'])
+            channel.sendall(b"New user 'root' has been successfully created!\n")
+            return 0
+        match = _COMPOSE_ROLE.search(command)
+        if match:
+            self._work(channel, remote['compose_up'], match.group(1), lines=4)
+            host.started[match.group(1)] = time.monotonic()
+            return 0
+        if 'nginx/config.sh' in command:
+            self._work(channel, remote['nginx_config'], 'nginx', lines=2)
+            return 0
+        time.sleep(remote['command'])
+        return 0
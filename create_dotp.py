@@ -1,23 +1,54 @@
 import secrets
 import string
 import botocore
-import boto3
 import json
 import os
 import logging
 from datetime import date, datetime
 import paramiko
 import time
-from flask_socketio import emit
 
 from utils.functions_vpc import *
 from utils.functions_ec2 import *
+from utils.engine import Cancelled, Step, run_steps
+from utils.aws_clients import get_client, current_session
+from utils.bootstrap import STATUS_FILE, docker_cmd, render_user_data, role_commands
+from utils.bundle import build_bundle, push_bundle
+from utils.journal import Journal
+from utils import images
+from utils import inventory, lookups, rate_limiter, sg_rules, tracing, warm_pool
+from utils.output import emit
+from utils.readiness import CommandProbe, HttpProbe, Target, wait_ready
+from utils.reconcile import STACK_KINDS, Plan
+from utils.remote_exec import remote_step, run_on_hosts
+from utils.ssh_sessions import SessionManager
 
 # logger config
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO,
                     format='[%(asctime)s] [%(levelname)s] %(message)s')
 
+# How long a host may take to configure itself with cloud-init (bootstrap='cloud-init')
+BOOTSTRAP_TIMEOUT = 1800
+
+# create: build a new stack (or resume the journal of a failed run), plan: show what reconcile would change,
+# reconcile: bring the live resources tagged with the project to the desired stack, changing only the difference
+MODES = ('create', 'plan', 'reconcile')
+
+VPC_CIDR = "10.0.0.0/26"
+# Public subnets 1 & 2 host the NAT Gateways, private subnets route through the NAT in the same AZ
+# (step / key, label, availability zone index, CIDR block, title)
+SUBNETS = [("private_subnet1", "private1", 0, "10.0.0.32/28", "Private Subnet 1"),
+           ("private_subnet2", "private2", 1, "10.0.0.48/28", "Private Subnet 2"),
+           ("public_subnet1", "public1", 0, "10.0.0.0/28", "Public Subnet 1"),
+           ("public_subnet2", "public2", 1, "10.0.0.16/28", "Public Subnet 2")]
+# Steps changing a resource of another step (updates of a plan) and steps changing nothing
+CHANGE_STEPS = ("internet_gateway_attach", "rtb_public_routes", "rtb_private1_routes", "rtb_private2_routes",
+                "vpc_endpoint_routes")
+READ_STEPS = ("availability_zones", "golden_image", "public_subnet1_ng_wait", "public_subnet2_ng_wait")
+# Ingress of the stack's security group (see utils.sg_rules): SSH, the tools and nginx
+SECURITY_GROUP_RULES = "0.0.0.0/0:22,0.0.0.0/0:3000,0.0.0.0/0:8080,0.0.0.0/0:8081"
+
 
 def json_datetime_serializer(obj):
     """
@@ -29,158 +60,475 @@ def json_datetime_serializer(obj):
     raise TypeError("Type %s not serializable" % type(obj))
 
 
-def run(multiple_vms, _instance_type, project='dev-ops-tools-pack'):
+def _check_cancel(cancel):
+    if cancel != None and cancel.is_set():
+        emit("output", "Run cancelled.")
+        raise Cancelled("Run cancelled.")
+
+
+def _report_step(step, context, elapsed):
+    if step.message == None:
+        return
+    message = step.message.format(elapsed=elapsed, **context)
+    logger.info(message)
+    emit("output", message)
+
+
+def _journaled(journal):
+    # Journal every finished step before reporting it, a run dying right after still resumes past it
+    def on_complete(step, context, elapsed):
+        journal.on_complete(step, context, elapsed)
+        _report_step(step, context, elapsed)
+    return on_complete
+
+
+def _pem_path(key_pair_name):
+    return os.path.expanduser('~') + "/shadow/" + key_pair_name + ".pem"
+
+
+def network_steps(project, region_name):
+    """
+    Provisioning steps for the network of one stack:
+    VPC + S3 endpoint, Internet Gateway, 2 public and 2 private subnets in the first 2 availability zones,
+    a NAT Gateway in each public subnet and one public and two private route tables.
+    """
+    def availability_zones():
+        client = get_client('ec2')
+        return [az['ZoneName'] for az in client.describe_availability_zones()['AvailabilityZones'][0:2]]
+
+    def default_route(route_table, target, target_type, subnets):
+        # A live route table (reconcile) may have the route, to an older target, and some associations already
+        route_table_id = route_table['RouteTableId']
+        current = next((route for route in route_table.get('Routes', []) if route.get('DestinationCidrBlock') == "0.0.0.0/0"), None)
+        if current == None:
+            create_route(route_table=route_table_id, destination="0.0.0.0/0", target=target, target_type=target_type)
+        elif target not in (current.get('GatewayId'), current.get('NatGatewayId')):
+            replace_route(route_table_id, "0.0.0.0/0", target, target_type)
+        associated = {association.get('SubnetId') for association in route_table.get('Associations', [])}
+        for subnet in subnets:
+            if subnet not in associated:
+                associate_route_table(route_table_id, subnet)
+        return True
+
+    def public_routes(rtb_public, internet_gateway, public_subnet1, public_subnet2, igw_attached):
+        return default_route(rtb_public['RouteTable'], internet_gateway['InternetGateway']['InternetGatewayId'], "InternetGateway",
+                             [public_subnet1['Subnet']['SubnetId'], public_subnet2['Subnet']['SubnetId']])
+
+    def private_routes(rtb_private, nat_gateway, private_subnet):
+        return default_route(rtb_private['RouteTable'], nat_gateway['NatGateway']['NatGatewayId'], "NatGateway",
+                             [private_subnet['Subnet']['SubnetId']])
+
+    steps = [
+        Step("vpc", lambda: create_vpc(name=project, cidr_block=VPC_CIDR, project=project),
+             provides=["vpc"],
+             message="VPC created. ID '{vpc[Vpc][VpcId]}'"),
+        Step("vpc_endpoint",
+             lambda vpc: create_vpc_endpoint(name=project+"-s3", vpc_id=vpc['Vpc']['VpcId'],
+                                             service_name="com.amazonaws." + region_name + ".s3", project=project),
+             requires=["vpc"], provides=["vpce"],
+             message="VPC Endpoint created. ID '{vpce[VpcEndpoint][VpcEndpointId]}'"),
+        Step("internet_gateway", lambda: create_internet_gateway(name=project + "-igw", project=project),
+             provides=["internet_gateway"],
+             message="Internet Gateway created. ID '{internet_gateway[InternetGateway][InternetGatewayId]}'"),
+        Step("internet_gateway_attach",
+             lambda internet_gateway, vpc: attach_internet_gateway(internet_gateway['InternetGateway']['InternetGatewayId'],
+                                                                   vpc['Vpc']['VpcId']) or True,
+             requires=["internet_gateway", "vpc"], provides=["igw_attached"]),
+        Step("availability_zones", availability_zones, provides=["availability_zones"]),
+    ]
+
+    for key, label, az_index, cidr_block, title in SUBNETS:
+        steps.append(Step(key,
+                          lambda vpc, availability_zones, label=label, az_index=az_index, cidr_block=cidr_block:
+                              create_subnet(name=project + "-subnet-" + label + "-" + availability_zones[az_index],
+                                            vpc_id=vpc['Vpc']['VpcId'],
+                                            availability_zone=availability_zones[az_index],
+                                            cidr_block=cidr_block, project=project),
+                          requires=["vpc", "availability_zones"], provides=[key],
+                          message=title + " created. AvailabilityZone: '{" + key + "[Subnet][AvailabilityZone]}' ; " +
+                                  "CidrBlock: '{" + key + "[Subnet][CidrBlock]}'. ID '{" + key + "[Subnet][SubnetId]}'"))
+
+    for index in (1, 2):
+        eip, nat, subnet = f"public_subnet{index}_eip", f"public_subnet{index}_ng", f"public_subnet{index}"
+        steps += [
+            Step(eip, lambda index=index: allocate_elastic_ip(project + f"-subnet-public{index}-eip", project=project),
+                 provides=[eip]),
+            Step(nat,
+                 lambda index=index, **inputs: create_nat_gateway(project + f"-subnet-public{index}-ng",
+                                                                   inputs[f"public_subnet{index}"]['Subnet']['SubnetId'],
+                                                                   inputs[f"public_subnet{index}_eip"]['AllocationId'],
+                                                                   project=project),
+                 requires=[subnet, eip], provides=[nat],
+                 message=f"Created NAT Gateway for Public Subnet {index} with Elastic IP " +
+                         "'{" + eip + "[PublicIp]}'. ID '{" + nat + "[NatGateway][NatGatewayId]}'"),
+            Step(nat + "_wait",
+                 lambda index=index, **inputs: wait_nat_gateway_available(inputs[f"public_subnet{index}_ng"]['NatGateway']['NatGatewayId']) or True,
+                 requires=[nat], provides=[nat + "_ready"],
+                 message=f"|⏲️|->  Time took for NAT Gateway {index} to be ready - " + "{elapsed:0.2f} seconds 😱"),
+            Step(f"rtb_private{index}",
+                 lambda vpc, availability_zones, index=index:
+                     create_route_table(name=project + f"-rtb-private{index}-" + availability_zones[index - 1],
+                                        vpc_id=vpc['Vpc']['VpcId'], project=project),
+                 requires=["vpc", "availability_zones"], provides=[f"rtb_private{index}"],
+                 message=f"Private Route Table {index} created. ID '" + "{" + f"rtb_private{index}" + "[RouteTable][RouteTableId]}'"),
+            Step(f"rtb_private{index}_routes",
+                 lambda index=index, **inputs: private_routes(inputs[f"rtb_private{index}"],
+                                                              inputs[f"public_subnet{index}_ng"],
+                                                              inputs[f"private_subnet{index}"]),
+                 requires=[f"rtb_private{index}", nat, nat + "_ready", f"private_subnet{index}"],
+                 provides=[f"rtb_private{index}_routed"]),
+        ]
+
+    steps += [
+        Step("rtb_public", lambda vpc: create_route_table(name=project + "-rtb-public", vpc_id=vpc['Vpc']['VpcId'], project=project),
+             requires=["vpc"], provides=["rtb_public"],
+             message="Public Route Table created. ID '{rtb_public[RouteTable][RouteTableId]}'"),
+        Step("rtb_public_routes", public_routes,
+             requires=["rtb_public", "internet_gateway", "public_subnet1", "public_subnet2", "igw_attached"],
+             provides=["rtb_public_routed"]),
+        Step("vpc_endpoint_routes",
+             lambda vpce, rtb_private1, rtb_private2: add_vpc_endpoint_route_tables(
+                 vpce['VpcEndpoint']['VpcEndpointId'],
+                 [rtb_private1['RouteTable']['RouteTableId'], rtb_private2['RouteTable']['RouteTableId']]) or True,
+             requires=["vpce", "rtb_private1", "rtb_private2"], provides=["vpce_routed"],
+             message="Added Private Route Tables to VPC Endpoint."),
+    ]
+    return steps
+
+
+def instance_specs(project, multiple_vms, private_subnet_id, public_subnet_id, security_group):
+    """
+    The instances of one stack for launch_ec2_instances: jenkins (+ gitea and artifactory) in the private subnet,
+    nginx last, in the public one.
+    """
+    names = ["dot_jenkins"] + (["dot_gitea", "dot_artifactory"] if multiple_vms == True else [])
+    specs = [{'instance_name': name, 'subnet_id': private_subnet_id, 'security_group': security_group, 'project': project}
+             for name in names]
+    specs.append({'instance_name': "dot_nginx", 'subnet_id': public_subnet_id, 'security_group': security_group, 'project': project})
+    return specs
+
+
+def adopt_network(plan, project, region_name):
+    """
+    Adopt in `plan` (utils.reconcile.Plan) the live resources matching what network_steps, the key pair and
+    the security group steps create: same Name tag and settings. A resource with other settings is left out,
+    so it is deleted and created again.
+    """
+    vpc = plan.find('vpcs', project, CidrBlock=VPC_CIDR)
+    if vpc == None:
+        return
+    vpc_id = vpc['VpcId']
+    plan.adopt("vpc", {"vpc": {'Vpc': vpc}}, vpc_id)
+
+    vpce = plan.find('vpc_endpoints', project + "-s3", VpcId=vpc_id, ServiceName="com.amazonaws." + region_name + ".s3")
+    if vpce != None:
+        plan.adopt("vpc_endpoint", {"vpce": {'VpcEndpoint': vpce}}, vpce['VpcEndpointId'])
+    internet_gateway = plan.find('internet_gateways', project + "-igw")
+    # A gateway attached to another VPC goes with that VPC
+    if internet_gateway != None and all(attachment['VpcId'] == vpc_id for attachment in internet_gateway.get('Attachments', [])):
+        plan.adopt("internet_gateway", {"internet_gateway": {'InternetGateway': internet_gateway}}, internet_gateway['InternetGatewayId'])
+        if internet_gateway.get('Attachments'):
+            plan.adopt("internet_gateway_attach", {"igw_attached": True})
+
+    subnets, zones = {}, {}
+    for key, label, az_index, cidr_block, title in SUBNETS:
+        subnet = plan.find('subnets', f"{project}-subnet-{label}-*", VpcId=vpc_id, CidrBlock=cidr_block)
+        if subnet != None and zones.setdefault(az_index, subnet['AvailabilityZone']) == subnet['AvailabilityZone']:
+            subnets[key] = subnet['SubnetId']
+            plan.adopt(key, {key: {'Subnet': subnet}}, subnet['SubnetId'])
+    if len(zones) == 2:
+        plan.adopt("availability_zones", {"availability_zones": [zones[0], zones[1]]})
+
+    def routed(route_table, target, subnet_ids):
+        route = next((route for route in route_table.get('Routes', []) if route.get('DestinationCidrBlock') == "0.0.0.0/0"), {})
+        associated = {association.get('SubnetId') for association in route_table.get('Associations', [])}
+        return target in (route.get('GatewayId'), route.get('NatGatewayId')) and set(subnet_ids) <= associated
+
+    route_tables = {}
+    for index in (1, 2):
+        eip = plan.find('addresses', f"{project}-subnet-public{index}-eip")
+        if eip != None:
+            plan.adopt(f"public_subnet{index}_eip", {f"public_subnet{index}_eip": eip}, eip['AllocationId'])
+        nat = None
+        if eip != None and f"public_subnet{index}" in subnets:
+            nat = plan.find('nat_gateways', f"{project}-subnet-public{index}-ng", SubnetId=subnets[f"public_subnet{index}"])
+        if nat != None and any(address.get('AllocationId') == eip['AllocationId'] for address in nat['NatGatewayAddresses']):
+            plan.adopt(f"public_subnet{index}_ng", {f"public_subnet{index}_ng": {'NatGateway': nat}}, nat['NatGatewayId'])
+            if nat['State'] == 'available':
+                plan.adopt(f"public_subnet{index}_ng_wait", {f"public_subnet{index}_ng_ready": True})
+        route_table = plan.find('route_tables', f"{project}-rtb-private{index}-*", VpcId=vpc_id)
+        if route_table != None:
+            route_tables[index] = route_table['RouteTableId']
+            plan.adopt(f"rtb_private{index}", {f"rtb_private{index}": {'RouteTable': route_table}}, route_table['RouteTableId'])
+            if nat != None and f"private_subnet{index}" in subnets and \
+                    routed(route_table, nat['NatGatewayId'], [subnets[f"private_subnet{index}"]]):
+                plan.adopt(f"rtb_private{index}_routes", {f"rtb_private{index}_routed": True})
+
+    route_table = plan.find('route_tables', project + "-rtb-public", VpcId=vpc_id)
+    if route_table != None:
+        plan.adopt("rtb_public", {"rtb_public": {'RouteTable': route_table}}, route_table['RouteTableId'])
+        if "internet_gateway" in plan.adopted and {"public_subnet1", "public_subnet2"} <= set(subnets) and \
+                routed(route_table, internet_gateway['InternetGatewayId'], [subnets["public_subnet1"], subnets["public_subnet2"]]):
+            plan.adopt("rtb_public_routes", {"rtb_public_routed": True})
+    if vpce != None and len(route_tables) == 2 and set(route_tables.values()) <= set(vpce.get('RouteTableIds', [])):
+        plan.adopt("vpc_endpoint_routes", {"vpce_routed": True})
+
+    security_group = plan.find('security_groups', GroupName=project + "-sgr", VpcId=vpc_id)
+    # A group with other rules is kept, the step brings its rules to SECURITY_GROUP_RULES
+    if security_group != None and sg_rules.diff(sg_rules.compile_rules(SECURITY_GROUP_RULES), security_group['IpPermissions']) == ([], []):
+        plan.adopt("security_group", {"security_group": security_group['GroupId']}, security_group['GroupId'])
+    elif security_group != None:
+        plan.modify("security_group", {"security_group": security_group['GroupId']}, security_group['GroupId'])
+    # Key pairs carry no tags, the one of the running instances is kept while its private key is here
+    for instance in plan.live.get('instances', []):
+        key_name = instance.get('KeyName')
+        if key_name != None and os.path.isfile(_pem_path(key_name)) and lookups.find_key_pair(key_name) != None:
+            plan.adopt("key_pair", {"key_pair": key_name})
+            break
+
+
+def adopt_instances(plan, specs, instance_type, key_pair_name, bootstrap):
     """
-    Start boto3 session, get config from ~/.aws/config , ~/.aws/credentials:
+    Adopt in `plan` the running instances matching `specs` (see instance_specs): same Name tag, subnet, security group,
+    instance type and key pair. With cloud-init the nginx user data holds the backend addresses,
+    so the instances are only kept when all of them are.
     """
+    for spec in specs:
+        for instance in plan.live.get('instances', []):
+            if (instance.get('Tags') and {'Key': 'Name', 'Value': spec['instance_name']} in instance['Tags']
+                    and instance['State']['Name'] in ('pending', 'running') and instance['SubnetId'] == spec['subnet_id']
+                    and instance['InstanceType'] == instance_type and instance.get('KeyName') == key_pair_name
+                    and spec['security_group'] in [group['GroupId'] for group in instance['SecurityGroups']]):
+                plan.adopt_instance(spec['instance_name'], instance)
+                break
+    if bootstrap == 'cloud-init' and len(plan.instances) < len(specs):
+        for name, instance in list(plan.instances.items()):
+            plan.keep.discard(instance['InstanceId'])
+            plan.instances.pop(name)
+    plan.add_instances([spec['instance_name'] for spec in specs if spec['instance_name'] not in plan.instances])
+
+
+def service_steps(sessions, hosts, docker_installed=False, bootstrapped=False):
+    """
+    Remote steps bringing up the services once the instances run.
+        sessions - utils.ssh_sessions.SessionManager, the bastion is the nginx host
+        hosts    - role ('nginx', 'jenkins', 'gitea', 'artifactory') -> host, None for the bastion.
+                   Roles may share a host, every host gets the resources and docker once.
+        docker_installed - the hosts run a golden image (utils.images), docker and the service images are there
+        bootstrapped     - the hosts configure themselves with cloud-init user data (utils.bootstrap),
+                           the steps only wait for them to finish
+    Jenkins, Gitea and Artifactory start as soon as docker is installed on their host,
+    nginx only once every backend is up.
+    Provides 'jenkins_password' (Jenkins initial admin password) and 'gitea_pwd' (Gitea 'root' user password).
+    """
+    def label(host):
+        return host or sessions.bastion_host
 
+    def create_gitea_admin(**_):
+        gitea_pwd = ''.join(secrets.choice(
+            string.ascii_uppercase + string.ascii_lowercase) for _ in range(16))
+        results = run_on_hosts(sessions, [hosts['gitea']], docker_cmd(
+            f"docker exec -u 1000 gitea gitea admin user create --admin --username root --password {gitea_pwd} --email admin@localhost.com"),
+            step="gitea_admin")
+        logger.info(results[hosts['gitea']].stdout)
+        return gitea_pwd
+
+    def jenkins_password(**_):
+        ready = wait_ready([
+            Target("jenkins", CommandProbe(docker_cmd("docker exec jenkins cat /var/jenkins_home/secrets/initialAdminPassword"),
+                                           run=lambda command: sessions.run(hosts['jenkins'], command)[:2]),
+                   host=hosts['jenkins'])])
+        return ready["jenkins"].strip()
+
+    steps = []
+    if bootstrapped:
+        # cloud-init brings every host up at boot (utils.bootstrap), only wait for it to report
+        for role, host in hosts.items():
+            steps.append(Step(role,
+                              lambda role=role, host=host: wait_ready([
+                                  Target(f"{role}-bootstrap",
+                                         CommandProbe(f"cat {STATUS_FILE}", run=lambda command, host=host: sessions.run(host, command)[:2],
+                                                      expect="ok", fail="failed"),
+                                         timeout=BOOTSTRAP_TIMEOUT, delay=5, max_delay=30, host=label(host))]) and True,
+                              provides=[role], message=f"{role} bootstrapped on '{label(host)}' " + "in {elapsed:0.2f} seconds."))
+    else:
+        # ./resources goes as one compressed stream, hosts already holding the same content are skipped
+        bundle = build_bundle("./resources")
+        for host in dict.fromkeys(hosts.values()):
+            steps.append(Step("resources@" + label(host), lambda host=host: push_bundle(sessions, host, bundle),
+                              provides=["resources@" + label(host)],
+                              message=f"Resources ready on '{label(host)}'."))
+            if docker_installed:
+                steps.append(Step("docker@" + label(host), lambda **_: True,
+                                  requires=["resources@" + label(host)], provides=["docker@" + label(host)]))
+            else:
+                steps.append(remote_step("docker@" + label(host), sessions, [host], "sudo /bin/bash ./resources/ubuntu/docker_install.sh",
+                                         requires=["resources@" + label(host)],
+                                         message=f"Docker installed on '{label(host)}' " + "in {elapsed:0.2f} seconds."))
+
+        # The sessions were opened before the user joined the 'docker' group, 'sg docker' picks it up without reconnecting
+        nginx_config, nginx_up = role_commands('nginx', hosts)
+        steps += [
+            remote_step("jenkins", sessions, [hosts['jenkins']], role_commands('jenkins', hosts)[0],
+                        requires=["docker@" + label(hosts['jenkins'])], message="Jenkins installed."),
+            remote_step("gitea", sessions, [hosts['gitea']], role_commands('gitea', hosts)[0],
+                        requires=["docker@" + label(hosts['gitea'])], message="Gitea installed."),
+            remote_step("artifactory", sessions, [hosts['artifactory']], role_commands('artifactory', hosts)[0],
+                        requires=["docker@" + label(hosts['artifactory'])], message="Artifactory installed."),
+            remote_step("nginx_config", sessions, [hosts['nginx']], nginx_config,
+                        requires=["resources@" + label(hosts['nginx'])]),
+            remote_step("nginx", sessions, [hosts['nginx']], nginx_up,
+                        requires=["nginx_config", "docker@" + label(hosts['nginx']), "jenkins", "gitea", "artifactory"],
+                        message="NGinx installed."),
+        ]
+
+    steps += [
+        # Wait for Gitea (port 3000) and the Jenkins initial password at the same time
+        Step("gitea_ready",
+             lambda **_: wait_ready([Target("gitea", HttpProbe(hosts['gitea'], 3000, via=sessions.transport),
+                                            host=hosts['gitea'])])["gitea"],
+             requires=["gitea"], provides=["gitea_ready"]),
+        Step("jenkins_password", jenkins_password, requires=["jenkins"], provides=["jenkins_password"]),
+        # Create default Gitea 'root' user with random password.
+        Step("gitea_admin", create_gitea_admin, requires=["gitea_ready"], provides=["gitea_pwd"]),
+    ]
+    return steps
+
+
+def run(multiple_vms, _instance_type, project='dev-ops-tools-pack', cancel=None, bootstrap='ssh', mode='create'):
+    """
+    Deploy the stack with the AWS session of the caller (aws_clients.use_session, see aws_clients.current_session):
+    cancel - optional threading.Event, checked before every step; raises engine.Cancelled once set
+    bootstrap - 'ssh': the services are installed over SSH once the instances run,
+                'cloud-init': every instance installs its services from user data at boot, SSH only waits for them
+    mode - see MODES
+    Returns the stack ('vpc_id', 'instances', 'url', and 'error' when its services could not be brought up),
+    in 'plan' mode the plan ('plan', 'changes').
+    """
+    if bootstrap not in ('ssh', 'cloud-init'):
+        raise ValueError(f"Unknown bootstrap mode '{bootstrap}'.")
+    if mode not in MODES:
+        raise ValueError(f"Unknown mode '{mode}'.")
+
+    # Every phase, step, AWS call and remote command is a span of the run trace (see utils.tracing)
+    run_trace = None
+    try:
+        with tracing.trace("create_dotp", project=project, instance_type=_instance_type,
+                           multiple_vms=multiple_vms, bootstrap=bootstrap, mode=mode) as run_trace:
+            return _run(multiple_vms, _instance_type, project, cancel, bootstrap, mode)
+    finally:
+        if mode != 'plan':
+            # Resources of the project were created or deleted, the status views read them again
+            inventory.project_index(project).invalidate()
+        if run_trace != None:
+            emit("output", "|⏲️|-> Time spent per phase:")
+            for line in run_trace.summary():
+                emit("output", line)
+
+
+def _run(multiple_vms, _instance_type, project, cancel, bootstrap, mode):
     # Init connections
-    full_tic = time.perf_counter()
+    tracing.phase("network", region=current_session().region_name)
     logger.info("Initiate AWS connections.")
     emit("output", "Initiate AWS connections.")
-    session = boto3.Session()
-    client = boto3.client('ec2')
-    ec2 = boto3.resource('ec2', region_name=session.region_name)
-
-    # Create VPC
-    vpc = create_vpc(name=project, cidr_block="10.0.0.0/26")
-    logger.info(f"VPC created. ID '{vpc['Vpc']['VpcId']}'")
-    emit("output", f"VPC created. ID '{vpc['Vpc']['VpcId']}'")
-    vpce = create_vpc_endpoint(
-        name=project+"-s3", vpc_id=vpc['Vpc']['VpcId'], service_name="com.amazonaws." + session.region_name + ".s3")
-    logger.info(
-        f"VPC Endpoint created. ID '{vpce['VpcEndpoint']['VpcEndpointId']}'")
-
-    # Create Internet Gateway
-    internet_gateway = create_internet_gateway(name=project + "-igw")
-    logger.info(
-        f"Internet Gateway created. ID '{internet_gateway['InternetGateway']['InternetGatewayId']}'")
-    emit("output",
-         f"Internet Gateway created. ID '{internet_gateway['InternetGateway']['InternetGatewayId']}'")
-    ec2.InternetGateway(internet_gateway['InternetGateway']['InternetGatewayId']).attach_to_vpc(
-        VpcId=vpc['Vpc']['VpcId'])
-
-    # Create 4 subnets in first 2 availability zones
-    availability_zones = client.describe_availability_zones()[
-        'AvailabilityZones'][0:2]
-
-    private_subnet1 = create_subnet(name=project + "-subnet-private1-" + availability_zones[0]['ZoneName'],
-                                    vpc_id=vpc['Vpc']['VpcId'],
-                                    availability_zone=availability_zones[0]['ZoneName'],
-                                    cidr_block="10.0.0.32/28")
-    logger.info(
-        f"Private Subnet 1 created. AvailabilityZone: '{private_subnet1['Subnet']['AvailabilityZone']}' ; CidrBlock: '{private_subnet1['Subnet']['CidrBlock']}'. ID '{private_subnet1['Subnet']['SubnetId']}'")
-    emit("output",
-         f"Private Subnet 1 created. AvailabilityZone: '{private_subnet1['Subnet']['AvailabilityZone']}' ; CidrBlock: '{private_subnet1['Subnet']['CidrBlock']}'. ID '{private_subnet1['Subnet']['SubnetId']}'")
-
-    private_subnet2 = create_subnet(name=project + "-subnet-private2-" + availability_zones[1]['ZoneName'],
-                                    vpc_id=vpc['Vpc']['VpcId'],
-                                    availability_zone=availability_zones[1]['ZoneName'],
-                                    cidr_block="10.0.0.48/28")
-    logger.info(
-        f"Private Subnet 2 created. AvailabilityZone: '{private_subnet2['Subnet']['AvailabilityZone']}' ; CidrBlock: '{private_subnet2['Subnet']['CidrBlock']}'. ID '{private_subnet2['Subnet']['SubnetId']}'")
-    emit("output",
-         f"Private Subnet 2 created. AvailabilityZone: '{private_subnet2['Subnet']['AvailabilityZone']}' ; CidrBlock: '{private_subnet2['Subnet']['CidrBlock']}'. ID '{private_subnet2['Subnet']['SubnetId']}'")
-
-    public_subnet1 = create_subnet(name=project + "-subnet-public1-" + availability_zones[0]['ZoneName'],
-                                   vpc_id=vpc['Vpc']['VpcId'],
-                                   availability_zone=availability_zones[0]['ZoneName'],
-                                   cidr_block="10.0.0.0/28")
-    logger.info(
-        f"Public Subnet 1 created. AvailabilityZone: '{public_subnet1['Subnet']['AvailabilityZone']}' ; CidrBlock: '{public_subnet1['Subnet']['CidrBlock']}'. ID '{public_subnet1['Subnet']['SubnetId']}'")
-    emit("output",
-         f"Public Subnet 1 created. AvailabilityZone: '{public_subnet1['Subnet']['AvailabilityZone']}' ; CidrBlock: '{public_subnet1['Subnet']['CidrBlock']}'. ID '{public_subnet1['Subnet']['SubnetId']}'")
-
-    public_subnet2 = create_subnet(name=project + "-subnet-public2-" + availability_zones[1]['ZoneName'],
-                                   vpc_id=vpc['Vpc']['VpcId'],
-                                   availability_zone=availability_zones[1]['ZoneName'],
-                                   cidr_block="10.0.0.16/28")
-    logger.info(
-        f"Public Subnet 1 created. AvailabilityZone: '{public_subnet2['Subnet']['AvailabilityZone']}' ; CidrBlock: '{public_subnet2['Subnet']['CidrBlock']}'. ID '{public_subnet2['Subnet']['SubnetId']}'")
-    emit("output",
-         f"Public Subnet 1 created. AvailabilityZone: '{public_subnet2['Subnet']['AvailabilityZone']}' ; CidrBlock: '{public_subnet2['Subnet']['CidrBlock']}'. ID '{public_subnet2['Subnet']['SubnetId']}'")
-
-    # create NAT gateway in public subnet2
-    tic = time.perf_counter()
-    public_subnet1_eip = client.allocate_address(Domain='vpc', 
-                                                 TagSpecifications=[{'ResourceType': 'elastic-ip', 'Tags': [{'Key': 'Name', 'Value': project + "-subnet-public1-eip"}]}])
-    public_subnet2_eip = client.allocate_address(Domain='vpc', 
-                                                 TagSpecifications=[{'ResourceType': 'elastic-ip', 'Tags': [{'Key': 'Name', 'Value': project + "-subnet-public2-eip"}]}])
-    public_subnet1_ng = client.create_nat_gateway(SubnetId=public_subnet1['Subnet']['SubnetId'], 
-                                                  AllocationId=public_subnet1_eip['AllocationId'],
-                                                  TagSpecifications=[{'ResourceType': 'natgateway', 'Tags': [{'Key': 'Name', 'Value': project + "-subnet-public1-ng"}]}])
-    logger.info(
-        f"Created NAT Gateway for Public Subnet 1 with Elastic IP '{public_subnet1_eip['PublicIp']}'. ID '{public_subnet1_ng['NatGateway']['NatGatewayId']}'")
-    emit("output",
-         f"Created NAT Gateway for Public Subnet 1 with Elastic IP '{public_subnet1_eip['PublicIp']}'. ID '{public_subnet1_ng['NatGateway']['NatGatewayId']}'")
-    public_subnet2_ng = client.create_nat_gateway(SubnetId=public_subnet2['Subnet']['SubnetId'], 
-                                                  AllocationId=public_subnet2_eip['AllocationId'],
-                                                  TagSpecifications=[{'ResourceType': 'natgateway', 'Tags': [{'Key': 'Name', 'Value': project + "-subnet-public2-ng"}]}])
-    logger.info(
-        f"Created NAT Gateway for Public Subnet 2 with Elastic IP '{public_subnet2_eip['PublicIp']}'. ID '{public_subnet2_ng['NatGateway']['NatGatewayId']}'")
-    emit("output",
-         f"Created NAT Gateway for Public Subnet 2 with Elastic IP '{public_subnet2_eip['PublicIp']}'. ID '{public_subnet2_ng['NatGateway']['NatGatewayId']}'")
-    logger.info(f"Waiting for gateways to be available...")
-    emit("output", f"Waiting for gateways to be available...")
-    waiter = client.get_waiter('nat_gateway_available')
-    waiter.wait(NatGatewayIds=[public_subnet1_ng['NatGateway']
-                ['NatGatewayId'], public_subnet2_ng['NatGateway']['NatGatewayId']])
-
-    toc = time.perf_counter()
-    logger.info(
-        f"Time took for NAT Gateways to be ready - {toc - tic:0.2f} seconds")
-    emit("output",
-         f"|⏲️|->  Time took for NAT Gateways to be ready - {toc - tic:0.2f} seconds 😱")
-
-    # Create Public Route Table
-    rtb_public = create_route_table(
-        name=project + "-rtb-public", vpc_id=vpc['Vpc']['VpcId'])
-    logger.info(
-        f"Public Route Table created. ID '{rtb_public['RouteTable']['RouteTableId']}'")
-    emit("output",
-         f"Public Route Table created. ID '{rtb_public['RouteTable']['RouteTableId']}'")
-
-    # Associate Public Subnets to Public Route Table
-    create_route(route_table=rtb_public['RouteTable']['RouteTableId'], destination="0.0.0.0/0",
-                 target=internet_gateway['InternetGateway']['InternetGatewayId'], target_type="InternetGateway")
-
-    ec2.RouteTable(rtb_public['RouteTable']['RouteTableId']).associate_with_subnet(
-        SubnetId=public_subnet1['Subnet']['SubnetId'])
-    ec2.RouteTable(rtb_public['RouteTable']['RouteTableId']).associate_with_subnet(
-        SubnetId=public_subnet2['Subnet']['SubnetId'])
-
-    # Create Private Route Table 1
-    rtb_private1 = create_route_table(
-        name=project + "-rtb-private1-" + availability_zones[0]['ZoneName'], vpc_id=vpc['Vpc']['VpcId'])
-    logger.info(
-        f"Private Route Table 1 created. ID '{rtb_private1['RouteTable']['RouteTableId']}'")
-    emit("output",
-         f"Private Route Table 1 created. ID '{rtb_private1['RouteTable']['RouteTableId']}'")
-    # Create route to NAT Gateway
-    create_route(route_table=rtb_private1['RouteTable']['RouteTableId'], destination="0.0.0.0/0",
-                 target=public_subnet1_ng['NatGateway']['NatGatewayId'], target_type="NatGateway")
-    # Link Route Table to Subnet
-    ec2.RouteTable(rtb_private1['RouteTable']['RouteTableId']).associate_with_subnet(
-        SubnetId=private_subnet1['Subnet']['SubnetId'])
-
-    # Create Private Route Table 2
-    rtb_private2 = create_route_table(
-        name=project + "-rtb-private2-" + availability_zones[1]['ZoneName'], vpc_id=vpc['Vpc']['VpcId'])
-    logger.info(
-        f"Private Route Table 2 created. ID '{rtb_private2['RouteTable']['RouteTableId']}'")
-    emit("output",
-         f"Private Route Table 2 created. ID '{rtb_private2['RouteTable']['RouteTableId']}'")
-    # Create route to NAT Gateway
-    create_route(route_table=rtb_private2['RouteTable']['RouteTableId'], destination="0.0.0.0/0",
-                 target=public_subnet2_ng['NatGateway']['NatGatewayId'], target_type="NatGateway")
-    # Link Route Table to Subnet
-    ec2.RouteTable(rtb_private2['RouteTable']['RouteTableId']).associate_with_subnet(
-        SubnetId=private_subnet2['Subnet']['SubnetId'])
-
-    client.modify_vpc_endpoint(VpcEndpointId=vpce['VpcEndpoint']['VpcEndpointId'],
-                               AddRouteTableIds=[rtb_private1['RouteTable']['RouteTableId'], rtb_private2['RouteTable']['RouteTableId']])
-    logger.info(f"Added Private Route Tables to VPC Endpoint.")
-    emit("output", f"Added Private Route Tables to VPC Endpoint.")
+    session = current_session()
+    client = get_client('ec2')
+    # Existence checks are cached for the duration of one run only
+    lookups.clear_cache()
+    # Steps completed by an earlier failed run of this project are reused once their resources are verified
+    journal = Journal(project, session.region_name)
+    if mode == 'reconcile':
+        # The live resources of the project are the starting point, not the journal
+        journal.finish()
+    elif journal.completed:
+        emit("output", f"Found the journal of an unfinished run of '{project}', verifying its resources...")
+
+    # Set EC2 properties
+    image_id, instance_type, key_pair_name_, instance_size = get_ec2_custom_template(
+        _instance_type)
+    # The templates name AMIs of one region, the same release is looked up in the others
+    image_id = images.regional_image(image_id)
+    key_pair_name = key_pair_name_ + "-" + \
+        str(time.perf_counter()).split('.')[1]
+    # Golden images (docker + service images pre-installed) are keyed on the base AMI and the bootstrap files
+    recipe = images.recipe_digest(image_id)
+
+    # Create VPC, subnets, gateways and route tables. Every step starts as soon as its inputs exist,
+    # so the key pair, security group and route tables are created while the NAT Gateways come up.
+    steps = network_steps(project, session.region_name) + [
+        Step("key_pair", lambda: create_ec2_key_pair(key_name=key_pair_name) or key_pair_name,
+             provides=["key_pair"],
+             message="Key pair '{key_pair}' ready."),
+        Step("security_group",
+             lambda private_subnet1: create_security_group(group_name=project+"-sgr",
+                                                           ip_permissions=SECURITY_GROUP_RULES,
+                                                           subnet_id=private_subnet1['Subnet']['SubnetId'],
+                                                           vpc_id=private_subnet1['Subnet']['VpcId'],
+                                                           project=project),
+             requires=["private_subnet1"], provides=["security_group"],
+             message="Security Group ready. ID '{security_group}'"),
+        Step("golden_image", lambda: images.find_golden_image(recipe), provides=["golden_image"]),
+    ]
+    plan = None
+    if mode == 'create':
+        context, steps = journal.resume(steps, checks={
+            "key_pair": lambda outputs: lookups.find_key_pair(outputs["key_pair"]) != None and os.path.isfile(_pem_path(outputs["key_pair"]))})
+        if context:
+            emit("output", f"Resuming: {len(context)} value(s) of the previous run reused, {len(steps)} step(s) left.")
+        elif warm_pool.POOL_SIZE > 0:
+            # A ready network of the warm pool becomes this project's, its steps are journaled as done
+            leased = warm_pool.lease(project)
+            if leased != None:
+                pool_plan = Plan(leased)
+                adopt_network(pool_plan, project, session.region_name)
+                context, steps = pool_plan.reuse(steps)
+                remaining = {step.name for step in steps}
+                for name, outputs in pool_plan.adopted.items():
+                    if name not in remaining:
+                        journal.record(name, outputs)
+                emit("output", f"Leased a network from the warm pool. VPC '{leased['vpcs'][0]['VpcId']}'")
+            else:
+                emit("output", "The warm pool is empty, building the network.")
+            warm_pool.refill_in_background(network_steps)
+    else:
+        emit("output", f"Comparing the stack with the live resources of project '{project}'...")
+        plan = Plan(inventory.project_index(project).get(STACK_KINDS))
+        adopt_network(plan, project, session.region_name)
+        context, steps = plan.reuse(steps, updates=CHANGE_STEPS, ignored=READ_STEPS)
+        # Steps updating a resource in place keep its ID, the instances using it can be kept too
+        known = dict(context)
+        for outputs in plan.modified.values():
+            known.update(outputs)
+        if {"private_subnet1", "public_subnet1", "security_group", "key_pair"} <= set(known):
+            adopt_instances(plan, instance_specs(project, multiple_vms, known['private_subnet1']['Subnet']['SubnetId'],
+                                                 known['public_subnet1']['Subnet']['SubnetId'], known['security_group']),
+                            instance_type, known['key_pair'], bootstrap)
+        else:
+            plan.add_instances([spec['instance_name'] for spec in instance_specs(project, multiple_vms, None, None, None)])
+        temp_elastic_ip = plan.find('addresses', project + "-temp-eip")
+        if temp_elastic_ip != None:
+            plan.keep.add(temp_elastic_ip['AllocationId'])
+        # A golden image bake running in the project's subnet is left to finish, it terminates its instance itself
+        for instance in plan.live.get('instances', []):
+            if inventory.tags(instance).get('Name', '').startswith(images.IMAGE_PREFIX + "-"):
+                plan.keep.add(instance['InstanceId'])
+        plan.compute_deletes()
+
+        emit("output", plan.summary())
+        for line in plan.lines():
+            emit("output", line)
+        logger.info(plan.summary() + "".join("\n" + line for line in plan.lines()))
+        # A plan leaves everything as it is, the journal of an unfinished create included
+        if mode == 'plan':
+            return {'plan': plan.summary(), 'changes': plan.lines()}
+        if temp_elastic_ip != None:
+            journal.record('temp_eip', {'temp_eip': temp_elastic_ip})
+        if plan.delete:
+            tracing.phase("delete")
+            emit("output", "Deleting the resources that are not part of the stack...")
+            run_steps(plan.delete_steps(), max_workers=16, cancel=cancel)
+            tracing.phase("network")
+    network = run_steps(steps, context=context, on_complete=_journaled(journal), cancel=cancel)
     ##
     # DONE VPC -> ID: vpc['Vpc']['VpcId']
     ##
@@ -190,200 +538,139 @@ def run(multiple_vms, _instance_type, project='dev-ops-tools-pack'):
     ##
 
     # Reduce variables...
-    vpc_id = vpc['Vpc']['VpcId']
-    private_subnet1_id = private_subnet1['Subnet']['SubnetId']
-    private_subnet2_id = private_subnet2['Subnet']['SubnetId']
-    public_subnet1_id = public_subnet1['Subnet']['SubnetId']
-    public_subnet2_id = public_subnet2['Subnet']['SubnetId']
-
-    # Set EC2 properties
-    image_id, instance_type, key_pair_name_, instance_size = get_ec2_custom_template(
-        _instance_type)
-    # print(f"Image ID: {image_id}\nInstance type: {instance_type}\nKey pair name: {key_pair_name}")
-    key_pair_name = key_pair_name_ + "-" + \
-        str(time.perf_counter()).split('.')[1]
-    create_ec2_key_pair(key_name=key_pair_name)
-
-    private_subnet1_sgr = create_security_group(group_name=project+"-sgr",
-                                                ip_permissions="0.0.0.0/0:22,0.0.0.0/0:3000,0.0.0.0/0:8080,0.0.0.0/0:8081",
-                                                subnet_id=private_subnet1_id)
+    vpc_id = network['vpc']['Vpc']['VpcId']
+    private_subnet1_id = network['private_subnet1']['Subnet']['SubnetId']
+    public_subnet1_id = network['public_subnet1']['Subnet']['SubnetId']
+    private_subnet1_sgr = network['security_group']
+    key_pair_name = network['key_pair']
+
+    # Launch from the golden image when there is one, otherwise bake it in the background for the next deploy
+    golden_image = network['golden_image']
+    if golden_image != None:
+        image_id = golden_image['ImageId']
+        logger.info(f"Using golden image '{golden_image['Name']}'. ID '{image_id}'")
+        emit("output", f"Using golden image '{golden_image['Name']}', docker install is skipped.")
+    else:
+        images.bake_in_background(recipe, image_id, instance_type, private_subnet1_id, private_subnet1_sgr, project)
+        emit("output", f"No golden image for this recipe yet, baking one in the background for the next deploy.")
+
+    _check_cancel(cancel)
     # Create EC2 instances
     emit("output", f"Provisioning EC2 instances...")
-    tic = time.perf_counter()
-    ec2_jenkins_privdns = ec2_gitea_privdns = ec2_artifactory_privdns = None
-
-    ec2_jenkins = create_ec2_instance(session.region_name, image_id, instance_type, key_pair_name,
-                                      instance_size, private_subnet1_id, private_subnet1_sgr, instance_name="dot_jenkins")
-    ec2_jenkins_privdns = client.describe_instances(InstanceIds=[ec2_jenkins.id])[
-        'Reservations'][0]['Instances'][0]['PrivateDnsName']
-
-    if multiple_vms == True:
-        ec2_gitea = create_ec2_instance(session.region_name, image_id, instance_type,
-                                        key_pair_name, instance_size, private_subnet1_id, instance_name="dot_gitea")
-        ec2_gitea_privdns = client.describe_instances(InstanceIds=[ec2_gitea.id])[
-            'Reservations'][0]['Instances'][0]['PrivateDnsName']
-        ec2_artifactory = create_ec2_instance(session.region_name, image_id, instance_type,
-                                              key_pair_name, instance_size, private_subnet1_id, instance_name="dot_artifactory")
-        ec2_artifactory_privdns = client.describe_instances(InstanceIds=[ec2_artifactory.id])[
-            'Reservations'][0]['Instances'][0]['PrivateDnsName']
-
-    ec2_nginx = create_ec2_instance(session.region_name, image_id, instance_type, key_pair_name,
-                                    instance_size, public_subnet1_id, private_subnet1_sgr, instance_name="dot_nginx")
-
-    if ec2_gitea_privdns == None:
-        ec2_gitea_privdns = ec2_jenkins_privdns
-    if ec2_artifactory_privdns == None:
-        ec2_artifactory_privdns = ec2_jenkins_privdns
+    tracing.phase("instances", image_id=image_id, golden=golden_image != None)
+    # Launch every VM in one batch: jenkins (+ gitea and artifactory) in the private subnet, nginx in the public one
+    specs = instance_specs(project, multiple_vms, private_subnet1_id, public_subnet1_id, private_subnet1_sgr)
+
+    # Instances of the previous run (all of them, with the same layout) or of the live stack (reconcile) are kept
+    existing = {}
+    journaled = journal.completed.get('instances')
+    if plan != None:
+        existing = plan.instances
+    elif (journaled != None and journaled['bootstrap'] == bootstrap
+          and set(journaled['instances']) == {spec['instance_name'] for spec in specs}
+          and journal.exists(journaled['instances'])):
+        existing = journaled['instances']
+    if existing:
+        emit("output", f"Reusing EC2 instance(s) {', '.join(existing)}.")
+    missing = [spec for spec in specs if spec['instance_name'] not in existing]
+
+    launched = {}
+    if bootstrap == 'cloud-init' and missing:
+        # Backends first: their private DNS names are known as soon as they are launched and go into the nginx config
+        bundle = build_bundle("./resources")
+        backend_specs = missing[:-1]
+        roles = {"dot_jenkins": ['jenkins'] if multiple_vms == True else ['jenkins', 'gitea', 'artifactory'],
+                 "dot_gitea": ['gitea'], "dot_artifactory": ['artifactory']}
+        for spec in backend_specs:
+            spec['user_data'] = render_user_data(roles[spec['instance_name']], bundle, {},
+                                                 docker_installed=golden_image != None)
+        launched = launch_ec2_instances(session.region_name, image_id, instance_type, key_pair_name,
+                                        instance_size, backend_specs)
+        backends = {role: launched[name]['PrivateDnsName'] for name in launched for role in roles[name]}
+        missing[-1]['user_data'] = render_user_data(['nginx'], bundle, backends,
+                                                    docker_installed=golden_image != None)
+        launched.update(launch_ec2_instances(session.region_name, image_id, instance_type, key_pair_name,
+                                             instance_size, missing[-1:]))
+    elif missing:
+        launched = launch_ec2_instances(session.region_name, image_id, instance_type, key_pair_name,
+                                        instance_size, missing)
+    instances = wait_ec2_instances({spec['instance_name']: existing.get(spec['instance_name']) or launched[spec['instance_name']]
+                                    for spec in specs})
+    instances_reused = not launched
+    if launched:
+        journal.record('instances', {'instances': instances, 'bootstrap': bootstrap})
+    ec2_nginx_id = instances["dot_nginx"]['InstanceId']
+    ec2_jenkins_privdns = instances["dot_jenkins"]['PrivateDnsName']
+    ec2_gitea_privdns = instances.get("dot_gitea", instances["dot_jenkins"])['PrivateDnsName']
+    ec2_artifactory_privdns = instances.get("dot_artifactory", instances["dot_jenkins"])['PrivateDnsName']
 
     logger.info(f"Listing EC2 instances in vpc '{vpc_id}':")
     emit("output", f"Listing EC2 instances in vpc '{vpc_id}':")
-    for instance in client.describe_instances(Filters=[{'Name': 'vpc-id', 'Values': [vpc_id]}])['Reservations']:
-        for tag in instance['Instances'][0]['Tags']:
-            if tag['Key'] == 'Name':
-                logger.info(
-                    f"  - Instance Name: {tag['Value']}, ID: {instance['Instances'][0]['InstanceId']}, State: {instance['Instances'][0]['State']['Name']}, Type: {instance['Instances'][0]['InstanceType']}")
-                emit(
-                    "output", f"  - Instance Name: {tag['Value']}, ID: {instance['Instances'][0]['InstanceId']}, State: {instance['Instances'][0]['State']['Name']}, Type: {instance['Instances'][0]['InstanceType']}")
-
-    toc = time.perf_counter()
-    logger.info(
-        f"Time took for provisioning EC2 instances - {toc - tic:0.2f} seconds")
-    emit("output",
-         f"|⏲️|-> Time took for provisioning EC2 instances - {toc - tic:0.2f} seconds 😱")
+    result = {'vpc_id': vpc_id, 'instances': {name: instance['InstanceId'] for name, instance in instances.items()}}
+    for name, instance in instances.items():
+        logger.info(
+            f"  - Instance Name: {name}, ID: {instance['InstanceId']}, State: {instance['State']['Name']}, Type: {instance['InstanceType']}")
+        emit(
+            "output", f"  - Instance Name: {name}, ID: {instance['InstanceId']}, State: {instance['State']['Name']}, Type: {instance['InstanceType']}")
 
+    _check_cancel(cancel)
+    tracing.phase("services")
     # Connect SSH to a temporary Elastic IP Allocated to EC2 NGinx
-    ec2_ssh_key = paramiko.RSAKey.from_private_key_file(
-        os.path.expanduser('~') + "/shadow/" + key_pair_name + ".pem")
-    ssh_client = paramiko.SSHClient()
-    ssh_client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    ec2_ssh_key = paramiko.RSAKey.from_private_key_file(_pem_path(key_pair_name))
 
     try:
-        temp_elastic_ip = client.allocate_address(Domain='vpc', TagSpecifications=[
-                                                  {'ResourceType': 'elastic-ip', 'Tags': [{'Key': 'Name', 'Value': project + "-temp-eip"}]}])
-        client.associate_address(
-            AllocationId=temp_elastic_ip['AllocationId'], InstanceId=ec2_nginx.id)
+        temp_elastic_ip = journal.completed.get('temp_eip', {}).get('temp_eip')
+        # A live address (reconcile) tells where it is associated, a journaled one went to the same nginx instance
+        associated = "dot_nginx" not in launched and temp_elastic_ip != None and \
+            temp_elastic_ip.get('InstanceId', ec2_nginx_id) == ec2_nginx_id
+        if temp_elastic_ip == None or (plan == None and not journal.exists(temp_elastic_ip)):
+            temp_elastic_ip = client.allocate_address(Domain='vpc', TagSpecifications=[
+                                                      {'ResourceType': 'elastic-ip', 'Tags': [{'Key': 'Name', 'Value': project + "-temp-eip"},
+                                                                                              {'Key': 'Project', 'Value': project}]}])
+            journal.record('temp_eip', {'temp_eip': temp_elastic_ip})
+            associated = False
+        if not associated:
+            client.associate_address(
+                AllocationId=temp_elastic_ip['AllocationId'], InstanceId=ec2_nginx_id, AllowReassociation=True)
     except botocore.exceptions.ClientError as e:
         emit("output", "Error encountered. Please check the application logs.")
         logger.error(e)
+        # No address to reach nginx through, the run fails here and `resume` picks it up
+        raise
 
+    # One SSH session per host for the whole run; private hosts are reached through the nginx host
+    sessions = SessionManager(temp_elastic_ip['PublicIp'], "ubuntu", ec2_ssh_key)
     try:
-        # Connect ssh to EC2 instance using temporary elastic IP
-        wait_for_port(port=22, host=temp_elastic_ip['PublicIp'], timeout=30)
-        emit("output", "Connect SSH to public VM.")
-        ssh_client.connect(
-            hostname=temp_elastic_ip['PublicIp'], username="ubuntu", pkey=ec2_ssh_key, timeout=5)
-
-        # Copy Install Scripts
-        sftp = ssh_client.open_sftp()
-
-        # Create subdir
-        sftp.mkdir("./resources")
-        for root, dirs, files in os.walk("./resources", topdown=True):
-            for name in dirs:
-                sftp.mkdir(os.path.join(root, name))
-            for name in files:
-                sftp.put(os.path.join(root, name), os.path.join(root, name))
-
-        logger.info("Copy ssh-key to EC2 instance.")
-        emit("output", "Copy ssh-key to EC2 instance.")
-        # Copy ssh-key for further ssh-ing :)
-        sftp.mkdir("./shadow")
-        sftp.put("./shadow/" + key_pair_name + ".pem",
-                 "./shadow/" + key_pair_name + ".pem")
-        sftp.close()
-        ssh_client.exec_command("chmod 400 ./shadow/" + key_pair_name + ".pem")
-
-        # Copy resources to other EC2 instances
-        logger.info("Copy resources to all EC2 instances...")
-        emit("output", "Copy resources to all EC2 instances...")
-
-        stdin, stdout, stderr = ssh_client.exec_command("scp -q -r -i ./shadow/" + key_pair_name + ".pem -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "./resources/ ubuntu@" + ec2_jenkins_privdns + ":~")
-        exit_status = stdout.channel.recv_exit_status()
-
-        if ec2_gitea_privdns != ec2_jenkins_privdns:
-            stdin, stdout, stderr = ssh_client.exec_command("scp -q -r -i ./shadow/" + key_pair_name + ".pem -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                            "./resources/ ubuntu@" + ec2_gitea_privdns + ":~")
-            exit_status = stdout.channel.recv_exit_status()
-
-        if ec2_artifactory_privdns != ec2_jenkins_privdns:
-            stdin, stdout, stderr = ssh_client.exec_command("scp -q -r -i ./shadow/" + key_pair_name + ".pem -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                            "./resources/ ubuntu@" + ec2_artifactory_privdns + ":~")
-            exit_status = stdout.channel.recv_exit_status()
-
-        logger.info("Installing docker...")
-        emit("output", "Installing docker...")
-        stdin, stdout, stderr = ssh_client.exec_command(
-            "sudo /bin/bash ./resources/ubuntu/docker_install.sh")
-        exit_status = stdout.channel.recv_exit_status()
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_jenkins_privdns + " sudo /bin/bash ./resources/ubuntu/docker_install.sh")
-        exit_status = stdout.channel.recv_exit_status()
-
-        if ec2_gitea_privdns != ec2_jenkins_privdns:
-            stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                            "ubuntu@" + ec2_gitea_privdns + " sudo /bin/bash ./resources/ubuntu/docker_install.sh")
-            exit_status = stdout.channel.recv_exit_status()
-        if ec2_artifactory_privdns != ec2_jenkins_privdns:
-            stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                            "ubuntu@" + ec2_artifactory_privdns + " sudo /bin/bash ./resources/ubuntu/docker_install.sh")
-            exit_status = stdout.channel.recv_exit_status()
-
-        # Reconnect to host to use 'docker-compose'
-        logger.info("Reconnecting to host...")
-        emit("output", "Reconnecting to host...")
-        ssh_client.close()
-        ssh_client.connect(
-            hostname=temp_elastic_ip['PublicIp'], username="ubuntu", pkey=ec2_ssh_key, timeout=5)
-
-        logger.info("Installing NGinx")
-        emit("output", "Installing NGinx")
-        stdin, stdout, stderr = ssh_client.exec_command("/bin/bash ./resources/nginx/config.sh " +
-                                                        "--jenkins_addr " + ec2_jenkins_privdns + ":8080 " +
-                                                        "--gitea_addr " + ec2_gitea_privdns + ":3000 " +
-                                                        "--artifactory_addr " + ec2_artifactory_privdns + ":8081")
-        exit_status = stdout.channel.recv_exit_status()
-        stdin, stdout, stderr = ssh_client.exec_command(
-            "docker-compose -f resources/nginx/docker-compose.yaml up -d")
-        exit_status = stdout.channel.recv_exit_status()
-
-        logger.info("Installing Jenkins")
-        emit("output", "Installing Jenkins")
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_jenkins_privdns + " sudo /bin/bash ./resources/jenkins/install.sh")
-        exit_status = stdout.channel.recv_exit_status()
-
-        logger.info("Installing Gitea")
-        emit("output", "Installing Gitea")
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_gitea_privdns + " docker-compose -f ./resources/gitea/docker-compose.yaml up -d")
-        exit_status = stdout.channel.recv_exit_status()
-
-        gitea_pwd = ''.join(secrets.choice(
-            string.ascii_uppercase + string.ascii_lowercase) for _ in range(16))
-
-        time.sleep(5)
-        # Wait for Gitea (port 3000) is up
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_gitea_privdns + " while ! curl --output /dev/null --silent --head --fail http://"+ec2_gitea_privdns+":3000; do sleep 1; done;")
-        exit_status = stdout.channel.recv_exit_status()
-
-        # Create default Gitea 'root' user with random password.
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_gitea_privdns + " docker exec -u 1000 gitea gitea admin user create --admin --username root --password " + gitea_pwd + " --email admin@localhost.com")
-        logger.info(stdout.read().decode())
-
-        logger.info("Installing Artifactory")
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" +key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null ubuntu@"+ ec2_artifactory_privdns +" docker-compose -f ./resources/artifactory/docker-compose.yaml up -d")
-        exit_status = stdout.channel.recv_exit_status()
-
-        time.sleep(5)
-        stdin, stdout, stderr = ssh_client.exec_command("ssh -i ./shadow/" + key_pair_name + ".pem -q -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null " +
-                                                        "ubuntu@" + ec2_jenkins_privdns + " docker exec jenkins cat /var/jenkins_home/secrets/initialAdminPassword")
-        jenkins_initial_password = stdout.read().decode()
-
-        # close the client connection once the job is done
-        ssh_client.close()
+        jenkins_initial_password = gitea_pwd = None
+        if plan != None and instances_reused:
+            # Reconcile kept every instance, the services on them are up already
+            emit("output", "No instance was replaced, the services are left as they are.")
+        else:
+            # Connect ssh to EC2 instance using temporary elastic IP
+            wait_for_port(port=22, host=temp_elastic_ip['PublicIp'], timeout=30)
+            emit("output", "Connect SSH to public VM.")
+            sessions.client()
+
+            # Copy resources, install docker and bring the services up on every host at once,
+            # each service starts as soon as docker is ready on its own host (or wait for cloud-init to do it)
+            if bootstrap == 'cloud-init':
+                logger.info("Waiting for all EC2 instances to bootstrap...")
+                emit("output", "Waiting for all EC2 instances to bootstrap...")
+            else:
+                logger.info("Installing docker and services on all EC2 instances...")
+                emit("output", "Installing docker and services on all EC2 instances...")
+            hosts = {'nginx': None, 'jenkins': ec2_jenkins_privdns,
+                     'gitea': ec2_gitea_privdns, 'artifactory': ec2_artifactory_privdns}
+            steps = service_steps(sessions, hosts, docker_installed=golden_image != None,
+                                  bootstrapped=bootstrap == 'cloud-init')
+            # Remote steps already done are only skipped on the very same hosts
+            context, steps = journal.resume(steps, rerun=() if instances_reused else [step.name for step in steps])
+            services = run_steps(steps, context=context, on_complete=_journaled(journal), cancel=cancel)
+            jenkins_initial_password = services["jenkins_password"]
+            gitea_pwd = services["gitea_pwd"]
+
+        # close the client connections once the job is done
+        sessions.close()
         # client.release_address(AllocationId=temp_elastic_ip['AllocationId'])
 
         logger.info(
@@ -392,8 +679,9 @@ def run(multiple_vms, _instance_type, project='dev-ops-tools-pack'):
             f"You can access Gitea       at : 'https://{temp_elastic_ip['PublicIp']}/gitea'")
         logger.info(
             f"You can access Artifactory at : 'https://{temp_elastic_ip['PublicIp']}/artifactory'")
-        logger.info(f"Jenkins initial password '{jenkins_initial_password}'")
-        logger.info(f"Gitea initial user 'root' and password '{gitea_pwd}'.")
+        if jenkins_initial_password != None:
+            logger.info(f"Jenkins initial password '{jenkins_initial_password}'")
+            logger.info(f"Gitea initial user 'root' and password '{gitea_pwd}'.")
 
         emit(
             "output", f"You can access Jenkins     at : 'https://{temp_elastic_ip['PublicIp']}/jenkins'")
@@ -401,21 +689,27 @@ def run(multiple_vms, _instance_type, project='dev-ops-tools-pack'):
             "output", f"You can access Gitea       at : 'https://{temp_elastic_ip['PublicIp']}/gitea'")
         emit(
             "output", f"You can access Artifactory at : 'https://{temp_elastic_ip['PublicIp']}/artifactory'")
-        emit(
-            "output", f"Jenkins initial password '{jenkins_initial_password}'")
-        emit(
-            "output", f"Gitea initial user 'root' and password '{gitea_pwd}'.")
-
-        toc = time.perf_counter()
-        logger.info(f"Total time took - {toc - full_tic:0.2f} seconds")
-        emit(
-            "output", f"|⏲️|-> Total time took - {toc - full_tic:0.2f} seconds")
-
+        if jenkins_initial_password != None:
+            emit(
+                "output", f"Jenkins initial password '{jenkins_initial_password}'")
+            emit(
+                "output", f"Gitea initial user 'root' and password '{gitea_pwd}'.")
+
+        result['url'] = f"https://{temp_elastic_ip['PublicIp']}"
+        rate_limiter.log_stats()
+        emit("output", f"Time spent waiting on the AWS API rate limiter - {rate_limiter.total_wait_seconds():0.2f} seconds")
+        journal.finish()
+
+    except Cancelled:
+        sessions.close()
+        raise
     except Exception as e:
-        ssh_client.close()
+        sessions.close()
         emit("output", "Error encountered. Please check logs.")
+        emit("output", f"Completed steps are kept in '{journal.path}', run '{project}' again to resume from there.")
         logger.error(e)
-    return
+        result['error'] = str(e)
+    return result
 
 
 def test_run(project, aws_access_key_id, aws_secret_access_key, region, multiple_vms):
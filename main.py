@@ -1,54 +1,232 @@
-from flask import Flask, render_template
+import os
+
+import boto3
+import botocore
+from flask import Flask, Response, render_template, request
 from flask_socketio import SocketIO, emit
 
-from create_dotp import run, test_run
+from create_dotp import MODES, run, test_run
 from utils.functions_login import *
+from utils.aws_clients import use_session
+from utils.jobs import JobManager
+from utils import inventory, metrics
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'secret!'
 socketio = SocketIO(app)
 
+# Provisioning runs in the background, DOTP_JOB_WORKERS runs at the same time, the rest are queued
+jobs = JobManager(max_workers=int(os.environ.get('DOTP_JOB_WORKERS', 2)), emit=socketio.emit)
+
+
+def job_metrics():
+    counts = {'queued': 0, 'running': 0, 'succeeded': 0, 'failed': 0, 'cancelled': 0}
+    for job in jobs.jobs():
+        counts[job.status] = counts.get(job.status, 0) + 1
+    return [('dotp_jobs', 'gauge', "Provisioning jobs by status.",
+             [({'status': status}, count) for status, count in counts.items()])]
+
+
+metrics.register_collector(job_metrics)
+
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
 
-@socketio.on('run_script')
-def handle_run_script(script_params):
-    # Run the Python script and emit the output to the client as it is generated
-    # Use the emit function to send the output to the client
-    # The 'output' event name can be customized
+@app.route('/metrics')
+def prometheus_metrics():
+    # Prometheus text format: AWS API calls / latency / retries / errors and the job queue
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+def provision(job, session, script_params):
+    with use_session(session):
+        result = run(multiple_vms = script_params["multiple_vm"], project=script_params["project"], _instance_type=script_params["instance_type"],
+                     cancel=job.cancel_event, bootstrap=script_params["bootstrap"], mode=script_params["mode"])
+    # run() reports a failure of the services in the stack it returns, the job fails with it
+    if result != None and result.get('error') != None:
+        job.result = result
+        raise RuntimeError(result['error'])
+    return result
 
-    if script_params["project"] == '':
+
+def validate_stack(script_params):
+    """
+    Fill in the defaults of one stack request (project, region, bootstrap, mode) and check it.
+    Returns the error message, None when the request is valid.
+    """
+    if script_params.get("project", '') == '':
         emit('output', 'Using default project name "dev-ops-tools-pack"')
         script_params["project"] = "dev-ops-tools-pack"
 
-    if script_params["region"] == '':
+    if script_params.get("region", '') == '':
         emit('output', 'Using default region "eu-central-1"')
         script_params["region"] = "eu-central-1"
-    
+
+    # 'ssh' installs the services over SSH, 'cloud-init' lets every instance install its own at boot
+    script_params["bootstrap"] = script_params.get("bootstrap") or os.environ.get('DOTP_BOOTSTRAP', 'ssh')
+    if script_params["bootstrap"] not in ('ssh', 'cloud-init'):
+        return f"Unknown bootstrap mode '{script_params['bootstrap']}'!"
+
+    # 'create' builds a new stack, 'plan' shows what 'reconcile' would change on the live one, 'reconcile' applies it
+    script_params["mode"] = script_params.get("mode") or os.environ.get('DOTP_MODE', 'create')
+    if script_params["mode"] not in MODES:
+        return f"Unknown mode '{script_params['mode']}'!"
+
+    if script_params.get("aws_access_key_id", '') == '' or script_params.get("aws_secret_access_key", '') == '':
+        return "AWS Secret Key ID or AWS Secret Access Key is missing!"
+    return None
+
+
+@socketio.on('run_script')
+def handle_run_script(script_params):
+    # Validate the request and login here, then hand the provisioning over to a background job
+    # The job emits 'output' and 'job_status' events to this client only
+
     if script_params["multiple_vm"] == True:
         emit('output', f'You have opted for multiple virtual machines')
     else:
         emit('output', f'You have opted for single virtual machine')
-    
-    if script_params["aws_access_key_id"] == '' or script_params["aws_secret_access_key"] == '':
-        emit('output', "[error] AWS Secret Key ID or AWS Secret Access Key is missing!")
-        return
-    
-    login(aws_access_key_id=script_params["aws_access_key_id"], 
-          aws_secret_access_key=script_params["aws_secret_access_key"], 
-          region=script_params["region"])
-    
-    # test_run(project=script_params["project"], 
-    #                             aws_access_key_id=script_params["aws_access_key_id"], 
-    #                             aws_secret_access_key=script_params["aws_secret_access_key"], 
+
+    error = validate_stack(script_params)
+    if error != None:
+        emit('output', f"[error] {error}")
+        return
+
+    try:
+        session = login(aws_access_key_id=script_params["aws_access_key_id"],
+                        aws_secret_access_key=script_params["aws_secret_access_key"],
+                        region=script_params["region"], sid=request.sid)
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+        return
+
+    # test_run(project=script_params["project"],
+    #                             aws_access_key_id=script_params["aws_access_key_id"],
+    #                             aws_secret_access_key=script_params["aws_secret_access_key"],
     ##                             region=script_params["region"],
     #                             multiple_vms = script_params["multiple_vm"])
-    
-    run(multiple_vms = script_params["multiple_vm"], project=script_params["project"], _instance_type=script_params["instance_type"])
 
+    # The session is taken now, so a later login can't change the credentials of this run
+    job = jobs.submit(request.sid, script_params["project"], provision,
+                      session=session, script_params=script_params)
+    emit('output', f"Job '{job.id}' queued.")
+    return job.id
+
+
+@socketio.on('run_batch')
+def handle_run_batch(batch_params):
+    # Several stacks at once: {"stacks": [{project, region, instance_type, multiple_vm, bootstrap, mode}, ...]}
+    # plus the credentials, per stack or once for the whole batch. Every stack is a job with a session of its own
+    # (nothing is written to ~/.aws), they share the DOTP_JOB_WORKERS cap with every other job.
+    # 'batch_status' events report every stack of the batch to this client.
+    stacks = batch_params.get("stacks") or []
+    if not stacks:
+        emit('output', "[error] The batch has no stacks!")
+        return
+
+    items, sessions = [], {}
+    for number, stack in enumerate(stacks, 1):
+        stack = {**{key: batch_params.get(key, '') for key in ('aws_access_key_id', 'aws_secret_access_key', 'region')},
+                 "multiple_vm": False, **stack}
+        error = validate_stack(stack)
+        if error != None:
+            emit('output', f"[error] Stack {number}: {error}")
+            return
+        # Two runs of a project in one region would share its journal and resources
+        if any(item[2]['script_params']["project"] == stack["project"] and item[2]['script_params']["region"] == stack["region"]
+               for item in items):
+            emit('output', f"[error] Stack {number}: project '{stack['project']}' is in region '{stack['region']}' twice!")
+            return
+
+        credentials = (stack["aws_access_key_id"], stack["aws_secret_access_key"], stack["region"])
+        if credentials not in sessions:
+            session = boto3.Session(aws_access_key_id=stack["aws_access_key_id"],
+                                    aws_secret_access_key=stack["aws_secret_access_key"], region_name=stack["region"])
+            try:
+                credential_store.identity(session)
+            except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
+                emit('output', f"[error] Stack {number}: login failed in region '{stack['region']}', please check credentials!")
+                return
+            sessions[credentials] = session
+        items.append((f"{stack['project']} ({stack['region']})", provision,
+                      {'session': sessions[credentials], 'script_params': stack}))
+
+    batch = jobs.submit_batch(request.sid, items)
+    emit('output', f"Batch '{batch.id}' queued: {len(items)} stack(s), {jobs.max_workers} at a time.")
+    return batch.id
+
+
+@socketio.on('batch_status')
+def handle_batch_status(batch_id):
+    batch = jobs.get_batch(batch_id)
+    if batch == None or batch.sid != request.sid:
+        emit('output', f"[error] Batch '{batch_id}' not found!")
+        return
+    emit('batch_status', batch.to_dict())
+
+
+@socketio.on('cancel_batch')
+def handle_cancel_batch(batch_id):
+    batch = jobs.get_batch(batch_id)
+    if batch == None or batch.sid != request.sid:
+        emit('output', f"[error] Batch '{batch_id}' not found!")
+        return
+    for job in batch.jobs:
+        jobs.cancel(job.id)
+    emit('output', f"Cancelling batch '{batch_id}'...")
+
+
+@socketio.on('cancel_job')
+def handle_cancel_job(job_id):
+    job = jobs.get(job_id)
+    if job == None or job.sid != request.sid:
+        emit('output', f"[error] Job '{job_id}' not found!")
+        return
+    jobs.cancel(job_id)
+    emit('output', f"Cancelling job '{job_id}'...")
+
+
+@socketio.on('job_status')
+def handle_job_status(job_id=None):
+    if job_id == None:
+        emit('job_list', [job.to_dict() for job in jobs.jobs(request.sid)])
+        return
+    job = jobs.get(job_id)
+    if job == None or job.sid != request.sid:
+        emit('output', f"[error] Job '{job_id}' not found!")
+        return
+    emit('job_status', job.to_dict())
+
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    # The credentials of a client live as long as its connection, its running jobs keep their session
+    credential_store.forget(request.sid)
+
+
+@socketio.on('project_status')
+def handle_project_status(params):
+    # Resources of a project from its inventory index, described again only past DOTP_INVENTORY_TTL or with 'refresh'
+    project = params.get("project") or "dev-ops-tools-pack"
+    session = credential_store.session(request.sid)
+    if session == None:
+        emit('output', "[error] Please log in first!")
+        return
+    try:
+        with use_session(session):
+            live = inventory.project_index(project).get(max_age=0 if params.get("refresh") else None)
+    except Exception as e:
+        emit('output', f"[error] Can't list the resources of project '{project}': {e}")
+        return
+    emit('project_status', {
+        'project': project,
+        'resources': {kind: len(resources) for kind, resources in live.items()},
+        'instances': [{'name': inventory.tags(instance).get('Name'), 'instance_id': instance['InstanceId'],
+                       'state': instance['State']['Name'], 'type': instance['InstanceType']}
+                      for instance in live['instances']],
+    })
 
 
 if __name__ == '__main__':
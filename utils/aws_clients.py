@@ -0,0 +1,135 @@
+import contextvars
+import hashlib
+import logging
+import threading
+from contextlib import contextmanager
+import boto3
+from botocore.config import Config
+from utils import metrics, rate_limiter, tracing
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Connection pool / retry settings used by every client built here.
+# Steps run concurrently, so the pool must be at least as large as the number of parallel calls.
+MAX_POOL_CONNECTIONS = 50
+RETRY_MODE = 'standard'
+MAX_ATTEMPTS = 5
+
+_lock = threading.Lock()
+# (credentials digest, region, service) -> client, the secret key itself is only held by the sessions
+_clients = {}
+_default_session = None
+_current_session = contextvars.ContextVar('aws_session', default=None)
+# Callables hook(client, account) run on every new client, e.g. to register botocore event handlers
+_client_hooks = [rate_limiter.install, tracing.install, metrics.install]
+
+
+def configure(max_pool_connections=None, retry_mode=None, max_attempts=None):
+    """
+    Change the client settings. Clients already built are dropped so the next call picks up the new config.
+    retry_mode - 'legacy', 'standard' or 'adaptive'
+    """
+    global MAX_POOL_CONNECTIONS, RETRY_MODE, MAX_ATTEMPTS
+    with _lock:
+        if max_pool_connections != None:
+            MAX_POOL_CONNECTIONS = max_pool_connections
+        if retry_mode != None:
+            RETRY_MODE = retry_mode
+        if max_attempts != None:
+            MAX_ATTEMPTS = max_attempts
+        _clients.clear()
+
+
+def reset():
+    """
+    Forget the default session and every cached client, e.g. after ~/.aws has been rewritten.
+    """
+    global _default_session
+    with _lock:
+        _default_session = None
+        _clients.clear()
+
+
+def register_client_hook(hook):
+    """
+    Call hook(client, account) for every client created from now on. `account` is the access key of its credentials.
+    """
+    with _lock:
+        _client_hooks.append(hook)
+
+
+def client_config():
+    return Config(max_pool_connections=MAX_POOL_CONNECTIONS,
+                  retries={'mode': RETRY_MODE, 'max_attempts': MAX_ATTEMPTS})
+
+
+def current_session():
+    """
+    Session used by the helpers: the one set with `use_session`, otherwise the process default session
+    (config from ~/.aws/config , ~/.aws/credentials).
+    """
+    global _default_session
+    session = _current_session.get()
+    if session != None:
+        return session
+    with _lock:
+        if _default_session == None:
+            _default_session = boto3.Session()
+        return _default_session
+
+
+@contextmanager
+def use_session(session):
+    """
+    Run the enclosed block (and the steps it starts through utils.engine) with `session`.
+    """
+    token = _current_session.set(session)
+    try:
+        yield session
+    finally:
+        _current_session.reset(token)
+
+
+def credentials_digest(access_key, secret_key):
+    return hashlib.sha256(f"{access_key}:{secret_key}".encode()).hexdigest()
+
+
+def _credentials(session):
+    # access key and digest of the credentials of `session`, (None, None) without credentials
+    credentials = session.get_credentials()
+    if credentials == None:
+        return None, None
+    credentials = credentials.get_frozen_credentials()
+    return credentials.access_key, credentials_digest(credentials.access_key, credentials.secret_key)
+
+
+def get_client(service, region_name=None):
+    """
+    Shared, thread-safe boto3 client for `service`, cached per credentials, region and service.
+    """
+    session = current_session()
+    region_name = region_name or session.region_name
+    account, digest = _credentials(session)
+    key = (digest, region_name, service)
+    with _lock:
+        client = _clients.get(key)
+        if client == None:
+            logger.debug(f"Creating '{service}' client for region '{region_name}'")
+            client = session.client(service, region_name=region_name, config=client_config())
+            for hook in _client_hooks:
+                hook(client, account)
+            _clients[key] = client
+    return client
+
+
+def forget(session):
+    """
+    Drop the clients built for the credentials of `session`, in every region, e.g. once nobody uses them anymore.
+    A later get_client with the same credentials builds new ones.
+    """
+    digest = _credentials(session)[1]
+    with _lock:
+        for key in [key for key in _clients if key[0] == digest]:
+            del _clients[key]
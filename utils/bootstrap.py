@@ -0,0 +1,63 @@
+import base64
+import shlex
+
+# EC2 refuses user data larger than this (before base64 encoding)
+MAX_USER_DATA = 16 * 1024
+# Written by the user data: 'running', then 'ok' or 'failed: <command>'
+STATUS_FILE = "/var/lib/dotp/bootstrap.status"
+HOME = "/home/ubuntu"
+
+
+def docker_cmd(command):
+    """
+    Run `command` with the 'docker' group of a session opened before docker was installed.
+    """
+    return "sg docker -c " + shlex.quote(command)
+
+
+def role_commands(role, hosts):
+    """
+    Commands bringing up `role` on its host, run from the home directory holding ./resources.
+        hosts - role -> address of the backends, only needed for 'nginx'
+    """
+    if role == 'nginx':
+        return ["/bin/bash ./resources/nginx/config.sh " +
+                f"--jenkins_addr {hosts['jenkins']}:8080 " +
+                f"--gitea_addr {hosts['gitea']}:3000 " +
+                f"--artifactory_addr {hosts['artifactory']}:8081",
+                docker_cmd("docker-compose -f resources/nginx/docker-compose.yaml up -d")]
+    if role == 'jenkins':
+        return ["sudo /bin/bash ./resources/jenkins/install.sh"]
+    if role in ('gitea', 'artifactory'):
+        return [docker_cmd(f"docker-compose -f ./resources/{role}/docker-compose.yaml up -d")]
+    raise ValueError(f"Unknown role '{role}'.")
+
+
+def render_user_data(roles, bundle, hosts, docker_installed=False):
+    """
+    cloud-init user data configuring one host at boot: unpacks `bundle` (utils.bundle.Bundle of ./resources)
+    in the ubuntu home directory, installs docker (unless `docker_installed`, e.g. on a golden image)
+    and brings up every role of `roles`. Progress goes to STATUS_FILE, which create_dotp.service_steps polls over SSH.
+    """
+    commands = [] if docker_installed else ["sudo /bin/bash ./resources/ubuntu/docker_install.sh"]
+    for role in roles:
+        commands += role_commands(role, hosts)
+
+    script = ["#!/bin/bash",
+              "set -uo pipefail",
+              f"mkdir -p $(dirname {STATUS_FILE}) && echo running > {STATUS_FILE}",
+              f"cd {HOME}",
+              f"base64 -d <<'DOTP_EOF' | sudo -u ubuntu tar xzmf - -C {HOME}",
+              base64.encodebytes(bundle.data).decode().rstrip('\n'),
+              "DOTP_EOF",
+              f"echo {bundle.digest} > {HOME}/.dotp_bundle.sha256"]
+    # Commands run as ubuntu, like over SSH; the first one failing is reported and stops the bootstrap
+    for command in commands:
+        script.append(f"sudo -u ubuntu -H /bin/bash -c {shlex.quote(command)} || "
+                      f"{{ echo {shlex.quote('failed: ' + command)} > {STATUS_FILE}; exit 1; }}")
+    script.append(f"echo ok > {STATUS_FILE}")
+
+    user_data = "\n".join(script) + "\n"
+    if len(user_data) > MAX_USER_DATA:
+        raise ValueError(f"User data for {roles} is {len(user_data)} bytes, EC2 allows {MAX_USER_DATA}.")
+    return user_data
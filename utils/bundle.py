@@ -0,0 +1,117 @@
+import gzip
+import hashlib
+import io
+import logging
+import os
+import posixpath
+import shlex
+import tarfile
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# File on the remote host holding the digest of the last bundle unpacked there
+MARKER = ".dotp_bundle.sha256"
+CHUNK_SIZE = 256 * 1024
+
+
+class Bundle:
+    """
+    A directory packed as one gzip'ed tar in memory.
+        data   - the .tar.gz bytes
+        digest - sha256 of the content manifest (path, mode and sha256 of every file),
+                 the same for the same files whatever their timestamps or owners
+        checksums - `sha256sum -c` input for the unpacked files, relative to the directory they are unpacked in
+    """
+
+    def __init__(self, data, digest, files, checksums):
+        self.data = data
+        self.digest = digest
+        self.files = files
+        self.checksums = checksums
+
+    def __repr__(self):
+        return f"Bundle(digest={self.digest[:12]!r}, files={self.files}, size={len(self.data)})"
+
+
+def build_bundle(local_dir, arcname=None):
+    """
+    Pack `local_dir` into a Bundle. Entries are stored under `arcname` (default: the directory name),
+    in sorted order with zeroed timestamps and owners, so the same content always gives the same bytes.
+    """
+    arcname = arcname or os.path.basename(os.path.normpath(local_dir))
+    manifest = hashlib.sha256()
+    checksums = []
+    buffer = io.BytesIO()
+    files = 0
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as compressed:
+        with tarfile.open(fileobj=compressed, mode='w', format=tarfile.PAX_FORMAT) as tar:
+            for root, dirs, names in os.walk(local_dir):
+                dirs.sort()
+                relative = os.path.relpath(root, local_dir).replace(os.sep, '/')
+                for name in [None] + sorted(names):
+                    path = root if name == None else os.path.join(root, name)
+                    member = posixpath.normpath(posixpath.join(arcname, relative, name or '.'))
+                    info = tar.gettarinfo(path, arcname=member)
+                    info.mtime = 0
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    if name == None:
+                        tar.addfile(info)
+                        continue
+                    with open(path, 'rb') as f:
+                        content = f.read()
+                    checksum = hashlib.sha256(content).hexdigest()
+                    manifest.update(f"{member}\0{info.mode:o}\0{checksum}\n".encode())
+                    checksums.append(f"{checksum}  {member}\n")
+                    tar.addfile(info, io.BytesIO(content))
+                    files += 1
+    return Bundle(buffer.getvalue(), manifest.hexdigest(), files, ''.join(checksums))
+
+
+def remote_digest(sessions, host, bundle, remote_dir='.'):
+    """
+    Digest of the bundle last unpacked on `host`, None if there is none or if a file of `bundle` unpacked
+    in `remote_dir` is missing or differs, e.g. a template filled in place by a config script.
+    """
+    exit_status, output, _ = sessions.run(host, f"cd {shlex.quote(remote_dir)} && "
+                                                f"printf %s {shlex.quote(bundle.checksums)} | sha256sum -c --status - && "
+                                                f"cat ~/{MARKER}")
+    return output.strip() if exit_status == 0 and output.strip() else None
+
+
+def push_bundle(sessions, host, bundle, remote_dir='.'):
+    """
+    Unpack `bundle` into `remote_dir` on `host` (None for the bastion of the utils.ssh_sessions.SessionManager),
+    streamed over a single channel into `tar xzf -`. Skipped when the host already has the same digest
+    and its files are still as unpacked; files changed in place (e.g. by nginx/config.sh) are unpacked again.
+    Returns True when the bundle was sent, False when it was skipped.
+    """
+    label = host or sessions.bastion_host
+    if remote_digest(sessions, host, bundle, remote_dir) == bundle.digest:
+        logger.info(f"'{label}' already has bundle {bundle.digest[:12]}, skipping transfer")
+        return False
+
+    command = (f"mkdir -p {shlex.quote(remote_dir)} && tar xzmf - -C {shlex.quote(remote_dir)} && "
+               f"echo {bundle.digest} > ~/{MARKER}")
+    channel = sessions.client(host).get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        view = memoryview(bundle.data)
+        for offset in range(0, len(view), CHUNK_SIZE):
+            channel.sendall(view[offset:offset + CHUNK_SIZE])
+        channel.shutdown_write()
+        error = b''
+        while True:
+            data = channel.recv_stderr(4096)
+            if not data:
+                break
+            error += data
+        exit_status = channel.recv_exit_status()
+    finally:
+        channel.close()
+    if exit_status != 0:
+        raise RuntimeError(f"Unpacking bundle on '{label}' failed with {exit_status}: {error.decode().strip()}")
+    logger.info(f"Sent bundle {bundle.digest[:12]} ({bundle.files} files, {len(bundle.data)} bytes) to '{label}'")
+    return True
@@ -1,13 +1,32 @@
+"""
+Tear down one or more VPCs created by DevOps Tools Pack.
+
+    python -m utils.clear_vpc vpc-01d6840cc8e27092c [vpc-...]
+    python -m utils.clear_vpc --project dev-ops-tools-pack
+
+Every resource of every VPC becomes a step of one dependency graph (utils.engine),
+so independent deletions run in parallel, e.g. endpoints, route tables and security groups
+are removed while the NAT Gateways are still being deleted.
+With --project only the resources tagged with the project are deleted, as listed by its inventory
+index (utils.inventory) instead of describing every VPC again.
+"""
+import argparse
 import logging
 from datetime import date, datetime
 import botocore
-import boto3
+from utils import inventory, tracing
+from utils.aws_clients import get_client
+from utils.engine import Step, run_steps
+from utils.waiters import wait_all, wait_for
 import time
 
 # logger config
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
 
+# Errors returned while a resource still has dependents being deleted
+RETRYABLE_ERRORS = ('DependencyViolation', 'InvalidIPAddress.InUse', 'AuthFailure.ServiceLinkedRoleCreationNotPermitted')
+
 def json_datetime_serializer(obj):
     """
     Helper method to serialize datetime fields
@@ -16,94 +35,308 @@ def json_datetime_serializer(obj):
         return obj.isoformat()
     raise TypeError("Type %s not serializable" % type(obj))
 
-def main():   
-    # Init connections
-    logger.info("Initiate AWS connections from Remove VPC.")
-    session = boto3.Session()
-    client = boto3.client('ec2')
-    ec2 = boto3.resource('ec2')
-
-    # vpc = 'vpc-01d6840cc8e27092c'
-    vpc = input("Enter VPC ID: ")
-
-    full_tic = time.perf_counter()
-    try:
-        tic = time.perf_counter()
-        instances = []
-        for instance in client.describe_instances(Filters=[{'Name': 'vpc-id','Values': [vpc]}])['Reservations']:
-            instances.append(instance['Instances'][0]['InstanceId'])
-    
-        logger.info(f"Deleting Instances '{instances}'")
-        client.terminate_instances(InstanceIds=instances)
-
-        waiter = client.get_waiter('instance_terminated')
-        logger.info(f"Waiting for instances to be terminated...")
-        waiter.wait(InstanceIds=instances)
-        toc = time.perf_counter()
-        logger.info(f"Time took to delete EC2 instances - {toc - tic:0.2f} seconds")
-    except:
-        logger.info("Skipping EC2 instances because <!insert-reason-here!>.")
-
-
-    tic = time.perf_counter()
-    nats = []
-    for nat in client.describe_nat_gateways(Filters=[{'Name': 'vpc-id', 'Values': [vpc]}])['NatGateways']:
-        nats.append(nat['NatGatewayId'])
-        logger.info(f"Deleting NAT Gatewaty '{nat['NatGatewayId']}'")
-        client.delete_nat_gateway(NatGatewayId=nat['NatGatewayId'])
-
-    logger.info("Waiting for NAT Gateways to be deleted...")
-    waiter = client.get_waiter('nat_gateway_deleted')
-    waiter.wait(NatGatewayIds=nats)
-
-    toc = time.perf_counter()
-    logger.info(f"Time took to delete NAT Gateways -> {toc - tic:0.2f} seconds")
-
-    tic = time.perf_counter()
-    for eip in client.describe_addresses()['Addresses']:
-        logger.info(f"Elastic IP {eip['PublicIp']} is not associated, releasing")
-        client.release_address(AllocationId=eip['AllocationId'])
-
-    for ig in client.describe_internet_gateways(Filters=[{'Name': 'attachment.vpc-id','Values': [vpc]}])['InternetGateways']:
-        logger.info(f"Deleting Internet Gateway '{ig['InternetGatewayId']}'")
-        client.detach_internet_gateway(InternetGatewayId=ig['InternetGatewayId'], VpcId=vpc)
-        client.delete_internet_gateway(InternetGatewayId=ig['InternetGatewayId'])
-
-    for scgr in client.describe_security_groups(Filters=[{'Name': 'vpc-id','Values': [vpc]}])['SecurityGroups']:
-        if scgr['GroupName'] == 'default':
+def retry_dependency(func, attempts=8, delay=2.0, max_delay=30.0, **kwargs):
+    """
+    Call func(**kwargs), retrying with exponential backoff while AWS reports a dependency violation.
+    """
+    for attempt in range(attempts):
+        try:
+            return func(**kwargs)
+        except botocore.exceptions.ClientError as error:
+            code = error.response['Error']['Code']
+            if code not in RETRYABLE_ERRORS or attempt == attempts - 1:
+                raise
+            wait = min(delay * 2 ** attempt, max_delay)
+            logger.info(f"{code} on {func.__name__}({kwargs}), retrying in {wait:0.0f} seconds...")
+            time.sleep(wait)
+
+def find_vpcs(project):
+    """
+    VPC IDs whose 'Name' tag is the project name.
+    """
+    client = get_client('ec2')
+    vpcs = []
+    for page in client.get_paginator('describe_vpcs').paginate(Filters=[{'Name': 'tag:Name', 'Values': [project]}]):
+        vpcs += [vpc['VpcId'] for vpc in page['Vpcs']]
+    return vpcs
+
+def _paginate(operation, result_key, **params):
+    client = get_client('ec2')
+    items = []
+    for page in client.get_paginator(operation).paginate(**params):
+        items += page[result_key]
+    return items
+
+def describe_vpc_resources(vpc):
+    client = get_client('ec2')
+    vpc_filter = [{'Name': 'vpc-id', 'Values': [vpc]}]
+
+    instances = []
+    for reservation in _paginate('describe_instances', 'Reservations',
+                                 Filters=vpc_filter + [{'Name': 'instance-state-name',
+                                                        'Values': ['pending', 'running', 'stopping', 'stopped']}]):
+        instances += [instance['InstanceId'] for instance in reservation['Instances']]
+
+    # DescribeNatGateways names its filter parameter 'Filter'
+    nats = [nat for nat in _paginate('describe_nat_gateways', 'NatGateways', Filter=vpc_filter)
+            if nat['State'] not in ('deleting', 'deleted')]
+
+    # Only the Elastic IPs used by this VPC: the ones of its NAT Gateways and of its instances
+    allocations = [address['AllocationId'] for nat in nats for address in nat['NatGatewayAddresses'] if 'AllocationId' in address]
+    if instances:
+        allocations += [address['AllocationId'] for address in
+                        client.describe_addresses(Filters=[{'Name': 'instance-id', 'Values': instances}])['Addresses']]
+
+    return {
+        'instances': instances,
+        'nat_gateways': [nat['NatGatewayId'] for nat in nats],
+        'addresses': sorted(set(allocations)),
+        'internet_gateways': [ig['InternetGatewayId'] for ig in
+                              _paginate('describe_internet_gateways', 'InternetGateways',
+                                        Filters=[{'Name': 'attachment.vpc-id', 'Values': [vpc]}])],
+        'security_groups': [(scgr['GroupId'], scgr['GroupName']) for scgr in
+                            _paginate('describe_security_groups', 'SecurityGroups', Filters=vpc_filter) if scgr['GroupName'] != 'default'],
+        'route_tables': _paginate('describe_route_tables', 'RouteTables', Filters=vpc_filter),
+        'subnets': [subnet['SubnetId'] for subnet in _paginate('describe_subnets', 'Subnets', Filters=vpc_filter)],
+        'vpc_endpoints': [vpce['VpcEndpointId'] for vpce in _paginate('describe_vpc_endpoints', 'VpcEndpoints', Filters=vpc_filter)
+                          if vpce['State'].lower() not in ('deleting', 'deleted')],
+    }
+
+def vpc_resources(vpc, live):
+    """
+    describe_vpc_resources of `vpc` read from an inventory index (inventory.Index.get): the resources tagged with the project only.
+    """
+    def in_vpc(kind):
+        return [resource for resource in live.get(kind, []) if resource.get('VpcId') == vpc]
+
+    instances = [instance['InstanceId'] for instance in in_vpc('instances')]
+    nats = in_vpc('nat_gateways')
+    allocations = [address['AllocationId'] for nat in nats for address in nat['NatGatewayAddresses'] if 'AllocationId' in address]
+    allocations += [address['AllocationId'] for address in live.get('addresses', []) if address.get('InstanceId') in instances]
+    return {
+        'instances': instances,
+        'nat_gateways': [nat['NatGatewayId'] for nat in nats],
+        'addresses': sorted(set(allocations)),
+        'internet_gateways': [ig['InternetGatewayId'] for ig in live.get('internet_gateways', [])
+                              if any(attachment['VpcId'] == vpc for attachment in ig.get('Attachments', []))],
+        'security_groups': [(scgr['GroupId'], scgr['GroupName']) for scgr in in_vpc('security_groups') if scgr['GroupName'] != 'default'],
+        'route_tables': in_vpc('route_tables'),
+        'subnets': [subnet['SubnetId'] for subnet in in_vpc('subnets')],
+        'vpc_endpoints': [vpce['VpcEndpointId'] for vpce in in_vpc('vpc_endpoints')],
+    }
+
+def terminate_instances(instances):
+    client = get_client('ec2')
+    logger.info(f"Deleting Instances '{instances}'")
+    client.terminate_instances(InstanceIds=instances)
+    logger.info(f"Waiting for instances to be terminated...")
+    wait_all('instance', instances, state='terminated')
+
+def delete_nat_gateway(nat_gateway_id):
+    client = get_client('ec2')
+    logger.info(f"Deleting NAT Gateway '{nat_gateway_id}'")
+    client.delete_nat_gateway(NatGatewayId=nat_gateway_id)
+    wait_for('nat_gateway', nat_gateway_id, state='deleted').result()
+
+def release_address(allocation_id):
+    client = get_client('ec2')
+    logger.info(f"Releasing Elastic IP '{allocation_id}'")
+    retry_dependency(client.release_address, AllocationId=allocation_id)
+
+def delete_internet_gateway(internet_gateway_id, vpc):
+    client = get_client('ec2')
+    logger.info(f"Deleting Internet Gateway '{internet_gateway_id}'")
+    # vpc is None for a gateway that was never attached, e.g. left behind by a failed run
+    if vpc != None:
+        retry_dependency(client.detach_internet_gateway, InternetGatewayId=internet_gateway_id, VpcId=vpc)
+    retry_dependency(client.delete_internet_gateway, InternetGatewayId=internet_gateway_id)
+
+def delete_security_group(group_id, group_name):
+    client = get_client('ec2')
+    logger.info(f"Deleting Security Group '{group_name}'")
+    retry_dependency(client.delete_security_group, GroupId=group_id)
+
+def delete_route_table(route_table):
+    client = get_client('ec2')
+    if any(rtb_assoc['Main'] for rtb_assoc in route_table['Associations']):
+        logger.info(f"Main Route Table '{route_table['RouteTableId']}' is deleted with the VPC.")
+        return
+    logger.info(f"Deleting Route Table '{route_table['RouteTableId']}'")
+    for rtb_assoc in route_table['Associations']:
+        client.disassociate_route_table(AssociationId=rtb_assoc['RouteTableAssociationId'])
+    retry_dependency(client.delete_route_table, RouteTableId=route_table['RouteTableId'])
+
+def delete_subnet(subnet_id):
+    client = get_client('ec2')
+    logger.info(f"Deleting Subnet '{subnet_id}'")
+    retry_dependency(client.delete_subnet, SubnetId=subnet_id)
+
+def delete_vpc_endpoint(vpc_endpoint_id):
+    client = get_client('ec2')
+    logger.info(f"Deleting VPC Endpoint '{vpc_endpoint_id}'")
+    client.delete_vpc_endpoints(VpcEndpointIds=[vpc_endpoint_id])
+
+def delete_vpc(vpc):
+    client = get_client('ec2')
+    logger.info(f"Deleting VPC '{vpc}'")
+    retry_dependency(client.delete_vpc, VpcId=vpc)
+
+def delete_ecs_cluster(cluster_arn):
+    client = get_client('ecs')
+    logger.info(f"Deleting ECS Cluster '{cluster_arn}'")
+    client.delete_cluster(cluster=cluster_arn)
+
+def teardown_steps(vpc, resources, keep_vpc=False):
+    """
+    Deletion steps for one VPC. Every step provides a '<vpc>/<resource>' marker other steps can depend on.
+    With keep_vpc=True only `resources` are deleted and the VPC stays; vpc=None for resources outside of any VPC
+    (Elastic IPs, detached Internet Gateways).
+    """
+    steps = []
+
+    def add(key, func, requires=()):
+        name = f"{vpc or 'detached'}/{key}"
+        steps.append(Step(name, lambda **_: func() or True, requires=requires, provides=[name]))
+        return name
+
+    instances = []
+    if resources['instances']:
+        instances.append(add("instances", lambda: terminate_instances(resources['instances'])))
+
+    nats = [add(nat, lambda nat=nat: delete_nat_gateway(nat)) for nat in resources['nat_gateways']]
+    endpoints = [add(vpce, lambda vpce=vpce: delete_vpc_endpoint(vpce)) for vpce in resources['vpc_endpoints']]
+
+    addresses = [add(allocation, lambda allocation=allocation: release_address(allocation), requires=nats + instances)
+                 for allocation in resources['addresses']]
+    gateways = [add(ig, lambda ig=ig: delete_internet_gateway(ig, vpc), requires=nats + instances + addresses)
+                for ig in resources['internet_gateways']]
+    groups = [add(group_id, lambda group_id=group_id, group_name=group_name: delete_security_group(group_id, group_name),
+                  requires=instances + endpoints)
+              for group_id, group_name in resources['security_groups']]
+    route_tables = [add(rt['RouteTableId'], lambda rt=rt: delete_route_table(rt), requires=endpoints)
+                    for rt in resources['route_tables']]
+    subnets = [add(subnet, lambda subnet=subnet: delete_subnet(subnet), requires=instances + nats + endpoints)
+               for subnet in resources['subnets']]
+
+    if not keep_vpc:
+        steps.append(Step(f"{vpc}/vpc", lambda **_: delete_vpc(vpc) or True,
+                          requires=instances + nats + endpoints + addresses + gateways + groups + route_tables + subnets,
+                          provides=[vpc]))
+    return steps
+
+def project_steps(live, delete=None):
+    """
+    Deletion steps for the resources of a project read from its inventory index (inventory.Index.get).
+    `delete` (kind -> resources, default everything in `live`) are the ones to delete: whole VPCs with everything
+    of the project inside them, other resources next to the ones depending on them in the VPC they belong to.
+    """
+    delete = live if delete == None else delete
+    vpcs = [vpc['VpcId'] for vpc in delete.get('vpcs', [])]
+    steps, covered = [], set()
+    for vpc in vpcs:
+        resources = vpc_resources(vpc, live)
+        covered.update(resources['addresses'])
+        steps += teardown_steps(vpc, resources)
+
+    # Elastic IPs belong with the NAT Gateway or instance holding them, so they are released after it
+    address_vpcs = {address['AllocationId']: nat['VpcId'] for nat in live.get('nat_gateways', [])
+                    for address in nat['NatGatewayAddresses'] if 'AllocationId' in address}
+    instance_vpcs = {instance['InstanceId']: instance.get('VpcId') for instance in live.get('instances', [])}
+    for address in live.get('addresses', []):
+        if address.get('InstanceId') in instance_vpcs:
+            address_vpcs[address['AllocationId']] = instance_vpcs[address['InstanceId']]
+
+    groups = {}
+    for kind, resources in delete.items():
+        if kind in ('vpcs', 'ecs_clusters'):
             continue
-        logger.info(f"Deleting Security Group '{scgr['GroupName']}'")
-        client.delete_security_group(GroupId=scgr['GroupId'])
-
-    for rt in client.describe_route_tables(Filters=[{'Name': 'vpc-id','Values': [vpc]}])['RouteTables']:
-        logger.info(f"Trying to delete Route Table '{rt['RouteTableId']}'")
-        for rtb_assoc in rt['Associations']:
-            is_main = False
-            if rtb_assoc['Main'] == False:
-                client.disassociate_route_table(AssociationId=rtb_assoc['RouteTableAssociationId'])
+        for resource in resources:
+            resource_id = inventory.resource_id(kind, resource)
+            if kind == 'internet_gateways':
+                vpc = next((attachment['VpcId'] for attachment in resource.get('Attachments', [])), None)
+            elif kind == 'addresses':
+                vpc = address_vpcs.get(resource_id)
             else:
-                is_main=True
-        if not is_main:
-            logger.info("Route table deleted.")
-            client.delete_route_table(RouteTableId=rt['RouteTableId'])
-        else:
-            logger.exception("Main Route Table can't be deleted.")
+                vpc = resource.get('VpcId')
+            if resource_id in covered or vpc in vpcs:
+                continue
+            group = groups.setdefault(vpc, {'instances': [], 'nat_gateways': [], 'addresses': [], 'internet_gateways': [],
+                                            'security_groups': [], 'route_tables': [], 'subnets': [], 'vpc_endpoints': []})
+            if kind == 'security_groups':
+                group[kind].append((resource_id, resource['GroupName']))
+            elif kind == 'route_tables':
+                group[kind].append(resource)
+            else:
+                group[kind].append(resource_id)
+    for vpc, resources in groups.items():
+        steps += teardown_steps(vpc, resources, keep_vpc=True)
 
-    for subnet in client.describe_subnets(Filters=[{'Name': 'vpc-id','Values': [vpc]}])['Subnets']:
-        logger.info(f"Deleting Subnet '{subnet['SubnetId']}'")
-        client.delete_subnet(SubnetId=subnet['SubnetId'])
+    for cluster in delete.get('ecs_clusters', []):
+        steps.append(Step(f"ecs/{cluster['clusterName']}", lambda cluster=cluster: delete_ecs_cluster(cluster['clusterArn']) or True,
+                          provides=[cluster['clusterArn']]))
+    return steps
 
-    for vpce in client.describe_vpc_endpoints(Filters=[{'Name': 'vpc-id','Values': [vpc]}])['VpcEndpoints']:
-        logger.info(f"Deleting VPC Endpoint '{vpce['VpcEndpointId']}'")
-        client.delete_vpc_endpoints(VpcEndpointIds=[vpce['VpcEndpointId']])
+def teardown_vpcs(vpcs, max_workers=16):
+    """
+    Delete every resource of `vpcs` and the VPCs themselves in one concurrent run.
+    """
+    with tracing.trace("clear_vpc", vpcs=",".join(vpcs)) as run_trace:
+        tracing.phase("discover")
+        discovered = run_steps([Step(f"{vpc}/discover", lambda vpc=vpc: describe_vpc_resources(vpc), provides=[f"{vpc}/resources"])
+                                for vpc in vpcs], max_workers=max_workers)
 
-    logger.info(f"Deleting VPC '{vpc}'")
-    client.delete_vpc(VpcId=vpc)
-    toc = time.perf_counter()
-    logger.info(f"VPC Deleted in {toc - full_tic:0.2f} seconds")
+        tracing.phase("teardown")
+        steps = []
+        for vpc in vpcs:
+            steps += teardown_steps(vpc, discovered[f"{vpc}/resources"])
+
+        def report(step, context, elapsed):
+            if step.name.endswith("/vpc"):
+                logger.info(f"VPC '{step.provides[0]}' deleted in {run_trace.root.duration:0.2f} seconds")
+
+        run_steps(steps, max_workers=max_workers, on_complete=report)
+    logger.info(f"{len(vpcs)} VPC(s) deleted in {run_trace.root.duration:0.2f} seconds")
+
+def teardown_project(project, max_workers=16):
+    """
+    Delete every resource tagged with `project` in one concurrent run, as listed by its inventory index.
+    Returns the IDs of the VPCs deleted.
+    """
+    index = inventory.project_index(project)
+    with tracing.trace("clear_vpc", project=project) as run_trace:
+        tracing.phase("discover")
+        live = index.get()
+
+        tracing.phase("teardown")
+        try:
+            run_steps(project_steps(live), max_workers=max_workers)
+        finally:
+            index.invalidate()
+    logger.info(f"Project '{project}' deleted in {run_trace.root.duration:0.2f} seconds")
+    return [vpc['VpcId'] for vpc in live['vpcs']]
+
+def main(vpcs=None, project=None):
+    # Init connections
+    logger.info("Initiate AWS connections from Remove VPC.")
+
+    vpcs = list(vpcs or [])
+    if project != None:
+        deleted = teardown_project(project)
+        # VPCs named after the project whose resources don't carry its name in the Project tag (older stacks)
+        vpcs += [vpc for vpc in find_vpcs(project) if vpc not in deleted and vpc not in vpcs]
+        if not vpcs:
+            logger.info("😊 Cleaned up and rolled out! 😊")
+            return
+    if not vpcs:
+        vpcs = input("Enter VPC ID: ").split()
 
+    teardown_vpcs(vpcs)
     logger.info("😊 Cleaned up and rolled out! 😊")
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Remove DevOps Tools Pack VPCs and everything inside them.")
+    parser.add_argument('vpcs', nargs='*', help="VPC IDs to remove")
+    parser.add_argument('--project', help="remove every resource tagged with this project and every VPC named after it")
+    args = parser.parse_args()
+    main(vpcs=args.vpcs, project=args.project)
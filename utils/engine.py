@@ -0,0 +1,138 @@
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from utils import tracing
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+
+class Cancelled(Exception):
+    """
+    Raised by run_steps when the run was cancelled before every step finished.
+    """
+
+
+class Step:
+    """
+    One unit of provisioning work.
+        name     - unique step name, used in logs
+        func     - callable, receives every name in `requires` as keyword argument
+        requires - names of values the step needs before it can start
+        provides - names of values the step returns. With one name the return value
+                   is stored as is, with more names func must return a tuple in the same order
+        message  - optional text formatted with the run context (and `elapsed`) once the step is done
+    """
+
+    def __init__(self, name, func, requires=(), provides=(), message=None):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.provides = tuple(provides)
+        self.message = message
+
+    def __repr__(self):
+        return f"Step({self.name!r})"
+
+    def execute(self, inputs):
+        result = self.func(**inputs)
+        if len(self.provides) == 0:
+            return {}
+        if len(self.provides) == 1:
+            return {self.provides[0]: result}
+        return dict(zip(self.provides, result))
+
+
+def _execute(step, inputs):
+    # Every step is a span of the current trace, annotated with the resources it returned
+    with tracing.span(step.name, 'step') as span:
+        outputs = step.execute(inputs)
+        if span != None:
+            span.set(**tracing.resource_attributes(outputs.values()))
+        return outputs
+
+
+def _check_graph(steps, context):
+    producers = {}
+    for step in steps:
+        for key in step.provides:
+            if key in producers or key in context:
+                raise ValueError(f"'{key}' is provided more than once (step '{step.name}').")
+            producers[key] = step
+    for step in steps:
+        for key in step.requires:
+            if key not in producers and key not in context:
+                raise ValueError(f"Step '{step.name}' requires '{key}' which no step provides.")
+
+
+def reuse(steps, done):
+    """
+    Split `steps` for a run that continues earlier work. `done` maps step names to outputs known already
+    (e.g. from utils.journal or the live stack); such a step is skipped unless a step it requires values from runs.
+    Returns (context with the outputs of the skipped steps, steps left to run) for run_steps.
+    """
+    producers = {key: step.name for step in steps for key in step.provides}
+    skipped = {step.name for step in steps if step.name in done and set(step.provides) <= set(done[step.name])}
+    changed = True
+    while changed:
+        changed = False
+        for step in steps:
+            if step.name in skipped and any(producers.get(key, step.name) not in skipped for key in step.requires):
+                skipped.discard(step.name)
+                changed = True
+    context = {}
+    for step in steps:
+        if step.name in skipped:
+            context.update({key: done[step.name][key] for key in step.provides})
+    return context, [step for step in steps if step.name not in skipped]
+
+
+def run_steps(steps, context=None, max_workers=8, on_complete=None, cancel=None):
+    """
+    Run `steps` on a thread pool, starting every step as soon as all its `requires` are known.
+    `context` holds values that are available from the start.
+    `on_complete(step, context, elapsed)` is called from the calling thread after each step,
+    so it is safe to emit Socket.IO messages from it.
+    Returns the context with every provided value.
+    On the first failing step no new step is started, running ones are awaited and the error is raised.
+    `cancel` is an optional threading.Event; once set no new step is started and Cancelled is raised.
+    """
+    context = dict(context or {})
+    _check_graph(steps, context)
+
+    pending = list(steps)
+    running = {}
+    started = {}
+    pool = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        while pending or running:
+            if cancel != None and cancel.is_set():
+                if running:
+                    wait(running)
+                raise Cancelled(f"Cancelled with {len(pending) + len(running)} step(s) not done.")
+            for step in [s for s in pending if all(key in context for key in s.requires)]:
+                pending.remove(step)
+                logger.debug(f"Starting step '{step.name}'")
+                started[step.name] = time.perf_counter()
+                # Steps inherit the caller's context (e.g. the AWS session set with aws_clients.use_session)
+                inputs = {key: context[key] for key in step.requires}
+                running[pool.submit(contextvars.copy_context().run, _execute, step, inputs)] = step
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                step = running.pop(future)
+                try:
+                    outputs = future.result()
+                except Exception:
+                    logger.error(f"Step '{step.name}' failed.")
+                    raise
+                context.update(outputs)
+                elapsed = time.perf_counter() - started[step.name]
+                logger.debug(f"Step '{step.name}' done in {elapsed:0.2f} seconds")
+                if on_complete != None:
+                    on_complete(step, context, elapsed)
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return context
@@ -1,11 +1,18 @@
 import botocore
 import boto3
+from utils import inventory, sg_rules, tracing
+from utils.aws_clients import get_client
+from utils.lookups import find_key_pair, find_security_group, find_subnet
+from utils.waiters import wait_for
+from utils.readiness import Target, TcpProbe, wait_ready
+import contextvars
 import json
 import os
 import logging
 from datetime import date, datetime
 import time
 import socket
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 # logger config
 logger = logging.getLogger()
@@ -20,47 +27,61 @@ def json_datetime_serializer(obj):
         return obj.isoformat()
     raise TypeError("Type %s not serializable" % type(obj))
 
-def create_security_group(group_name, subnet_id, ip_permissions="0.0.0.0/0:22", group_description="Autocreated by [snick] DevOps Tools Pack"):
-    client = boto3.client('ec2')
-
-    security_groups = client.describe_security_groups(Filters=[{'Name': 'group-name', 'Values': [group_name]}])['SecurityGroups']
-    if len(security_groups) == 0:
-        vpc_id = client.describe_subnets(Filters=[{'Name': 'subnet-id', 'Values': [subnet_id]}])['Subnets'][0]['VpcId']
+def create_security_group(group_name, subnet_id, ip_permissions="0.0.0.0/0:22", group_description="Autocreated by [snick] DevOps Tools Pack", vpc_id=None, project=None):
+    """
+    Create the security group `group_name` with the ingress rules `ip_permissions` (see utils.sg_rules),
+    or bring the rules of the existing group to them with the fewest authorize / revoke calls.
+    """
+    client = get_client('ec2')
+    # An invalid spec fails before anything is created
+    rules = sg_rules.compile_rules(ip_permissions)
+
+    if vpc_id == None:
+        vpc_id = find_subnet(subnet_id)['VpcId']
+    security_group = find_security_group(group_name, vpc_id)
+    if security_group == None:
         try:
+            tags = [] if project == None else [{'ResourceType': 'security-group', 'Tags': [{'Key': 'Project', 'Value': project},
+                                                                                       {'Key': 'Name', 'Value': group_name}]}]
             response = client.create_security_group(GroupName=group_name,
                                                 Description=group_description,
-                                                VpcId=vpc_id)
+                                                VpcId=vpc_id,
+                                                TagSpecifications=tags)
             security_group_id = response['GroupId']
             logger.info(f"Security Group Created {security_group_id} in vpc {vpc_id}.")
 
-            ec2_ip_permissions = []
-            for x in ip_permissions.split(','):
-                ip_ranges = []
-                for y in x.split(':')[0].split(';'):
-                    ip_ranges.append({'CidrIp': y})
-                ec2_ip_permissions.append({'IpProtocol': 'tcp','FromPort': int(x.split(':')[1]),'ToPort': int(x.split(':')[1]),'IpRanges': ip_ranges})
-
-            client.authorize_security_group_ingress(GroupId=security_group_id, IpPermissions=ec2_ip_permissions)
+            sg_rules.apply(security_group_id, rules, permissions=[])
             logger.info(f"Ingress Successfully Set")
             return security_group_id
         except botocore.exceptions.ClientError as e:
             raise e
-    logger.info(f"Security group '{group_name}' already exists.")
-    return security_groups[0]['GroupId']
+    # find_security_group is memoized, its rules may be stale: apply describes them
+    authorize, revoke = sg_rules.apply(security_group['GroupId'], rules)
+    if authorize or revoke:
+        logger.info(f"Security group '{group_name}' updated: {len(sg_rules.rules_from_permissions(authorize))} rule(s) "
+                    f"authorized, {len(sg_rules.rules_from_permissions(revoke))} revoked.")
+    else:
+        logger.info(f"Security group '{group_name}' already exists in vpc {vpc_id}.")
+    return security_group['GroupId']
 
-def get_ec2_instances(vpc_id):
+def get_ec2_instances(vpc_id, project=None):
     # ec2 = boto3.resource('ec2', region_name=region_name)
     # instances = ec2.instances.all()
 
-    client = boto3.client('ec2')
-    instances = boto3.client('ec2').describe_instances(Filters=[{'Name': 'vpc-id', 'Values':[vpc_id]}])
+    # The instances of a project are read from its inventory index (see utils.inventory) instead of asking EC2 each time
+    if project != None:
+        instances = {'Reservations': [{'Instances': [instance for instance in inventory.project_index(project).get(['instances'])['instances']
+                                                     if instance.get('VpcId') == vpc_id]}]}
+        return json.dumps(instances, indent=4, default=json_datetime_serializer)
+
+    instances = get_client('ec2').describe_instances(Filters=[{'Name': 'vpc-id', 'Values':[vpc_id]}])
 
     return json.dumps(instances, indent=4, default=json_datetime_serializer)
 
-def create_ec2_instance(region_name, image_id, instance_type, key_pair_name, instance_size, subnet_id, security_group, instance_name=None):
+def _ec2_instance_params(image_id, instance_type, key_pair_name, instance_size, subnet_id, security_group, instance_name=None, user_data=None, project=None):
     # instance_size - Volume size in GB
-    ec2 = boto3.resource('ec2', region_name=region_name)
-    instance = ec2.create_instances(
+    # user_data - optional cloud-init script run at first boot (see utils.bootstrap)
+    params = dict(
         ImageId=image_id,
         InstanceType=instance_type,
         SubnetId=subnet_id,
@@ -76,7 +97,6 @@ def create_ec2_instance(region_name, image_id, instance_type, key_pair_name, ins
                 'Encrypted': False,
                 'DeleteOnTermination': True,
                 'Iops': 3000,
-                'SnapshotId': 'snap-03cb54dd7b8f2094d',
                 'VolumeSize': instance_size,
                 'VolumeType': 'gp3',
                 'Throughput': 125
@@ -92,51 +112,78 @@ def create_ec2_instance(region_name, image_id, instance_type, key_pair_name, ins
                                         'Value': instance_name
                                     },{
                                         'Key': 'Project',
-                                        'Value': '[snick] DevOps Tools Pack'
+                                        'Value': project or '[snick] DevOps Tools Pack'
                                     }
                                 ]
                             },
                         ]
-                        )[0]
-    
-    if instance_name != None:
-        logger.info(f"EC2 instance '{instance_name}' - Region '{region_name}' - sshkey '{key_pair_name}'.")
-    else:
-        logger.info(f"EC2 instance - Region '{region_name}' - sshkey '{key_pair_name}'.")
-    logger.info("Waiting for instance to start...")
-    instance.wait_until_running()
-    instance.reload() # Reload to get public IP
-    if instance.public_ip_address == None:
-        logger.info(f"EC2 instance is running! No Public IP Available ; Private IP: '{instance.private_ip_address}'.")
-    else:
-        logger.info(f"EC2 instance is running! Public IP: '{instance.public_ip_address}' ; Private IP: '{instance.private_ip_address}'.")
+    )
+    if user_data != None:
+        params['UserData'] = user_data
+    return params
 
-    return instance
+def launch_ec2_instances(region_name, image_id, instance_type, key_pair_name, instance_size, instances):
+    """
+    Start several EC2 instances at once without waiting for them.
+        instances - list of dicts with keys 'instance_name', 'subnet_id', 'security_group' and optionally 'user_data'
+                    and 'project' (value of the 'Project' tag)
+    Returns a dict 'instance_name' -> description from run_instances (InstanceId, PrivateDnsName, PrivateIpAddress are
+    known right away), to pass to wait_ec2_instances.
+    """
+    client = get_client('ec2', region_name=region_name)
+
+    def launch(spec):
+        response = client.run_instances(**_ec2_instance_params(image_id, instance_type, key_pair_name, instance_size,
+                                                                spec['subnet_id'], spec['security_group'], spec['instance_name'],
+                                                                spec.get('user_data'), spec.get('project')))
+        logger.info(f"EC2 instance '{spec['instance_name']}' - Region '{region_name}' - sshkey '{key_pair_name}'.")
+        return response['Instances'][0]
+
+    with ThreadPoolExecutor(max_workers=len(instances) or 1) as pool:
+        # Each launch keeps the caller's context, so its call is traced under the current span
+        launched = list(pool.map(lambda spec: contextvars.copy_context().run(launch, spec), instances))
+    return {spec['instance_name']: instance for spec, instance in zip(instances, launched)}
+
+def wait_ec2_instances(launched):
+    """
+    Wait until every instance of `launched` ('instance_name' -> description) runs, through utils.waiters,
+    which checks them all with one describe_instances call per tick.
+    Returns a dict 'instance_name' -> instance description in the same order.
+    """
+    logger.info(f"Waiting for {len(launched)} instances to start...")
+    # One batched describe per tick for all instances; each one is logged as soon as it runs
+    result = {}
+    with tracing.span("wait instances", instances=len(launched)):
+        futures = {wait_for('instance', instance['InstanceId']): name for name, instance in launched.items()}
+        for future in as_completed(futures):
+            instance = future.result()
+            if instance.get('PublicIpAddress') == None:
+                logger.info(f"EC2 instance '{futures[future]}' is running! No Public IP Available ; Private IP: '{instance['PrivateIpAddress']}'.")
+            else:
+                logger.info(f"EC2 instance '{futures[future]}' is running! Public IP: '{instance['PublicIpAddress']}' ; Private IP: '{instance['PrivateIpAddress']}'.")
+            result[futures[future]] = instance
+    return {name: result[name] for name in launched}
 
 def create_ec2_key_pair(key_name):
     ## Allow call with no key, do nothing
     if key_name == None:
         return
     ## Check if key exists
-    client = boto3.client('ec2')
-    try:
-        json_data = json.loads(json.dumps(client.describe_key_pairs(KeyNames=[key_name]), indent=2, default=str))
-        logger.warning(f"Key <{json_data['KeyPairs'][0]['KeyName']}> exists, created at: <{json_data['KeyPairs'][0]['CreateTime']}>")
-    except botocore.exceptions.ClientError as error: 
-        if error.response['Error']['Code'] == 'InvalidKeyPair.NotFound':
-            logger.info("Creating ssh-key...")
-            client = boto3.client('ec2')
-            pem_key = client.create_key_pair(KeyName=key_name)
-            with open("./shadow/"+key_name+".pem", "w") as file:
-                file.write(pem_key['KeyMaterial'])
-                os.system("chmod 400 ./shadow/"+key_name+".pem")
-        else:
-            logger.error(f"Unexpected error: {error}")
+    client = get_client('ec2')
+    key_pair = find_key_pair(key_name)
+    if key_pair != None:
+        logger.warning(f"Key <{key_pair['KeyName']}> exists, created at: <{key_pair.get('CreateTime')}>")
+    else:
+        logger.info("Creating ssh-key...")
+        pem_key = client.create_key_pair(KeyName=key_name)
+        with open("./shadow/"+key_name+".pem", "w") as file:
+            file.write(pem_key['KeyMaterial'])
+            os.system("chmod 400 ./shadow/"+key_name+".pem")
     if os.path.isfile(f"./shadow/{key_name}.pem"):
         logger.info(f"Key {key_name} was created!")
     else:
         logger.error(f"Could not find pem key at '~/shadow/{key_name}.pem'.")
-        raise error
+        raise FileNotFoundError(f"./shadow/{key_name}.pem")
     return
 
 def get_ec2_custom_template(x):
@@ -168,16 +215,7 @@ def wait_for_port(port: int, host: str = 'localhost', timeout: float = 5.0):
     Raises:
         TimeoutError: The port isn't accepting connection after time specified in `timeout`.
     """
-    start_time = time.perf_counter()
-    while True:
-        try:
-            with socket.create_connection((host, port), timeout=timeout):
-                break
-        except OSError as e:
-            time.sleep(0.01)
-            if time.perf_counter() - start_time >= timeout:
-                raise TimeoutError('Waited too long for the port {} on host {} to start accepting '
-                                   'connections.'.format(port, host)) from e
+    wait_ready([Target(f"{host}:{port}", TcpProbe(host, port, timeout=min(timeout, 5.0)), timeout=timeout, host=host)])
 
 def main():
     logger.error("Please refer to main app, EC2 main function isn't callable.")
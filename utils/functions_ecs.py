@@ -1,25 +1,25 @@
 import botocore
 import boto3
+from utils.aws_clients import get_client
+from utils.functions_vpc import DEFAULT_PROJECT
+from utils.lookups import find_ecs_cluster, find_role
 import json
 
-def create_ecs_cluster(cluster_name):
-    client = boto3.client('ecs')
+def create_ecs_cluster(cluster_name, project=DEFAULT_PROJECT):
+    client = get_client('ecs')
 
-    try:
-        check = [x.split('/')[1] for x in client.list_clusters()['clusterArns']]
-        if cluster_name in check:
-            print(f"Cluster '{cluster_name}' already exists.")
-            return client.describe_clusters(clusters=[cluster_name])
-        else:
-            raise IndexError
-    except IndexError:
+    cluster = find_ecs_cluster(cluster_name)
+    if cluster != None:
+        print(f"Cluster '{cluster_name}' already exists.")
+        return {'clusters': [cluster]}
+    else:
         print(f"Cluster '{cluster_name}' does not exists. Creating...")
         response = client.create_cluster(
             clusterName=cluster_name,
             tags=[
                 {
                     'key': 'Project',
-                    'value': 'DevOps Tools Pack'
+                    'value': project
                 },
             ],
             settings=[
@@ -61,9 +61,9 @@ def create_ecs_cluster(cluster_name):
 
 def create_role_AmazonECSTaskExecutionRolePolicy():
     # Role needed when creating ECS Task Definition
-    client = boto3.client('iam')
+    client = get_client('iam')
 
-    if 'AmazonECSTaskExecutionRolePolicy' in [x['RoleName'] for x in client.list_roles()['Roles']]:
+    if find_role('AmazonECSTaskExecutionRolePolicy') != None:
         print(f"Role 'AmazonECSTaskExecutionRolePolicy' already exists.")
         return
 
@@ -86,7 +86,7 @@ def create_role_AmazonECSTaskExecutionRolePolicy():
     return response
 
 def main():
-    client = boto3.client('ecs')
+    client = get_client('ecs')
 
     cluster_name = "DevOps_Tools_Pack"
     
@@ -1,35 +1,118 @@
 import botocore
 import boto3
-import json
+from utils import aws_clients, waiters
+from utils.aws_clients import credentials_digest, get_client, use_session
 import os
 import logging
-from datetime import date, datetime
+import threading
+import time
 from flask_socketio import SocketIO, emit
 
 # logger config
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
 
-def login(aws_access_key_id, aws_secret_access_key, region):
+# Seconds a successful sts:GetCallerIdentity of some credentials stands for them, failures are never cached
+IDENTITY_TTL = float(os.environ.get('DOTP_LOGIN_TTL', 300))
 
-    if not os.path.exists(os.path.expanduser("~") + "/.aws"):
-        os.makedirs(os.path.expanduser("~") + "/.aws") 
 
-    with open(os.path.expanduser("~") + "/.aws/config", "w+") as file:
-        file.write(f"[default] \n")
-        file.write(f"region = {region} \n")
-        file.write(f"output = json \n")
+class CredentialStore:
+    """
+    AWS credentials of the Socket.IO clients, kept in memory for as long as the client is connected.
+    Nothing is written to ~/.aws: every login gets a boto3.Session built from its keys (one per keys and region,
+    shared by the clients using the same ones), so clients of different accounts never overwrite each other.
+    Credentials are checked with sts:GetCallerIdentity, a success is cached for `ttl` seconds.
+    """
 
-    with open(os.path.expanduser("~") + "/.aws/credentials", "w+") as file:
-        file.write(f"[default] \n")
-        file.write(f"aws_access_key_id = {aws_access_key_id} \n")
-        file.write(f"aws_secret_access_key = {aws_secret_access_key} \n")
-    
+    def __init__(self, ttl=IDENTITY_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # digest, region -> boto3.Session
+        self._sessions = {}
+        # sid -> (digest, region) of its last login
+        self._logins = {}
+        # digest -> (identity, checked at)
+        self._identities = {}
+
+    def identity(self, session):
+        """
+        sts:GetCallerIdentity of the credentials of `session` (Account, Arn, UserId), cached for self.ttl seconds.
+        Raises botocore errors when the credentials are not valid.
+        """
+        credentials = session.get_credentials()
+        if credentials == None:
+            raise botocore.exceptions.NoCredentialsError()
+        credentials = credentials.get_frozen_credentials()
+        key = credentials_digest(credentials.access_key, credentials.secret_key)
+        with self._lock:
+            identity, checked_at = self._identities.get(key, (None, 0))
+        if identity != None and time.time() - checked_at < self.ttl:
+            return identity
+        with use_session(session):
+            identity = get_client('sts').get_caller_identity()
+        identity = {name: identity[name] for name in ('Account', 'Arn', 'UserId')}
+        now = time.time()
+        with self._lock:
+            self._identities = {digest: value for digest, value in self._identities.items() if now - value[1] < self.ttl}
+            self._identities[key] = (identity, now)
+        return identity
+
+    def login(self, sid, aws_access_key_id, aws_secret_access_key, region):
+        """
+        Check the credentials and make them the ones of client `sid`. Returns their boto3.Session.
+        Raises botocore errors when they are not valid, the previous login of `sid` stays then.
+        """
+        key = (credentials_digest(aws_access_key_id, aws_secret_access_key), region)
+        with self._lock:
+            session = self._sessions.get(key)
+        if session == None:
+            session = boto3.Session(aws_access_key_id=aws_access_key_id, aws_secret_access_key=aws_secret_access_key,
+                                    region_name=region)
+        identity = self.identity(session)
+        with self._lock:
+            session = self._sessions.setdefault(key, session)
+            self._logins[sid] = key
+        logger.info(f"Client '{sid}' logged in as '{identity['Arn']}' in region '{region}'.")
+        return session
+
+    def session(self, sid):
+        """
+        The boto3.Session of the last login of client `sid`, None if it has not logged in.
+        """
+        with self._lock:
+            key = self._logins.get(sid)
+            return self._sessions.get(key) if key != None else None
+
+    def forget(self, sid):
+        """
+        Client `sid` is gone: drop its login, and its session unless another client uses it.
+        Once no client uses its credentials, their cached AWS clients and idle waiters are dropped too.
+        Jobs it started keep the session they were given.
+        """
+        with self._lock:
+            key = self._logins.pop(sid, None)
+            if key == None or key in self._logins.values():
+                return
+            session = self._sessions.pop(key, None)
+            unused = all(digest != key[0] for digest, _ in self._logins.values())
+        if session != None:
+            waiters.forget(session)
+            if unused:
+                aws_clients.forget(session)
+
+
+credential_store = CredentialStore()
+
+
+def login(aws_access_key_id, aws_secret_access_key, region, sid=None):
+    """
+    Log the Socket.IO client `sid` in (see CredentialStore.login) and tell it how it went. Returns the session.
+    """
     try:
-        client = boto3.client('ec2')
-        client.describe_instances()
+        session = credential_store.login(sid, aws_access_key_id, aws_secret_access_key, region)
         emit('output', 'Login success!')
-    except:
+        return session
+    except (botocore.exceptions.BotoCoreError, botocore.exceptions.ClientError):
         emit('output', 'Something went wrong with login. Please check credentials!')
         raise
 
@@ -37,4 +120,4 @@ def main():
     logger.warning("Not from here! 🎄")
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -1,12 +1,20 @@
 import logging
 from datetime import date, datetime
 import botocore
-import boto3
+from utils.aws_clients import get_client
+from utils.waiters import wait_for
 
 # logger config
 logger = logging.getLogger()
 logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
 
+# 'Project' tag of resources created without a project name
+DEFAULT_PROJECT = 'DevOps Tools Pack'
+
+def _tags(name, project):
+    # Every resource of a stack carries its project, utils.inventory finds them by this tag
+    return [{'Key': 'Project', 'Value': project}, {'Key': 'Name', 'Value': name}]
+
 def json_datetime_serializer(obj):
     """
     Helper method to serialize datetime fields
@@ -15,11 +23,11 @@ def json_datetime_serializer(obj):
         return obj.isoformat()
     raise TypeError("Type %s not serializable" % type(obj))
 
-def create_vpc(name, cidr_block):
+def create_vpc(name, cidr_block, project=DEFAULT_PROJECT):
     """
     CidrBlock='10.0.0.0/26'
     """
-    client = boto3.client('ec2')
+    client = get_client('ec2')
     try:
         vpc = client.create_vpc(
             CidrBlock=cidr_block,
@@ -28,24 +36,14 @@ def create_vpc(name, cidr_block):
             TagSpecifications=[
                 {
                     'ResourceType': 'vpc',
-                    'Tags': [
-                        {
-                            'Key': 'Project',
-                            'Value': 'DevOps Tools Pack'
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': name
-                        },
-                    ]
+                    'Tags': _tags(name, project)
                 },
             ]
         )
         
         
         # wait for the VPC to become available
-        waiter = client.get_waiter('vpc_available')
-        waiter.wait(VpcIds=[vpc['Vpc']['VpcId']])
+        wait_for('vpc', vpc['Vpc']['VpcId']).result()
 
         # enable DNS support in the VPC
         client.modify_vpc_attribute(VpcId=vpc['Vpc']['VpcId'], EnableDnsSupport={'Value': True})
@@ -59,28 +57,19 @@ def create_vpc(name, cidr_block):
             logger.exception("Unexpected error: ", error)
             raise
 
-def create_subnet(name, vpc_id, availability_zone, cidr_block):
+def create_subnet(name, vpc_id, availability_zone, cidr_block, project=DEFAULT_PROJECT):
     """
     AvailabilityZone='eu-central-1a',
     AvailabilityZoneId='euc1-az2',
     CidrBlock='10.0.0.0/28',
     """
-    client = boto3.client('ec2')
+    client = get_client('ec2')
     response = client.create_subnet(
         VpcId=vpc_id,
         TagSpecifications=[
             {
                 'ResourceType': 'subnet',
-                'Tags': [
-                    {
-                        'Key': 'Project',
-                        'Value': 'DevOps Tools Pack'
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': name
-                    },
-                ]
+                'Tags': _tags(name, project)
             },
         ],
         AvailabilityZone=availability_zone,
@@ -89,23 +78,14 @@ def create_subnet(name, vpc_id, availability_zone, cidr_block):
     )
     return response
  
-def create_internet_gateway(name):
-    client = boto3.client('ec2')
+def create_internet_gateway(name, project=DEFAULT_PROJECT):
+    client = get_client('ec2')
     try:
         response = client.create_internet_gateway(
             TagSpecifications=[
                 {
                     'ResourceType': 'internet-gateway',
-                    'Tags': [
-                        {
-                            'Key': 'Project',
-                            'Value': 'DevOps Tools Pack'
-                        },
-                        {
-                            'Key': 'Name',
-                            'Value': name
-                        },
-                    ]
+                    'Tags': _tags(name, project)
                 },
             ],
         )
@@ -118,30 +98,46 @@ def create_internet_gateway(name):
             logger.exception("Unexpected error: ", error)
             raise
   
-def create_route_table(name, vpc_id):
-    client = boto3.client('ec2')
+def attach_internet_gateway(internet_gateway_id, vpc_id):
+    client = get_client('ec2')
+    client.attach_internet_gateway(InternetGatewayId=internet_gateway_id, VpcId=vpc_id)
+    logger.info(f"Internet Gateway '{internet_gateway_id}' attached to VPC '{vpc_id}'")
+
+def allocate_elastic_ip(name, project=DEFAULT_PROJECT):
+    client = get_client('ec2')
+    response = client.allocate_address(
+        Domain='vpc',
+        TagSpecifications=[{'ResourceType': 'elastic-ip', 'Tags': _tags(name, project)}]
+    )
+    return response
+
+def create_nat_gateway(name, subnet_id, allocation_id, project=DEFAULT_PROJECT):
+    client = get_client('ec2')
+    response = client.create_nat_gateway(
+        SubnetId=subnet_id,
+        AllocationId=allocation_id,
+        TagSpecifications=[{'ResourceType': 'natgateway', 'Tags': _tags(name, project)}]
+    )
+    return response
+
+def wait_nat_gateway_available(nat_gateway_id):
+    return wait_for('nat_gateway', nat_gateway_id).result()
+
+def create_route_table(name, vpc_id, project=DEFAULT_PROJECT):
+    client = get_client('ec2')
     response = client.create_route_table(
         VpcId=vpc_id,
         TagSpecifications=[
             {
                 'ResourceType': 'route-table',
-                'Tags': [
-                    {
-                        'Key': 'Project',
-                        'Value': 'DevOps Tools Pack'
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': name
-                    },
-                ]
+                'Tags': _tags(name, project)
             },
         ]
     )
     return response
 
 def create_route(route_table, destination, target, target_type):
-    client = boto3.client('ec2')
+    client = get_client('ec2')
     response = None
     match target_type:
         case "VPCEndpoint":
@@ -167,13 +163,26 @@ def create_route(route_table, destination, target, target_type):
                 logger.info(f"Create route - Destination: '{destination}' - Target: NatGateway '{target}'")
     return response
 
-def create_vpc_endpoint(name, vpc_id, service_name, route_tables=[], subnets=[], security_groups=[]):
+def replace_route(route_table, destination, target, target_type):
+    # Point an existing route to another target, e.g. a NAT Gateway that was created again
+    client = get_client('ec2')
+    target_key = {"InternetGateway": 'GatewayId', "NatGateway": 'NatGatewayId'}[target_type]
+    client.replace_route(RouteTableId=route_table, DestinationCidrBlock=destination, **{target_key: target})
+    logger.info(f"Replace route - Destination: '{destination}' - Target: {target_type} '{target}'")
+
+def associate_route_table(route_table, subnet_id):
+    client = get_client('ec2')
+    response = client.associate_route_table(RouteTableId=route_table, SubnetId=subnet_id)
+    logger.info(f"Route Table '{route_table}' associated with subnet '{subnet_id}'")
+    return response
+
+def create_vpc_endpoint(name, vpc_id, service_name, route_tables=[], subnets=[], security_groups=[], project=DEFAULT_PROJECT):
     """
     VpcId='vpc-0111ac0194d93a36b',
     ServiceName='com.amazonaws.eu-central-1.s3',
     !! Parameters: route_tables, subnets, security_groups - are type list
     """
-    client = boto3.client('ec2')
+    client = get_client('ec2')
     response = client.create_vpc_endpoint(
         VpcEndpointType='Gateway',
         VpcId=vpc_id,
@@ -184,21 +193,16 @@ def create_vpc_endpoint(name, vpc_id, service_name, route_tables=[], subnets=[],
         TagSpecifications=[
             {
                 'ResourceType': 'vpc-endpoint',
-                'Tags': [
-                    {
-                        'Key': 'Project',
-                        'Value': 'DevOps Tools Pack'
-                    },
-                    {
-                        'Key': 'Name',
-                        'Value': name
-                    },
-                ]
+                'Tags': _tags(name, project)
             },
         ]
     )
     return response
 
+def add_vpc_endpoint_route_tables(vpc_endpoint_id, route_tables):
+    client = get_client('ec2')
+    client.modify_vpc_endpoint(VpcEndpointId=vpc_endpoint_id, AddRouteTableIds=route_tables)
+
 def get_new_vpc():
     logger.error("Please refer to main app, VPC main function isn't callable.")
 
@@ -0,0 +1,150 @@
+import contextvars
+import glob
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import Future
+from utils.aws_clients import current_session, get_client
+from utils.waiters import wait_for
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Golden images carry the recipe digest in this tag, the AMI they were built from in BASE_TAG
+RECIPE_TAG = 'dotp:recipe'
+BASE_TAG = 'dotp:base-image'
+DOCKER_INSTALL = "./resources/ubuntu/docker_install.sh"
+COMPOSE_FILES = "./resources/*/docker-compose.yaml"
+# How long the bake instance may take to install docker, pull the images and stop
+BAKE_TIMEOUT = 1800
+# The AMIs of the EC2 templates (functions_ec2.get_ec2_custom_template) are the ones of TEMPLATE_REGION,
+# elsewhere the same Ubuntu release is read from the public SSM parameter Canonical keeps up to date
+TEMPLATE_REGION = 'eu-central-1'
+# Golden images are named <IMAGE_PREFIX>-<digest>, their bake instance <IMAGE_PREFIX>-<digest>-builder
+IMAGE_PREFIX = 'dotp-golden'
+UBUNTU_IMAGE_PARAMETER = '/aws/service/canonical/ubuntu/server/22.04/stable/current/amd64/hvm/ebs-gp2/ami-id'
+
+_lock = threading.Lock()
+_bakes = {}
+
+
+def regional_image(image_id):
+    """
+    `image_id` (an AMI of TEMPLATE_REGION) or the current Ubuntu 22.04 AMI of the region of the current session.
+    """
+    # No SSM client is built for the template region, it would only be used for its region name
+    if current_session().region_name == TEMPLATE_REGION:
+        return image_id
+    return get_client('ssm').get_parameter(Name=UBUNTU_IMAGE_PARAMETER)['Parameter']['Value']
+
+
+def recipe_files():
+    return [DOCKER_INSTALL] + sorted(glob.glob(COMPOSE_FILES))
+
+
+def recipe_digest(base_image_id, files=None):
+    """
+    sha256 of the base AMI and of the bootstrap files (docker_install.sh + every docker-compose.yaml).
+    Any change to one of them gives a new digest, so a stale image is never used.
+    """
+    digest = hashlib.sha256(base_image_id.encode() + b'\0')
+    for path in files or recipe_files():
+        with open(path, 'rb') as f:
+            content = f.read()
+        digest.update(f"{os.path.relpath(path)}\0{hashlib.sha256(content).hexdigest()}\n".encode())
+    return digest.hexdigest()
+
+
+def find_golden_image(digest, states=('available',)):
+    """
+    Newest image of this account tagged with the recipe `digest` in one of `states`, None if there is none.
+    """
+    client = get_client('ec2')
+    images = []
+    for page in client.get_paginator('describe_images').paginate(
+            Owners=['self'], Filters=[{'Name': f'tag:{RECIPE_TAG}', 'Values': [digest]},
+                                      {'Name': 'state', 'Values': list(states)}]):
+        images += page['Images']
+    if not images:
+        return None
+    return max(images, key=lambda image: image['CreationDate'])
+
+
+def bake_user_data(files=None):
+    """
+    User data of the bake instance: installs docker, pulls the images of every compose file,
+    then stops the instance. It stays running when a command fails, so the bake times out instead
+    of imaging a broken host.
+    """
+    files = files or recipe_files()
+    paths = [os.path.relpath(path) for path in files]
+    script = ["#!/bin/bash", "set -euo pipefail", "mkdir -p /opt/dotp && cd /opt/dotp"]
+    for path, relative in zip(files, paths):
+        with open(path) as f:
+            content = f.read()
+        script += [f"mkdir -p $(dirname {relative})",
+                   f"cat > {relative} <<'DOTP_EOF'", content.rstrip('\n'), "DOTP_EOF"]
+    script.append(f"/bin/bash {paths[0]}")
+    script += [f"docker-compose -f {relative} pull" for relative in paths[1:]]
+    script += ["usermod -a -G docker ubuntu",
+               "cd / && rm -rf /opt/dotp",
+               "cloud-init clean --logs",
+               "shutdown -h now"]
+    return "\n".join(script) + "\n"
+
+
+def bake_golden_image(digest, base_image_id, instance_type, subnet_id, security_group, project):
+    """
+    Build a golden image: launch `base_image_id` with the bake user data in `subnet_id` (it needs internet access),
+    wait for it to stop, image it with the recipe tags and terminate it. Returns the new ImageId.
+    The bake instance is tagged with `project`, the project owning `subnet_id`, so its teardown finds it.
+    """
+    client = get_client('ec2')
+    name = f"{IMAGE_PREFIX}-{digest[:12]}"
+    instance_id = client.run_instances(
+        ImageId=base_image_id, InstanceType=instance_type, SubnetId=subnet_id, SecurityGroupIds=[security_group],
+        MinCount=1, MaxCount=1, UserData=bake_user_data(), InstanceInitiatedShutdownBehavior='stop',
+        TagSpecifications=[{'ResourceType': 'instance', 'Tags': [{'Key': 'Name', 'Value': name + "-builder"},
+                                                                 {'Key': 'Project', 'Value': project}]}]
+    )['Instances'][0]['InstanceId']
+    logger.info(f"Baking golden image '{name}' on instance '{instance_id}'...")
+    try:
+        wait_for('instance', instance_id, 'stopped', timeout=BAKE_TIMEOUT).result()
+        image_id = client.create_image(
+            InstanceId=instance_id, Name=name, Description=f"DevOps Tools Pack golden image, recipe {digest}",
+            TagSpecifications=[{'ResourceType': 'image', 'Tags': [{'Key': 'Name', 'Value': name},
+                                                                  {'Key': RECIPE_TAG, 'Value': digest},
+                                                                  {'Key': BASE_TAG, 'Value': base_image_id}]}]
+        )['ImageId']
+        wait_for('image', image_id, timeout=BAKE_TIMEOUT).result()
+        logger.info(f"Golden image '{name}' ready. ID '{image_id}'")
+        return image_id
+    finally:
+        client.terminate_instances(InstanceIds=[instance_id])
+
+
+def bake_in_background(digest, base_image_id, instance_type, subnet_id, security_group, project):
+    """
+    Start bake_golden_image on a daemon thread (with the caller's AWS session) unless a bake of `digest`
+    runs already in this process or an image with that digest is pending. Returns the bake Future or None.
+    """
+    with _lock:
+        future = _bakes.get(digest)
+        if future != None and not future.done():
+            return future
+        if find_golden_image(digest, states=('pending',)) != None:
+            logger.info(f"Golden image for recipe '{digest[:12]}' is pending already.")
+            return None
+        future = _bakes[digest] = Future()
+
+    def bake():
+        try:
+            future.set_result(bake_golden_image(digest, base_image_id, instance_type, subnet_id, security_group, project))
+        except Exception as e:
+            logger.error(f"Baking golden image for recipe '{digest[:12]}' failed: {e}")
+            future.set_exception(e)
+
+    threading.Thread(target=contextvars.copy_context().run, args=(bake,), name=f"bake-{digest[:12]}", daemon=True).start()
+    return future
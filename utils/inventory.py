@@ -0,0 +1,199 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+from utils.aws_clients import current_session, get_client
+from utils.engine import Step, run_steps
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Tag carrying the project name on every resource of a stack (see functions_vpc._tags)
+PROJECT_TAG = 'Project'
+# The index of every project is also kept on disk, one JSON file per project and region: <project>-<region>.json
+INVENTORY_DIR = os.environ.get('DOTP_INVENTORY_DIR', './inventory')
+# Seconds the resources of one kind are served from the index before they are described again
+INVENTORY_TTL = float(os.environ.get('DOTP_INVENTORY_TTL', 300))
+
+# kind -> service, describe operation, result key, id key
+RESOURCES = {
+    'vpcs': ('ec2', 'describe_vpcs', 'Vpcs', 'VpcId'),
+    'subnets': ('ec2', 'describe_subnets', 'Subnets', 'SubnetId'),
+    'internet_gateways': ('ec2', 'describe_internet_gateways', 'InternetGateways', 'InternetGatewayId'),
+    'nat_gateways': ('ec2', 'describe_nat_gateways', 'NatGateways', 'NatGatewayId'),
+    'addresses': ('ec2', 'describe_addresses', 'Addresses', 'AllocationId'),
+    'route_tables': ('ec2', 'describe_route_tables', 'RouteTables', 'RouteTableId'),
+    'vpc_endpoints': ('ec2', 'describe_vpc_endpoints', 'VpcEndpoints', 'VpcEndpointId'),
+    'security_groups': ('ec2', 'describe_security_groups', 'SecurityGroups', 'GroupId'),
+    'instances': ('ec2', 'describe_instances', 'Reservations', 'InstanceId'),
+    'ecs_clusters': ('ecs', 'describe_clusters', 'clusters', 'clusterArn'),
+}
+# Resources in these states are left out, they are gone or on their way out
+GONE_STATES = ('failed', 'deleting', 'deleted', 'shutting-down', 'terminated', 'inactive', 'deprovisioning')
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def _serializer(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    raise TypeError("Type %s not serializable" % type(obj))
+
+
+def tags(resource):
+    # EC2 tags are {'Key', 'Value'}, ECS tags {'key', 'value'}
+    return {tag.get('Key', tag.get('key')): tag.get('Value', tag.get('value'))
+            for tag in resource.get('Tags', resource.get('tags', []))}
+
+
+def state(resource):
+    value = resource.get('State', resource.get('status'))
+    if isinstance(value, dict):
+        return value['Name']
+    return value.lower() if value != None else None
+
+
+def _describe_ecs_clusters(project):
+    # ListClusters has no tag filter, the tags come with DescribeClusters (up to 100 clusters per call)
+    client = get_client('ecs')
+    arns = []
+    for page in client.get_paginator('list_clusters').paginate():
+        arns += page['clusterArns']
+    clusters = []
+    for start in range(0, len(arns), 100):
+        clusters += client.describe_clusters(clusters=arns[start:start + 100], include=['TAGS'])['clusters']
+    return [cluster for cluster in clusters if tags(cluster).get(PROJECT_TAG) == project]
+
+
+def _describe(kind, project):
+    service, operation, result_key, _ = RESOURCES[kind]
+    if service == 'ecs':
+        return [resource for resource in _describe_ecs_clusters(project) if state(resource) not in GONE_STATES]
+
+    client = get_client(service)
+    tag_filter = [{'Name': f"tag:{PROJECT_TAG}", 'Values': [project]}]
+    # DescribeNatGateways names its filter parameter 'Filter'
+    params = {'Filter' if kind == 'nat_gateways' else 'Filters': tag_filter}
+    if client.can_paginate(operation):
+        pages = client.get_paginator(operation).paginate(**params)
+    else:
+        pages = [getattr(client, operation)(**params)]
+    resources = []
+    for page in pages:
+        for resource in page[result_key]:
+            resources += resource['Instances'] if kind == 'instances' else [resource]
+    # The tag is checked again: retag and teardown act on this list, it must hold nothing of another project
+    return [resource for resource in resources
+            if state(resource) not in GONE_STATES and tags(resource).get(PROJECT_TAG) == project]
+
+
+def discover(project, kinds=None, max_workers=8):
+    """
+    Every live resource of `kinds` (default all of RESOURCES) tagged with `project`: kind -> list of descriptions.
+    One paginated, tag-filtered describe per kind, all of them at once.
+    """
+    kinds = list(kinds or RESOURCES)
+    logger.info(f"Discovering the {', '.join(kinds)} of project '{project}'...")
+    steps = [Step(f"inventory/{kind}", lambda kind=kind: _describe(kind, project), provides=[kind]) for kind in kinds]
+    return run_steps(steps, max_workers=max_workers)
+
+
+def resource_id(kind, resource):
+    return resource[RESOURCES[kind][3]]
+
+
+class Index:
+    """
+    Copy of the live resources of one project (see discover) shared by the status views, teardown and reconcile.
+    Each kind is described again once it is older than `ttl` seconds, the other kinds are served from memory.
+    The index is saved to disk after every refresh, so a restart picks it up where it was.
+    Whatever creates or deletes resources of the project calls invalidate() afterwards.
+        account - identifies the credentials the index was built with, an index on disk of other credentials is dropped
+    """
+
+    def __init__(self, project, region_name, account='', ttl=INVENTORY_TTL, directory=INVENTORY_DIR):
+        self.project = project
+        self.region_name = region_name
+        self.account = account
+        self.ttl = ttl
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]', '_', f"{project}-{region_name}") + ".json")
+        self._lock = threading.Lock()
+        # One refresh at a time, concurrent readers wait for it instead of describing the same kinds
+        self._refresh_lock = threading.Lock()
+        self.resources = {}
+        self.fetched = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            logger.warning(f"Inventory '{self.path}' is unreadable, starting over.")
+            return
+        if saved.get('account') != self.account:
+            return
+        self.resources = saved['resources']
+        self.fetched = saved['fetched']
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        # Written aside and renamed, a reader never sees half of it
+        with open(self.path + ".tmp", 'w') as f:
+            json.dump({'account': self.account, 'resources': self.resources, 'fetched': self.fetched}, f,
+                      default=_serializer)
+        os.replace(self.path + ".tmp", self.path)
+
+    def get(self, kinds=None, max_age=None):
+        """
+        Resources of `kinds` (default all of RESOURCES): kind -> list of descriptions.
+        Only the kinds older than `max_age` seconds (default the index ttl) are described again.
+        """
+        kinds = list(kinds or RESOURCES)
+        max_age = self.ttl if max_age == None else max_age
+        with self._refresh_lock:
+            stale = [kind for kind in kinds if time.time() - self.fetched.get(kind, 0) > max_age]
+            if stale:
+                fresh = discover(self.project, stale)
+                now = time.time()
+                with self._lock:
+                    for kind in stale:
+                        # Round trip so what is served now matches what a restart reads back
+                        self.resources[kind] = json.loads(json.dumps(fresh[kind], default=_serializer))
+                        self.fetched[kind] = now
+                    self._save()
+        with self._lock:
+            return {kind: list(self.resources.get(kind, [])) for kind in kinds}
+
+    def invalidate(self, kinds=None):
+        """
+        The resources of `kinds` (default all) changed, the next get() describes them again.
+        """
+        with self._lock:
+            for kind in kinds or RESOURCES:
+                self.fetched.pop(kind, None)
+            if os.path.isfile(self.path):
+                self._save()
+
+
+def project_index(project):
+    """
+    The Index of `project` for the current session (see aws_clients.use_session), one per project, region and credentials.
+    """
+    session = current_session()
+    credentials = session.get_credentials()
+    # Only a digest of the access key is kept, the index is saved to disk
+    account = hashlib.sha256(credentials.access_key.encode()).hexdigest()[:16] if credentials != None else ''
+    key = (project, session.region_name, account)
+    with _lock:
+        if key not in _indexes:
+            _indexes[key] = Index(project, session.region_name, account)
+        return _indexes[key]
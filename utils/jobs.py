@@ -0,0 +1,188 @@
+import contextvars
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from utils.engine import Cancelled
+from utils.output import use_emitter
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Seconds a finished job (and a batch whose jobs all finished) can still be looked up, then it is dropped
+RETENTION = float(os.environ.get('DOTP_JOB_RETENTION', 3600))
+
+
+class Job:
+    """
+    One background run. Messages and status changes go to the Socket.IO room `sid` (the requesting client).
+    """
+
+    def __init__(self, sid, name, emit):
+        self.id = uuid.uuid4().hex[:12]
+        self.sid = sid
+        self.name = name
+        self.status = 'queued'
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.cancel_event = threading.Event()
+        self.future = None
+        # What func returned, e.g. the endpoints of a stack
+        self.result = None
+        self.batch = None
+        self._emit = emit
+
+    def emit(self, event, data):
+        self._emit(event, data, to=self.sid)
+
+    def to_dict(self):
+        return {'job_id': self.id, 'name': self.name, 'status': self.status, 'error': self.error, 'result': self.result,
+                'created_at': self.created_at, 'started_at': self.started_at, 'finished_at': self.finished_at}
+
+
+class Batch:
+    """
+    Jobs submitted together, e.g. one stack per project and region. They share the JobManager queue with every
+    other job; each status change of one of them also sends the whole batch (to_dict) as 'batch_status'.
+    """
+
+    def __init__(self, sid):
+        self.id = uuid.uuid4().hex[:12]
+        self.sid = sid
+        self.jobs = []
+        self.created_at = time.time()
+
+    @property
+    def status(self):
+        statuses = {job.status for job in self.jobs}
+        if statuses & {'queued', 'running'}:
+            return 'running' if statuses - {'queued'} else 'queued'
+        if statuses == {'succeeded'} or statuses == {'cancelled'}:
+            return statuses.pop()
+        return 'failed'
+
+    def to_dict(self):
+        counts = {}
+        for job in self.jobs:
+            counts[job.status] = counts.get(job.status, 0) + 1
+        return {'batch_id': self.id, 'status': self.status, 'counts': counts, 'created_at': self.created_at,
+                'jobs': [job.to_dict() for job in self.jobs]}
+
+
+class JobManager:
+    """
+    Runs long jobs (e.g. create_dotp.run) on a thread pool so Socket.IO handlers return right away.
+        max_workers - how many jobs run at the same time, the others wait in the queue
+        emit        - socketio.emit, used to reach the client that started the job
+        retention   - seconds finished jobs and batches are kept, they are dropped when new jobs are queued
+    """
+
+    def __init__(self, max_workers, emit, retention=RETENTION):
+        self.max_workers = max_workers
+        self.retention = retention
+        self._emit = emit
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._batches = {}
+
+    def submit(self, sid, name, func, **kwargs):
+        """
+        Queue func(job, **kwargs) and return the Job. Every emit() inside func reaches the `sid` client.
+        """
+        job = Job(sid, name, self._emit)
+        self._submit(job, func, kwargs)
+        return job
+
+    def submit_batch(self, sid, items):
+        """
+        Queue one job per (name, func, kwargs) of `items` and return the Batch; they run like submit() ones.
+        """
+        batch = Batch(sid)
+        for name, func, kwargs in items:
+            job = Job(sid, name, self._emit)
+            job.batch = batch
+            batch.jobs.append(job)
+        with self._lock:
+            self._prune()
+            self._batches[batch.id] = batch
+        for job, (name, func, kwargs) in zip(batch.jobs, items):
+            self._submit(job, func, kwargs)
+        return batch
+
+    def _submit(self, job, func, kwargs):
+        with self._lock:
+            self._prune()
+            self._jobs[job.id] = job
+        self._set_status(job, 'queued')
+        context = contextvars.copy_context()
+        job.future = self._pool.submit(context.run, self._run, job, func, kwargs)
+
+    def _prune(self):
+        # Called with self._lock held
+        expired = time.time() - self.retention
+
+        def gone(job):
+            return job.finished_at != None and job.finished_at < expired
+
+        self._jobs = {job_id: job for job_id, job in self._jobs.items() if not gone(job)}
+        self._batches = {batch_id: batch for batch_id, batch in self._batches.items()
+                         if not all(gone(job) for job in batch.jobs)}
+
+    def _run(self, job, func, kwargs):
+        if job.cancel_event.is_set():
+            # Cancelled after the pool picked it up, future.cancel() in cancel() could not mark it
+            job.finished_at = time.time()
+            self._set_status(job, 'cancelled')
+            return
+        job.started_at = time.time()
+        self._set_status(job, 'running')
+        try:
+            with use_emitter(job.emit):
+                job.result = func(job, **kwargs)
+            status = 'cancelled' if job.cancel_event.is_set() else 'succeeded'
+        except Cancelled:
+            status = 'cancelled'
+        except Exception as e:
+            logger.exception(f"Job '{job.id}' failed.")
+            job.error = str(e)
+            status = 'failed'
+        job.finished_at = time.time()
+        self._set_status(job, status)
+
+    def _set_status(self, job, status):
+        job.status = status
+        logger.info(f"Job '{job.id}' ({job.name}) {status}.")
+        job.emit('job_status', job.to_dict())
+        if job.batch != None:
+            job.emit('batch_status', job.batch.to_dict())
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_batch(self, batch_id):
+        with self._lock:
+            return self._batches.get(batch_id)
+
+    def jobs(self, sid=None):
+        with self._lock:
+            return [job for job in self._jobs.values() if sid == None or job.sid == sid]
+
+    def cancel(self, job_id):
+        """
+        Ask a job to stop. Queued jobs never start, running ones stop before their next step.
+        """
+        job = self.get(job_id)
+        if job == None or job.status not in ('queued', 'running'):
+            return job
+        job.cancel_event.set()
+        if job.future != None and job.future.cancel():
+            job.finished_at = time.time()
+            self._set_status(job, 'cancelled')
+        return job
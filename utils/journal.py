@@ -0,0 +1,199 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from datetime import date, datetime
+from utils import tracing
+from utils.aws_clients import get_client
+from utils.engine import reuse
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# One JSON-lines file per project and region: <project>-<region>.jsonl
+JOURNAL_DIR = os.environ.get('DOTP_JOURNAL_DIR', './journal')
+
+# resource ID prefix -> describe operation, id filter, result key, id key
+RESOURCES = {
+    'vpc': ('describe_vpcs', 'vpc-id', 'Vpcs', 'VpcId'),
+    'subnet': ('describe_subnets', 'subnet-id', 'Subnets', 'SubnetId'),
+    'igw': ('describe_internet_gateways', 'internet-gateway-id', 'InternetGateways', 'InternetGatewayId'),
+    'nat': ('describe_nat_gateways', 'nat-gateway-id', 'NatGateways', 'NatGatewayId'),
+    'rtb': ('describe_route_tables', 'route-table-id', 'RouteTables', 'RouteTableId'),
+    'vpce': ('describe_vpc_endpoints', 'vpc-endpoint-id', 'VpcEndpoints', 'VpcEndpointId'),
+    'sg': ('describe_security_groups', 'group-id', 'SecurityGroups', 'GroupId'),
+    'eipalloc': ('describe_addresses', 'allocation-id', 'Addresses', 'AllocationId'),
+    'i': ('describe_instances', 'instance-id', 'Reservations', 'InstanceId'),
+}
+# A journaled resource in one of these states has to be created again
+GONE_STATES = ('failed', 'deleting', 'deleted', 'shutting-down', 'terminated')
+_RESOURCE_ID = re.compile(r'^(' + '|'.join(RESOURCES) + r')-[0-9a-f]{8,17}$')
+
+
+def _serializer(obj):
+    if isinstance(obj, (datetime, date)):
+        return obj.isoformat()
+    # e.g. remote_exec.CommandResult, only the fact that the step ran matters on resume
+    return str(obj)
+
+
+def resource_ids(value):
+    """
+    Every ID of a RESOURCES type found in `value` (AWS responses, lists of them or plain IDs).
+    """
+    if isinstance(value, str):
+        return {value} if _RESOURCE_ID.match(value) else set()
+    if isinstance(value, dict):
+        value = list(value.values())
+    if isinstance(value, (list, tuple, set)):
+        return set().union(*(resource_ids(item) for item in value))
+    return set()
+
+
+def existing_resources(ids):
+    """
+    The subset of `ids` that still exists and is not on its way out, one describe per resource type.
+    """
+    by_type = {}
+    for resource_id in ids:
+        by_type.setdefault(resource_id.rsplit('-', 1)[0], []).append(resource_id)
+
+    client = get_client('ec2')
+    existing = set()
+    for resource_type, type_ids in by_type.items():
+        operation, id_filter, result_key, id_key = RESOURCES[resource_type]
+        params = {'Filters': [{'Name': id_filter, 'Values': type_ids}]}
+        if client.can_paginate(operation):
+            pages = client.get_paginator(operation).paginate(**params)
+        else:
+            pages = [getattr(client, operation)(**params)]
+        for page in pages:
+            for resource in page[result_key]:
+                for item in (resource['Instances'] if resource_type == 'i' else [resource]):
+                    state = item.get('State')
+                    if isinstance(state, dict):
+                        state = state['Name']
+                    if state == None or state.lower() not in GONE_STATES:
+                        existing.add(item[id_key])
+    return existing
+
+
+class Journal:
+    """
+    Append-only record of a project's run: the outputs of every completed step, AWS responses included.
+    A failed or cancelled run leaves it behind, the next run of the same project resumes from it;
+    finish() removes it once the stack is up.
+    Entries are one JSON object per line:
+        {"event": "step", "step": <name>, "outputs": {...}, "time": <epoch>}
+        {"event": "discard", "steps": [<name>, ...], "time": <epoch>}
+    """
+
+    def __init__(self, project, region_name, directory=JOURNAL_DIR):
+        self.project = project
+        self.region_name = region_name
+        self.path = os.path.join(directory, re.sub(r'[^\w.-]', '_', f"{project}-{region_name}") + ".jsonl")
+        self._lock = threading.Lock()
+        self.completed = self._load()
+
+    def _load(self):
+        completed = {}
+        if not os.path.isfile(self.path):
+            return completed
+        with open(self.path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # Torn last line of a run killed while writing it
+                    logger.warning(f"Journal '{self.path}': ignoring unreadable entry.")
+                    break
+                if entry['event'] == 'step':
+                    completed[entry['step']] = entry['outputs']
+                elif entry['event'] == 'discard':
+                    for name in entry['steps']:
+                        completed.pop(name, None)
+        return completed
+
+    def _append(self, entry):
+        entry['time'] = time.time()
+        line = json.dumps(entry, default=_serializer) + "\n"
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            # Step outputs hold generated passwords
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o600)
+            with os.fdopen(fd, 'a') as f:
+                f.write(line)
+                f.flush()
+                os.fsync(f.fileno())
+
+    def record(self, step_name, outputs):
+        outputs = {key: {k: v for k, v in value.items() if k != 'ResponseMetadata'} if isinstance(value, dict) else value
+                   for key, value in outputs.items()}
+        # Round trip so the in-memory copy matches what a later run reads back
+        outputs = json.loads(json.dumps(outputs, default=_serializer))
+        self._append({'event': 'step', 'step': step_name, 'outputs': outputs})
+        self.completed[step_name] = outputs
+
+    def discard(self, step_names):
+        step_names = [name for name in step_names if name in self.completed]
+        if step_names:
+            self._append({'event': 'discard', 'steps': step_names})
+            for name in step_names:
+                self.completed.pop(name)
+
+    def on_complete(self, step, context, elapsed):
+        """
+        engine.run_steps callback journaling the outputs of every finished step.
+        """
+        self.record(step.name, {key: context[key] for key in step.provides})
+
+    def exists(self, value):
+        """
+        True when every resource ID in `value` still exists.
+        """
+        ids = resource_ids(value)
+        return ids <= existing_resources(ids)
+
+    def resume(self, steps, rerun=(), checks=None):
+        """
+        Split `steps` into the journaled ones that can be reused and the ones left to run.
+        A journaled step is reused when every resource in its outputs still exists,
+        `checks[step name](outputs)` (if any) returns True and every step it requires values from is reused too;
+        steps named in `rerun` always run again, and so do the steps depending on them.
+        Returns (context with the reused outputs, steps to run) for engine.run_steps.
+        """
+        checks = checks or {}
+        candidates = {step.name for step in steps
+                      if step.name in self.completed and step.name not in rerun
+                      and set(step.provides) <= set(self.completed[step.name])}
+        if not candidates:
+            return {}, list(steps)
+
+        with tracing.span("journal", 'internal', steps=len(candidates)):
+            ids = set().union(*(resource_ids(self.completed[name]) for name in candidates))
+            existing = existing_resources(ids)
+            valid = {name: self.completed[name] for name in candidates
+                     if resource_ids(self.completed[name]) <= existing
+                     and (name not in checks or checks[name](self.completed[name]))}
+        context, remaining = reuse(steps, valid)
+
+        remaining_names = {step.name for step in remaining}
+        missing = sorted(candidates & remaining_names)
+        if missing:
+            logger.info(f"Journal: {len(missing)} completed step(s) run again, their resources are gone "
+                        f"or depend on steps that run again: {', '.join(missing)}")
+        self.discard(sorted(remaining_names))
+        logger.info(f"Journal: resuming '{self.project}', {len(steps) - len(remaining)} step(s) reused.")
+        return context, remaining
+
+    def finish(self):
+        """
+        The run completed, the next run of the project starts over.
+        """
+        with self._lock:
+            if os.path.isfile(self.path):
+                os.remove(self.path)
+        self.completed = {}
@@ -0,0 +1,86 @@
+import functools
+import logging
+import threading
+import botocore
+from utils.aws_clients import get_client
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Existence checks with direct gets or server side filters.
+# Found resources are remembered until clear_cache() (called at the start of every run),
+# misses are always asked again because the caller usually creates the resource right after.
+_lock = threading.Lock()
+_cache = {}
+
+
+def clear_cache():
+    with _lock:
+        _cache.clear()
+
+
+def _memoized(service):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args):
+            # The client is cached per credentials and region, so it also scopes the cache entry
+            key = (func.__name__, get_client(service), args)
+            with _lock:
+                if key in _cache:
+                    return _cache[key]
+            result = func(*args)
+            if result != None:
+                with _lock:
+                    _cache[key] = result
+            return result
+        return wrapper
+    return decorator
+
+
+@_memoized('ec2')
+def find_security_group(group_name, vpc_id):
+    client = get_client('ec2')
+    for page in client.get_paginator('describe_security_groups').paginate(
+            Filters=[{'Name': 'group-name', 'Values': [group_name]}, {'Name': 'vpc-id', 'Values': [vpc_id]}]):
+        for security_group in page['SecurityGroups']:
+            return security_group
+    return None
+
+
+@_memoized('ec2')
+def find_subnet(subnet_id):
+    client = get_client('ec2')
+    try:
+        return client.describe_subnets(SubnetIds=[subnet_id])['Subnets'][0]
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'InvalidSubnetID.NotFound':
+            return None
+        raise
+
+
+@_memoized('ec2')
+def find_key_pair(key_name):
+    client = get_client('ec2')
+    key_pairs = client.describe_key_pairs(Filters=[{'Name': 'key-name', 'Values': [key_name]}])['KeyPairs']
+    return key_pairs[0] if key_pairs else None
+
+
+@_memoized('iam')
+def find_role(role_name):
+    client = get_client('iam')
+    try:
+        return client.get_role(RoleName=role_name)['Role']
+    except botocore.exceptions.ClientError as error:
+        if error.response['Error']['Code'] == 'NoSuchEntity':
+            return None
+        raise
+
+
+@_memoized('ecs')
+def find_ecs_cluster(cluster_name):
+    client = get_client('ecs')
+    for cluster in client.describe_clusters(clusters=[cluster_name])['clusters']:
+        if cluster['status'] != 'INACTIVE':
+            return cluster
+    return None
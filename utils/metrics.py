@@ -0,0 +1,177 @@
+import logging
+import threading
+import time
+from utils import rate_limiter
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Upper bounds (seconds) of the AWS call latency histogram
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels):
+        with self._lock:
+            return self._values.get(labels, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f"{self.name}{_labels(self.labels, labels)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, *labels):
+        with self._lock:
+            counts, total, count = self._values.get(labels, ([0] * len(self.buckets), 0.0, 0))
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+            self._values[labels] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total, count) in sorted(self._values.items()):
+                for bound, bucket in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{_labels(self.labels, labels, [('le', bound)])} {bucket}")
+                lines.append(f"{self.name}_bucket{_labels(self.labels, labels, [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{_labels(self.labels, labels)} {total}")
+                lines.append(f"{self.name}_count{_labels(self.labels, labels)} {count}")
+        return lines
+
+
+api_calls = Counter('dotp_aws_api_calls_total', "AWS API calls, a retried call counts once.",
+                    ('service', 'operation', 'region'))
+api_latency = Histogram('dotp_aws_api_call_duration_seconds', "AWS API call latency, retries and backoff included.",
+                        ('service', 'operation'))
+api_retries = Counter('dotp_aws_api_retries_total', "Retried AWS API attempts.", ('service', 'operation'))
+api_errors = Counter('dotp_aws_api_errors_total', "Failed AWS API attempts by error code, throttling included.",
+                     ('service', 'operation', 'code'))
+api_throttles = Counter('dotp_aws_api_throttles_total', "Throttled AWS API attempts.", ('service', 'operation', 'region'))
+
+_metrics = [api_calls, api_latency, api_retries, api_errors, api_throttles]
+_collectors = []
+
+
+def register_collector(collector):
+    """
+    `collector()` is called on every scrape and returns [(name, type, help, [(labels dict, value)])],
+    e.g. for values owned by another module such as the job queue.
+    """
+    _collectors.append(collector)
+
+
+def render():
+    """
+    Every metric in the Prometheus text exposition format.
+    """
+    lines = []
+    for metric in _metrics:
+        lines += metric.render()
+    for collector in _collectors:
+        try:
+            families = collector()
+        except Exception as e:
+            logger.warning(f"Metrics collector {collector} failed: {e}")
+            continue
+        for name, kind, help, samples in families:
+            lines += [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+            lines += [f"{name}{_labels(labels.keys(), labels.values())} {value}" for labels, value in samples]
+    return "\n".join(lines) + "\n"
+
+
+def _rate_limiter_metrics():
+    samples = {'dotp_aws_rate_limiter_wait_seconds_total': [], 'dotp_aws_rate_limiter_concurrency_limit': []}
+    for (account, region_name, service, kind), item in sorted(rate_limiter.stats().items(), key=lambda x: str(x[0])):
+        labels = {'service': service, 'category': kind, 'region': region_name}
+        samples['dotp_aws_rate_limiter_wait_seconds_total'].append((labels, item['wait_seconds']))
+        samples['dotp_aws_rate_limiter_concurrency_limit'].append((labels, item['concurrency_limit']))
+    return [('dotp_aws_rate_limiter_wait_seconds_total', 'counter', "Time AWS calls waited for the client side rate limiter.",
+             samples['dotp_aws_rate_limiter_wait_seconds_total']),
+            ('dotp_aws_rate_limiter_concurrency_limit', 'gauge', "Current adaptive concurrency limit.",
+             samples['dotp_aws_rate_limiter_concurrency_limit'])]
+
+
+register_collector(_rate_limiter_metrics)
+
+
+def _error_code(response):
+    if response == None:
+        return None
+    http_response, parsed = response
+    code = (parsed or {}).get('Error', {}).get('Code')
+    if code == None and http_response != None and http_response.status_code >= 400:
+        code = str(http_response.status_code)
+    return code
+
+
+def install(client, account):
+    """
+    Count every call of `client` with its latency, retries and error codes.
+    Called by utils.aws_clients for each client it creates.
+    """
+    service = client.meta.service_model.service_name
+    region_name = client.meta.region_name
+
+    def before_call(model, context, **kwargs):
+        context['metrics_call'] = (model.name, time.perf_counter())
+
+    def needs_retry(request_dict, response=None, caught_exception=None, operation=None, attempts=None, **kwargs):
+        # Called after every attempt, the final one included
+        code = _error_code(response) or (type(caught_exception).__name__ if caught_exception != None else None)
+        if code != None:
+            api_errors.inc(service, operation.name, code)
+        if code in rate_limiter.THROTTLING_ERRORS:
+            api_throttles.inc(service, operation.name, region_name)
+        if attempts != None and attempts > 1:
+            api_retries.inc(service, operation.name)
+
+    def after_call(context, **kwargs):
+        # after-call-error (e.g. connection errors) comes without the operation model, it was kept in the context
+        call = context.pop('metrics_call', None)
+        if call == None:
+            return
+        operation_name, start = call
+        api_calls.inc(service, operation_name, region_name)
+        api_latency.observe(time.perf_counter() - start, service, operation_name)
+
+    events = client.meta.events
+    events.register('before-call', before_call, unique_id='dotp-metrics-before-call')
+    events.register('needs-retry', needs_retry, unique_id='dotp-metrics-needs-retry')
+    events.register('after-call', after_call, unique_id='dotp-metrics-after-call')
+    events.register('after-call-error', after_call, unique_id='dotp-metrics-after-call-error')
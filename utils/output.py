@@ -0,0 +1,88 @@
+import collections
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from flask import has_request_context
+from flask_socketio import emit as socketio_emit
+
+# Where progress messages go. Inside a Socket.IO handler it is the requesting client,
+# background jobs set their own emitter with `use_emitter`.
+_emitter = contextvars.ContextVar('emitter', default=None)
+
+
+def emit(event, data):
+    emitter = _emitter.get()
+    if emitter != None:
+        emitter(event, data)
+    elif has_request_context():
+        socketio_emit(event, data)
+
+
+@contextmanager
+def use_emitter(emitter):
+    """
+    Send every `emit(event, data)` of the enclosed block (and of the steps it starts) to `emitter`.
+    """
+    token = _emitter.set(emitter)
+    try:
+        yield emitter
+    finally:
+        _emitter.reset(token)
+
+
+# Remote output buffering: at most MAX_BUFFERED_LINES wait for the client, sent at most every FLUSH_INTERVAL seconds
+MAX_BUFFERED_LINES = 200
+FLUSH_INTERVAL = 0.5
+
+
+class LineBuffer:
+    """
+    Forwards lines (e.g. remote command output) as `event` messages
+    {**tags, 'lines': [...], 'dropped': n} from a sender thread, so the producer never waits on the client.
+    Lines are batched, one message per FLUSH_INTERVAL at most. When the client is slower than the producer
+    only the newest `max_lines` are kept and `dropped` counts the ones skipped since the last message.
+    """
+
+    def __init__(self, event, tags, max_lines=MAX_BUFFERED_LINES, interval=FLUSH_INTERVAL):
+        self.event = event
+        self.tags = tags
+        self.interval = interval
+        self._lines = collections.deque(maxlen=max_lines)
+        self._dropped = 0
+        self._closed = False
+        self._condition = threading.Condition()
+        # The sender keeps the caller's emitter (see use_emitter)
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._send_loop,),
+                                        name=f"{event}-sender", daemon=True)
+        self._thread.start()
+
+    def append(self, line):
+        with self._condition:
+            if len(self._lines) == self._lines.maxlen:
+                self._dropped += 1
+            self._lines.append(line)
+            self._condition.notify()
+
+    def close(self):
+        """
+        Send what is left and stop the sender thread.
+        """
+        with self._condition:
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _send_loop(self):
+        while True:
+            with self._condition:
+                while not self._lines and not self._closed:
+                    self._condition.wait()
+                lines, dropped, closed = list(self._lines), self._dropped, self._closed
+                self._lines.clear()
+                self._dropped = 0
+            if lines or dropped:
+                emit(self.event, dict(self.tags, lines=lines, dropped=dropped))
+            if closed:
+                return
+            time.sleep(self.interval)
@@ -0,0 +1,202 @@
+import logging
+import threading
+import time
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Token bucket per category: (capacity, refill per second).
+# Close to the EC2 API request-rate limits for describe and mutating actions.
+BUCKETS = {
+    'describe': (100, 20.0),
+    'mutating': (200, 5.0),
+}
+# AIMD concurrency: start, floor and ceiling of calls in flight per bucket
+INITIAL_CONCURRENCY = 10
+MIN_CONCURRENCY = 1
+MAX_CONCURRENCY = 50
+# Don't halve the concurrency more than once per this many seconds
+DECREASE_COOLDOWN = 1.0
+
+THROTTLING_ERRORS = ('RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'ThrottledException',
+                     'TooManyRequestsException', 'RequestThrottled', 'RequestThrottledException', 'SlowDown')
+
+
+def category(operation_name):
+    if operation_name.startswith(('Describe', 'List', 'Get')):
+        return 'describe'
+    return 'mutating'
+
+
+class TokenBucket:
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self._tokens = float(capacity)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available. Returns the seconds waited.
+        """
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return waited
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class AdaptiveConcurrency:
+    """
+    Limits the calls in flight. The limit grows by ~1 for every `limit` successful calls
+    and is halved on throttling (additive increase, multiplicative decrease).
+    """
+
+    def __init__(self, initial=INITIAL_CONCURRENCY, minimum=MIN_CONCURRENCY, maximum=MAX_CONCURRENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+        return time.monotonic() - start
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+    def on_success(self):
+        with self._condition:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify()
+
+    def on_throttle(self):
+        with self._condition:
+            now = time.monotonic()
+            if now - self._last_decrease < DECREASE_COOLDOWN:
+                return
+            self._last_decrease = now
+            self.limit = max(self.minimum, self.limit / 2)
+            logger.info(f"API throttled, concurrency limit lowered to {int(self.limit)}")
+
+
+class Limiter:
+    """
+    Token bucket + adaptive concurrency for one (account, region, service, category).
+    """
+
+    def __init__(self, key):
+        self.key = key
+        self.bucket = TokenBucket(*BUCKETS[key[-1]])
+        self.concurrency = AdaptiveConcurrency()
+        self.calls = 0
+        self.throttled = 0
+        self.wait_seconds = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        waited = self.concurrency.acquire() + self.bucket.acquire()
+        with self._lock:
+            self.calls += 1
+            self.wait_seconds += waited
+
+    def release(self, throttled):
+        self.concurrency.release()
+        if throttled:
+            with self._lock:
+                self.throttled += 1
+        else:
+            self.concurrency.on_success()
+
+    def throttle(self):
+        self.concurrency.on_throttle()
+
+    def stats(self):
+        with self._lock:
+            return {'calls': self.calls, 'throttled': self.throttled, 'wait_seconds': self.wait_seconds,
+                    'concurrency_limit': int(self.concurrency.limit)}
+
+
+_lock = threading.Lock()
+_limiters = {}
+
+
+def get_limiter(account, region_name, service, operation_name):
+    key = (account, region_name, service, category(operation_name))
+    with _lock:
+        limiter = _limiters.get(key)
+        if limiter == None:
+            limiter = _limiters[key] = Limiter(key)
+    return limiter
+
+
+def stats():
+    """
+    {(account, region, service, category): {'calls', 'throttled', 'wait_seconds', 'concurrency_limit'}}
+    """
+    with _lock:
+        limiters = list(_limiters.values())
+    return {limiter.key: limiter.stats() for limiter in limiters}
+
+
+def total_wait_seconds():
+    return sum(item['wait_seconds'] for item in stats().values())
+
+
+def log_stats():
+    for (account, region_name, service, kind), item in sorted(stats().items(), key=lambda x: str(x[0])):
+        logger.info(f"Rate limiter {service}/{kind} in {region_name}: {item['calls']} calls, {item['throttled']} throttled, "
+                    f"{item['wait_seconds']:0.2f} seconds waiting, concurrency limit {item['concurrency_limit']}")
+
+
+def _is_throttled(parsed):
+    return parsed != None and parsed.get('Error', {}).get('Code') in THROTTLING_ERRORS
+
+
+def install(client, account):
+    """
+    Route every call of `client` through the limiter of its account, region and API category.
+    Called by utils.aws_clients for each client it creates.
+    """
+    service = client.meta.service_model.service_name
+    region_name = client.meta.region_name
+
+    def before_call(model, context, **kwargs):
+        limiter = get_limiter(account, region_name, service, model.name)
+        limiter.acquire()
+        context['rate_limiter'] = limiter
+
+    def needs_retry(request_dict, response=None, **kwargs):
+        # Called for every attempt; throttled attempts lower the concurrency right away
+        limiter = request_dict.get('context', {}).get('rate_limiter')
+        if limiter != None and response != None and _is_throttled(response[1]):
+            request_dict['context']['rate_limiter_throttled'] = True
+            limiter.throttle()
+
+    def after_call(context, parsed=None, **kwargs):
+        limiter = context.pop('rate_limiter', None)
+        if limiter != None:
+            limiter.release(context.pop('rate_limiter_throttled', False) or _is_throttled(parsed))
+
+    events = client.meta.events
+    events.register('before-call', before_call, unique_id='dotp-rate-limiter-before-call')
+    events.register('needs-retry', needs_retry, unique_id='dotp-rate-limiter-needs-retry')
+    events.register('after-call', after_call, unique_id='dotp-rate-limiter-after-call')
+    events.register('after-call-error', after_call, unique_id='dotp-rate-limiter-after-call-error')
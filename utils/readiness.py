@@ -0,0 +1,178 @@
+import contextvars
+import http.client
+import logging
+import random
+import socket
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import tracing
+from utils.output import emit
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+
+class ProbeFailed(Exception):
+    """
+    Raised by a probe when the target can't become ready anymore; the target fails without further attempts.
+    """
+
+
+class TcpProbe:
+    """
+    Ready once host:port accepts a TCP connection. With `via` (a paramiko Transport, e.g. to the bastion)
+    the connection is opened from that host through a direct-tcpip channel.
+    """
+
+    def __init__(self, host, port, via=None, timeout=5.0):
+        self.host = host
+        self.port = port
+        self.via = via
+        self.timeout = timeout
+
+    def __call__(self):
+        if self.via != None:
+            self.via.open_channel('direct-tcpip', (self.host, self.port), ('127.0.0.1', 0), timeout=self.timeout).close()
+        else:
+            socket.create_connection((self.host, self.port), timeout=self.timeout).close()
+        return True
+
+
+class HttpProbe:
+    """
+    Ready once GET http://host:port/path answers with a status in `statuses` (default 2xx/3xx).
+    Works directly or through `via`, a paramiko Transport.
+    """
+
+    def __init__(self, host, port, path='/', via=None, statuses=range(200, 400), timeout=5.0):
+        self.host = host
+        self.port = port
+        self.path = path
+        self.via = via
+        self.statuses = statuses
+        self.timeout = timeout
+
+    def _status(self):
+        if self.via == None:
+            connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+            try:
+                connection.request('GET', self.path)
+                return connection.getresponse().status
+            finally:
+                connection.close()
+
+        channel = self.via.open_channel('direct-tcpip', (self.host, self.port), ('127.0.0.1', 0), timeout=self.timeout)
+        try:
+            channel.settimeout(self.timeout)
+            channel.sendall(f"GET {self.path} HTTP/1.0\r\nHost: {self.host}:{self.port}\r\nConnection: close\r\n\r\n".encode())
+            status_line = b''
+            while b'\r\n' not in status_line:
+                data = channel.recv(1024)
+                if not data:
+                    break
+                status_line += data
+            return int(status_line.split(b' ')[1])
+        finally:
+            channel.close()
+
+    def __call__(self):
+        status = self._status()
+        if status not in self.statuses:
+            raise ConnectionError(f"HTTP status {status}")
+        return status
+
+
+class CommandProbe:
+    """
+    Ready once `command` exits with 0 (and its output contains `expect`, if given).
+    Output containing `fail` fails the target right away.
+    `run(command)` executes it and returns (exit_status, stdout), e.g. over SSH.
+    The command output is the probe result.
+    """
+
+    def __init__(self, command, run, expect=None, fail=None):
+        self.command = command
+        self.run = run
+        self.expect = expect
+        self.fail = fail
+
+    def __call__(self):
+        exit_status, output = self.run(self.command)
+        if self.fail != None and self.fail in output:
+            raise ProbeFailed(output.strip())
+        if exit_status != 0:
+            raise RuntimeError(f"exit status {exit_status}")
+        if self.expect != None and self.expect not in output:
+            raise RuntimeError(f"'{self.expect}' not in output")
+        return output
+
+
+class Target:
+    """
+    One endpoint to wait for.
+        timeout - per-target deadline in seconds
+        delay / max_delay - first and largest pause between attempts (exponential backoff with jitter)
+    """
+
+    def __init__(self, name, probe, timeout=300, delay=0.5, max_delay=10.0, host=None):
+        self.name = name
+        self.probe = probe
+        self.timeout = timeout
+        self.delay = delay
+        self.max_delay = max_delay
+        self.host = host
+        self.state = 'pending'
+
+
+def _set_state(target, state, detail=None):
+    target.state = state
+    message = f"[{target.name}] {state}" + (f" - {detail}" if detail != None else "")
+    logger.info(message)
+    emit('probe', {'target': target.name, 'host': target.host, 'state': state, 'detail': detail})
+    if state in ('ready', 'failed'):
+        emit('output', message)
+
+
+def _probe(target):
+    deadline = time.monotonic() + target.timeout
+    attempt = 0
+    _set_state(target, 'probing')
+    while True:
+        try:
+            result = target.probe()
+            _set_state(target, 'ready')
+            return result
+        except ProbeFailed as e:
+            _set_state(target, 'failed', str(e))
+            raise
+        except Exception as e:
+            error = e
+        now = time.monotonic()
+        if now >= deadline:
+            _set_state(target, 'failed', str(error))
+            raise TimeoutError(f"'{target.name}' not ready after {target.timeout} seconds: {error}") from error
+        if attempt == 0:
+            _set_state(target, 'waiting', str(error))
+        # Full jitter: a random pause up to the exponential delay, never past the deadline
+        pause = random.uniform(0, min(target.max_delay, target.delay * 2 ** attempt))
+        time.sleep(min(pause, deadline - now))
+        attempt += 1
+
+
+def _traced_probe(target):
+    with tracing.span(target.name, 'probe', host=target.host):
+        return _probe(target)
+
+
+def wait_ready(targets, max_workers=None):
+    """
+    Probe every target concurrently until it is ready or its deadline passes.
+    State changes are logged and emitted as 'probe' events (and 'output' lines).
+    Returns {target.name: probe result}; raises TimeoutError (or ProbeFailed) for the first target that failed.
+    """
+    if not targets:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(targets)) as pool:
+        futures = {target.name: pool.submit(contextvars.copy_context().run, _traced_probe, target) for target in targets}
+    return {name: future.result() for name, future in futures.items()}
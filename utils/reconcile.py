@@ -0,0 +1,130 @@
+"""
+Plan of a stack against the live resources of its project, for the 'plan' and 'reconcile' modes of create_dotp.run.
+
+The desired stack decides which live resources it keeps (Plan.adopt); the steps creating them are skipped
+(engine.reuse), the other steps are the creates and updates, and every other resource tagged with the project
+is deleted, through the teardown graph of utils.clear_vpc.
+"""
+import logging
+from utils import clear_vpc, inventory
+from utils.engine import reuse
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Kinds of resources a stack is made of; other resources of the project (ECS clusters) are left alone
+STACK_KINDS = [kind for kind in inventory.RESOURCES if kind != 'ecs_clusters']
+
+
+def _name(resource):
+    return inventory.tags(resource).get('Name', '')
+
+
+class Plan:
+    """
+    Difference between the desired stack and the resources tagged with its project.
+        live      - the STACK_KINDS of the project's inventory index (inventory.Index.get)
+        adopted   - step name -> outputs of the live resources kept, for engine.reuse
+        modified  - step name -> outputs of the steps updating live resources in place (see modify)
+        instances - instance name -> description of the live instances kept
+        keep      - IDs of every live resource kept
+        create / update - (kind, name) of the work left, filled by reuse / add_instances
+        delete    - kind (see inventory.RESOURCES) -> live resources of the project that are not kept
+    """
+
+    def __init__(self, live):
+        self.live = live
+        self.adopted = {}
+        self._ids = {}
+        self.modified = {}
+        self.instances = {}
+        self.keep = set()
+        self.create = []
+        self.update = []
+        self.delete = {}
+
+    def find(self, kind, name=None, **attributes):
+        """
+        The first live resource of `kind` with the Name tag `name` (or a Name starting with it when it ends in '*')
+        and the given top level attributes, None if there is none.
+        """
+        for resource in self.live.get(kind, []):
+            if name != None:
+                if name.endswith('*') and not _name(resource).startswith(name[:-1]):
+                    continue
+                if not name.endswith('*') and _name(resource) != name:
+                    continue
+            if all(resource.get(key) == value for key, value in attributes.items()):
+                return resource
+        return None
+
+    def adopt(self, step_name, outputs, *ids):
+        """
+        The step `step_name` is done with `outputs`, the live resources `ids` are kept if the step is skipped (see reuse).
+        """
+        self.adopted[step_name] = outputs
+        self._ids[step_name] = ids
+
+    def modify(self, step_name, outputs, *ids):
+        """
+        The live resources `ids` of step `step_name` are kept and changed in place: the step runs as an update,
+        its `outputs` are known ahead (e.g. the ID of the resource it updates).
+        """
+        self.modified[step_name] = outputs
+        self.keep.update(ids)
+
+    def adopt_instance(self, name, instance):
+        self.instances[name] = instance
+        self.keep.add(instance['InstanceId'])
+
+    def reuse(self, steps, updates=(), ignored=()):
+        """
+        engine.reuse of `steps` with the adopted outputs; the resources of the skipped steps are kept.
+        The steps left to run are recorded: the ones in `updates` (or modify) change live resources, the ones in `ignored`
+        change nothing (lookups, waits), every other one creates a resource.
+        Returns (context, steps left to run) for engine.run_steps.
+        """
+        context, steps = reuse(steps, self.adopted)
+        remaining = {step.name for step in steps}
+        for name, ids in self._ids.items():
+            if name not in remaining:
+                self.keep.update(ids)
+        for step in steps:
+            if step.name in updates or step.name in self.modified:
+                self.update.append(('step', step.name))
+            elif step.name not in ignored:
+                self.create.append(('step', step.name))
+        return context, steps
+
+    def add_instances(self, names):
+        self.create += [('instance', name) for name in names]
+
+    def compute_deletes(self):
+        self.delete = {}
+        for kind, resources in self.live.items():
+            stray = [resource for resource in resources if inventory.resource_id(kind, resource) not in self.keep]
+            if stray:
+                self.delete[kind] = stray
+
+    def empty(self):
+        return not (self.create or self.update or self.delete)
+
+    def summary(self):
+        deletes = sum(len(resources) for resources in self.delete.values())
+        return f"Plan: {len(self.create)} to create, {len(self.update)} to update, {deletes} to delete."
+
+    def lines(self):
+        lines = [f"  + {kind} {name}" for kind, name in self.create]
+        lines += [f"  ~ {kind} {name}" for kind, name in self.update]
+        for kind, resources in self.delete.items():
+            for resource in resources:
+                name = _name(resource)
+                lines.append(f"  - {kind} {inventory.resource_id(kind, resource)}" + (f" ({name})" if name else ""))
+        return lines
+
+    def delete_steps(self):
+        """
+        utils.engine steps deleting self.delete (see clear_vpc.project_steps).
+        """
+        return clear_vpc.project_steps(self.live, self.delete)
@@ -0,0 +1,141 @@
+import codecs
+import contextvars
+import logging
+import select
+import time
+from concurrent.futures import ThreadPoolExecutor
+from utils import tracing
+from utils.engine import Step
+from utils.output import LineBuffer
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Output of a streamed command kept for its CommandResult, per stream (the browser gets every line)
+MAX_OUTPUT_CHARS = 64 * 1024
+READ_SIZE = 32 * 1024
+
+
+class CommandResult:
+    """
+    Outcome of one command on one host.
+    """
+
+    def __init__(self, host, command, exit_status, stdout, stderr, elapsed):
+        self.host = host
+        self.command = command
+        self.exit_status = exit_status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.elapsed = elapsed
+
+    @property
+    def ok(self):
+        return self.exit_status == 0
+
+    def __repr__(self):
+        return f"CommandResult(host={self.host!r}, exit_status={self.exit_status})"
+
+
+class RemoteCommandError(Exception):
+    """
+    Raised when a command exits with a non-zero status on at least one host. `results` holds every host's result.
+    """
+
+    def __init__(self, results):
+        self.results = results
+        failed = [result for result in results.values() if not result.ok]
+        details = "; ".join(f"'{r.host}' exited with {r.exit_status}: {(r.stderr or r.stdout).strip()[-200:]}"
+                            for r in failed)
+        super().__init__(f"'{failed[0].command}' failed on {len(failed)} host(s): {details}")
+
+
+class _Stream:
+    """
+    Decodes one output stream of a channel, passes complete lines to `buffer`
+    and keeps the last MAX_OUTPUT_CHARS characters.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = buffer
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.partial = ''
+        self.text = ''
+
+    def feed(self, data, final=False):
+        text = self.decoder.decode(data, final)
+        self.text = (self.text + text)[-MAX_OUTPUT_CHARS:]
+        lines = (self.partial + text).splitlines(keepends=True)
+        self.partial = lines.pop() if lines and not final and not lines[-1].endswith('\n') else ''
+        for line in lines:
+            self.buffer.append(line.rstrip('\r\n'))
+
+
+def _stream(sessions, host, command, step):
+    """
+    Run `command` on `host`, forwarding its output line by line as 'remote_output' events while it runs.
+    Returns (exit_status, stdout, stderr).
+    """
+    buffer = LineBuffer('remote_output', {'host': host or sessions.bastion_host, 'step': step})
+    stdout, stderr = _Stream(buffer), _Stream(buffer)
+    channel = sessions.client(host).get_transport().open_session()
+    try:
+        channel.exec_command(command)
+        channel.shutdown_write()
+        while True:
+            select.select([channel], [], [], 1.0)
+            while channel.recv_ready():
+                stdout.feed(channel.recv(READ_SIZE))
+            while channel.recv_stderr_ready():
+                stderr.feed(channel.recv_stderr(READ_SIZE))
+            # The exit status comes after all the output
+            if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                break
+        stdout.feed(b'', final=True)
+        stderr.feed(b'', final=True)
+        return channel.recv_exit_status(), stdout.text, stderr.text
+    finally:
+        channel.close()
+        buffer.close()
+
+
+def _run(sessions, host, command, step):
+    tic = time.perf_counter()
+    with tracing.span(step or command.split()[0], 'remote', host=host or sessions.bastion_host, command=command) as span:
+        exit_status, output, error = _stream(sessions, host, command, step)
+        if span != None:
+            span.set(exit_status=exit_status)
+            if exit_status != 0:
+                span.finish(error=f"exit status {exit_status}")
+    result = CommandResult(host or sessions.bastion_host, command, exit_status, output, error,
+                           time.perf_counter() - tic)
+    logger.info(f"'{result.host}': '{command}' exited with {exit_status} in {result.elapsed:0.2f} seconds")
+    return result
+
+
+def run_on_hosts(sessions, hosts, command, check=True, max_workers=None, step=None):
+    """
+    Run `command` on every host at once over the sessions of a utils.ssh_sessions.SessionManager
+    (None is the bastion host). Returns {host: CommandResult} in the order of `hosts`.
+    Output is streamed while the command runs as 'remote_output' events tagged with the host and `step`.
+    With `check` a non-zero exit status on any host raises RemoteCommandError once all hosts are done.
+    """
+    hosts = list(dict.fromkeys(hosts))
+    if not hosts:
+        return {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(hosts)) as pool:
+        futures = {host: pool.submit(contextvars.copy_context().run, _run, sessions, host, command, step) for host in hosts}
+    results = {host: future.result() for host, future in futures.items()}
+    if check and not all(result.ok for result in results.values()):
+        raise RemoteCommandError(results)
+    return results
+
+
+def remote_step(name, sessions, hosts, command, requires=(), check=True, message=None):
+    """
+    utils.engine Step running `command` on `hosts` with run_on_hosts.
+    It provides `name` with the {host: CommandResult} map, so later steps can depend on it.
+    """
+    return Step(name, lambda **_: run_on_hosts(sessions, hosts, command, check=check, step=name),
+                requires=requires, provides=[name], message=message)
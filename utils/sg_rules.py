@@ -0,0 +1,246 @@
+"""
+Security group ingress rules written as a compact spec, compiled to the smallest equivalent set of IpPermissions.
+
+    "<sources>:<ports>[/<protocol>],..."
+    sources  - ';' separated IPv4 / IPv6 networks or addresses, or security group IDs (sg-...)
+    ports    - a port (22), a range (8080-8090) or 'all'; for icmp / icmpv6 a type (8), type.code (3.4) or 'all'
+    protocol - tcp (default), udp, icmp, icmpv6 or all (every protocol, with ports 'all')
+
+    "0.0.0.0/0;172.18.20.15/32:22,10.0.0.0/16:8080-8090,::/0:53/udp,sg-0123456789abcdef0:all/all"
+
+Rules are deduplicated, the port ranges of one source are merged when they overlap or touch, and the networks
+sharing a port range are aggregated. diff() / apply() bring an existing group to the spec with the fewest changes.
+"""
+import ipaddress
+import logging
+import os
+import re
+from collections import namedtuple
+from utils.aws_clients import get_client
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Inbound rules per security group (AWS default quota, counted per IP version; group references count in both)
+MAX_RULES = int(os.environ.get('DOTP_SG_MAX_RULES', 60))
+PROTOCOLS = {'tcp': 'tcp', 'udp': 'udp', 'icmp': 'icmp', 'icmpv6': 'icmpv6', 'all': '-1'}
+# IpProtocol may come back as a protocol number
+PROTOCOL_NUMBERS = {'6': 'tcp', '17': 'udp', '1': 'icmp', '58': 'icmpv6'}
+_GROUP_ID = re.compile(r'^sg-[0-9a-f]{8,17}$')
+
+# One source allowed on one protocol and port range; source is a network ('10.0.0.0/16') or a group ID
+Rule = namedtuple('Rule', ['protocol', 'from_port', 'to_port', 'source'])
+
+
+def _source(text):
+    if _GROUP_ID.match(text):
+        return text
+    try:
+        return str(ipaddress.ip_network(text))
+    except ValueError as e:
+        raise ValueError(f"Invalid source '{text}': {e}")
+
+
+def _ports(text, protocol):
+    if protocol == '-1':
+        if text != 'all':
+            raise ValueError(f"Protocol 'all' takes ports 'all', not '{text}'.")
+        return -1, -1
+    if protocol in ('icmp', 'icmpv6'):
+        if text == 'all':
+            return -1, -1
+        if not re.match(r'^\d+(\.\d+)?$', text):
+            raise ValueError(f"Invalid {protocol} type / code '{text}'.")
+        icmp_type, _, code = text.partition('.')
+        ports = int(icmp_type), int(code) if code else -1
+        if not (0 <= ports[0] <= 255 and -1 <= ports[1] <= 255):
+            raise ValueError(f"Invalid {protocol} type / code '{text}'.")
+        return ports
+    if text == 'all':
+        return 0, 65535
+    if not re.match(r'^\d+(-\d+)?$', text):
+        raise ValueError(f"Invalid port range '{text}'.")
+    low, _, high = text.partition('-')
+    ports = int(low), int(high or low)
+    if not 0 <= ports[0] <= ports[1] <= 65535:
+        raise ValueError(f"Invalid port range '{text}'.")
+    return ports
+
+
+def parse(spec):
+    """
+    Rules of `spec` (see the module docstring) as written, one per source. Raises ValueError on an invalid rule.
+    """
+    rules = []
+    for entry in spec.split(','):
+        entry = entry.strip()
+        if entry == '':
+            continue
+        # The ports follow the last ':', IPv6 sources have some of their own
+        sources, _, ports = entry.rpartition(':')
+        ports, _, protocol = ports.partition('/')
+        if sources == '' or protocol.lower() not in PROTOCOLS | {'': 'tcp'}:
+            raise ValueError(f"Invalid rule '{entry}', expected '<sources>:<ports>[/<protocol>]'.")
+        protocol = PROTOCOLS.get(protocol.lower(), 'tcp')
+        try:
+            from_port, to_port = _ports(ports.strip().lower(), protocol)
+        except ValueError as e:
+            raise ValueError(f"Invalid rule '{entry}': {e}")
+        for source in sources.split(';'):
+            source = _source(source.strip())
+            version = None if _GROUP_ID.match(source) else ipaddress.ip_network(source).version
+            if (protocol, version) in (('icmp', 6), ('icmpv6', 4)):
+                raise ValueError(f"Invalid rule '{entry}': {protocol} does not apply to '{source}'.")
+            rules.append(Rule(protocol, from_port, to_port, source))
+    return rules
+
+
+def _merge(intervals):
+    merged = []
+    for low, high in sorted(intervals):
+        if merged and low <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], high))
+        else:
+            merged.append((low, high))
+    return merged
+
+
+def _sort_key(rule):
+    group = _GROUP_ID.match(rule.source) != None
+    network = None if group else ipaddress.ip_network(rule.source)
+    return (rule.protocol, rule.from_port, rule.to_port, group, network.version if network else 0,
+            network.network_address.packed if network else rule.source.encode(), network.prefixlen if network else 0)
+
+
+def _ports_cover(rule, other):
+    # the ports of `other` include the ones of `rule`
+    if rule.protocol in ('tcp', 'udp'):
+        return other.from_port <= rule.from_port and rule.to_port <= other.to_port
+    return (other.from_port, other.to_port) == (-1, -1) or (other.from_port == rule.from_port and other.to_port == -1)
+
+
+def _drop_covered(rules):
+    # Network rules another rule allows already: same protocol, a wider network and its ports included
+    kept, families = set(), {}
+    for rule in rules:
+        if _GROUP_ID.match(rule.source):
+            kept.add(rule)
+        else:
+            network = ipaddress.ip_network(rule.source)
+            families.setdefault((rule.protocol, network.version), []).append((rule, network))
+    for family in families.values():
+        for rule, network in family:
+            if not any(other != rule and wider.prefixlen <= network.prefixlen and _ports_cover(rule, other)
+                       and network.subnet_of(wider) for other, wider in family):
+                kept.add(rule)
+    return kept
+
+
+def _compile_once(rules):
+    # A source allowed on every protocol needs no other rule
+    everything = {rule.source for rule in rules if rule.protocol == '-1'}
+    rules = {rule for rule in rules if rule.protocol == '-1' or rule.source not in everything}
+
+    ranges = {}
+    for rule in rules:
+        ranges.setdefault((rule.protocol, rule.source), []).append((rule.from_port, rule.to_port))
+    by_ports = {}
+    for (protocol, source), intervals in ranges.items():
+        if protocol in ('tcp', 'udp'):
+            intervals = _merge(intervals)
+        elif (-1, -1) in intervals:
+            intervals = [(-1, -1)]
+        for from_port, to_port in intervals:
+            by_ports.setdefault((protocol, from_port, to_port), []).append(source)
+
+    compiled = set()
+    for (protocol, from_port, to_port), sources in by_ports.items():
+        networks = [ipaddress.ip_network(source) for source in sources if not _GROUP_ID.match(source)]
+        for version in (4, 6):
+            compiled.update(Rule(protocol, from_port, to_port, str(network))
+                            for network in ipaddress.collapse_addresses(network for network in networks if network.version == version))
+        compiled.update(Rule(protocol, from_port, to_port, source) for source in sources if _GROUP_ID.match(source))
+    return _drop_covered(compiled)
+
+
+def compile_rules(spec):
+    """
+    The canonical rule set of `spec` (a spec string or Rules), sorted. Raises ValueError when it is invalid
+    or needs more than MAX_RULES rules.
+    """
+    rules = set(parse(spec) if isinstance(spec, str) else spec)
+    # Aggregated networks may give a source overlapping port ranges again, and merged ranges wider networks
+    compiled = _compile_once(rules)
+    while compiled != rules:
+        rules, compiled = compiled, _compile_once(compiled)
+
+    for version in (4, 6):
+        count = sum(1 for rule in compiled if _GROUP_ID.match(rule.source) or ipaddress.ip_network(rule.source).version == version)
+        if count > MAX_RULES:
+            raise ValueError(f"{count} IPv{version} ingress rules, a security group takes {MAX_RULES} (DOTP_SG_MAX_RULES).")
+    return sorted(compiled, key=_sort_key)
+
+
+def ip_permissions(rules):
+    """
+    IpPermissions of `rules` for authorize/revoke_security_group_ingress, one entry per protocol and port range.
+    """
+    permissions = {}
+    for rule in sorted(rules, key=_sort_key):
+        permission = permissions.get((rule.protocol, rule.from_port, rule.to_port))
+        if permission == None:
+            permission = permissions[(rule.protocol, rule.from_port, rule.to_port)] = {'IpProtocol': rule.protocol}
+            if rule.protocol != '-1':
+                permission['FromPort'], permission['ToPort'] = rule.from_port, rule.to_port
+        if _GROUP_ID.match(rule.source):
+            permission.setdefault('UserIdGroupPairs', []).append({'GroupId': rule.source})
+        elif ipaddress.ip_network(rule.source).version == 4:
+            permission.setdefault('IpRanges', []).append({'CidrIp': rule.source})
+        else:
+            permission.setdefault('Ipv6Ranges', []).append({'CidrIpv6': rule.source})
+    return list(permissions.values())
+
+
+def rules_from_permissions(permissions):
+    """
+    Rules of the IpPermissions of a security group (describe_security_groups). Prefix lists are not managed here.
+    """
+    rules = set()
+    for permission in permissions:
+        protocol = PROTOCOL_NUMBERS.get(permission['IpProtocol'], permission['IpProtocol'])
+        from_port, to_port = (-1, -1) if protocol == '-1' else (permission.get('FromPort', -1), permission.get('ToPort', -1))
+        rules.update(Rule(protocol, from_port, to_port, str(ipaddress.ip_network(ip_range['CidrIp'])))
+                     for ip_range in permission.get('IpRanges', []))
+        rules.update(Rule(protocol, from_port, to_port, str(ipaddress.ip_network(ip_range['CidrIpv6'])))
+                     for ip_range in permission.get('Ipv6Ranges', []))
+        rules.update(Rule(protocol, from_port, to_port, pair['GroupId'])
+                     for pair in permission.get('UserIdGroupPairs', []) if 'GroupId' in pair)
+    return rules
+
+
+def diff(rules, permissions):
+    """
+    What turns the IpPermissions `permissions` into `rules`: (IpPermissions to authorize, IpPermissions to revoke).
+    """
+    current = rules_from_permissions(permissions)
+    return ip_permissions(set(rules) - current), ip_permissions(current - set(rules))
+
+
+def apply(group_id, spec, permissions=None):
+    """
+    Bring the ingress rules of security group `group_id` to `spec` (a spec string or Rules) with the fewest changes.
+    permissions - the current IpPermissions of the group when known, otherwise they are described.
+    Returns (IpPermissions authorized, IpPermissions revoked).
+    """
+    client = get_client('ec2')
+    rules = compile_rules(spec)
+    if permissions == None:
+        permissions = client.describe_security_groups(GroupIds=[group_id])['SecurityGroups'][0]['IpPermissions']
+    authorize, revoke = diff(rules, permissions)
+    # Authorized first, a source moving to a wider rule keeps its access in between
+    if authorize:
+        client.authorize_security_group_ingress(GroupId=group_id, IpPermissions=authorize)
+    if revoke:
+        client.revoke_security_group_ingress(GroupId=group_id, IpPermissions=revoke)
+    return authorize, revoke
@@ -0,0 +1,106 @@
+import logging
+import select
+import threading
+import paramiko
+from utils import tracing
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+READ_SIZE = 32 * 1024
+
+
+class SessionManager:
+    """
+    One authenticated SSH session per host for a whole run.
+    The bastion (public host) is reached directly, private hosts through a direct-tcpip channel
+    opened on the bastion transport, so no key has to be copied to the bastion and no nested ssh/scp is needed.
+    Commands are multiplexed as channels over these sessions, paramiko allows that from several threads.
+    """
+
+    def __init__(self, bastion_host, username, pkey, timeout=10):
+        self.bastion_host = bastion_host
+        self.username = username
+        self.pkey = pkey
+        self.timeout = timeout
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._host_locks = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _host_lock(self, host):
+        with self._lock:
+            return self._host_locks.setdefault(host, threading.Lock())
+
+    def client(self, host=None):
+        """
+        Connected paramiko.SSHClient for `host` (the bastion when host is None).
+        """
+        host = host or self.bastion_host
+        with self._host_lock(host):
+            client = self._clients.get(host)
+            if client != None and client.get_transport() != None and client.get_transport().is_active():
+                return client
+
+            sock = self._sock(host)
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            logger.info(f"Opening SSH session to '{host}'" + (f" through '{self.bastion_host}'" if host != self.bastion_host else ""))
+            with tracing.span("ssh connect", 'remote', host=host, via=self.bastion_host if host != self.bastion_host else None):
+                client.connect(hostname=host, username=self.username, pkey=self.pkey, sock=sock,
+                               timeout=self.timeout, banner_timeout=self.timeout, auth_timeout=self.timeout)
+            self._clients[host] = client
+            return client
+
+    def _sock(self, host):
+        """
+        Socket the session to `host` runs over: None (a direct TCP connection) for the bastion,
+        a direct-tcpip channel opened on the bastion transport for the others.
+        """
+        if host == self.bastion_host:
+            return None
+        return self.transport.open_channel('direct-tcpip', (host, 22), ('127.0.0.1', 0), timeout=self.timeout)
+
+    @property
+    def transport(self):
+        """
+        Transport of the bastion session, e.g. for readiness probes of private hosts.
+        """
+        return self.client(self.bastion_host).get_transport()
+
+    def run(self, host, command):
+        """
+        Run `command` on `host` and wait for it. Returns (exit_status, stdout, stderr).
+        Both streams are read as the output comes, so a command filling one of them can't stall.
+        """
+        stdout, stderr = [], []
+        channel = self.client(host).get_transport().open_session()
+        try:
+            channel.exec_command(command)
+            channel.shutdown_write()
+            while True:
+                select.select([channel], [], [], 1.0)
+                while channel.recv_ready():
+                    stdout.append(channel.recv(READ_SIZE))
+                while channel.recv_stderr_ready():
+                    stderr.append(channel.recv_stderr(READ_SIZE))
+                # The exit status comes after all the output
+                if channel.exit_status_ready() and not channel.recv_ready() and not channel.recv_stderr_ready():
+                    break
+            return (channel.recv_exit_status(), b''.join(stdout).decode(errors='replace'),
+                    b''.join(stderr).decode(errors='replace'))
+        finally:
+            channel.close()
+
+    def close(self):
+        with self._lock:
+            # Private host sessions first, their channels run over the bastion transport
+            hosts = sorted(self._clients, key=lambda host: host == self.bastion_host)
+            for host in hosts:
+                self._clients.pop(host).close()
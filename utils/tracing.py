@@ -0,0 +1,283 @@
+import contextvars
+import itertools
+import json
+import logging
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Every finished trace is written there as <name>-<date>-<time>-<trace id>.json
+TRACE_DIR = os.environ.get('DOTP_TRACE_DIR', './traces')
+
+# Span kinds: run -> phase -> step (one resource) -> api / remote / probe
+_current = contextvars.ContextVar('trace_span', default=None)
+_ids = itertools.count(1)
+_RESOURCE_ID = re.compile(r'^[a-z]+(-[a-z]+)?-[0-9a-f]{8,17}$')
+
+
+class Span:
+    """
+    One timed operation of a trace. `attributes` hold e.g. the resource ID, availability zone or host.
+    """
+
+    def __init__(self, trace, name, kind, parent, attributes):
+        self.trace = trace
+        self.id = next(_ids)
+        self.name = name
+        self.kind = kind
+        self.parent = parent
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self.start = time.perf_counter()
+        self.end = None
+        self.status = 'ok'
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end if self.end != None else time.perf_counter()) - self.start
+
+    def set(self, **attributes):
+        self.attributes.update({key: value for key, value in attributes.items() if value != None})
+
+    def finish(self, error=None):
+        if self.end != None:
+            return
+        if error != None:
+            self.status = 'error'
+            self.error = str(error) or type(error).__name__
+        self.end = time.perf_counter()
+
+    def to_dict(self):
+        return {'id': self.id, 'parent': self.parent.id if self.parent != None else None, 'name': self.name,
+                'kind': self.kind, 'start': self.start_time, 'duration': round(self.duration, 6),
+                'status': self.status, 'error': self.error, 'attributes': self.attributes}
+
+
+class Trace:
+    """
+    Spans of one provisioning or teardown run, the root span is the run itself.
+    """
+
+    def __init__(self, name, attributes):
+        self.id = f"{next(_ids):06d}"
+        self.name = name
+        self._lock = threading.Lock()
+        self.spans = []
+        self.phase = None
+        self.root = self.start_span(name, 'run', None, attributes)
+
+    def start_span(self, name, kind, parent, attributes):
+        span = Span(self, name, kind, parent, attributes)
+        with self._lock:
+            self.spans.append(span)
+        return span
+
+    def finish(self, error=None):
+        """
+        End the open phase and the run.
+        """
+        if self.phase != None:
+            self.phase.finish(error=error)
+        self.root.finish(error=error)
+
+    def to_dict(self):
+        with self._lock:
+            spans = list(self.spans)
+        return {'trace_id': self.id, 'name': self.name, 'spans': [span.to_dict() for span in spans]}
+
+    def export(self, directory=TRACE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.root.start_time))}-{self.id}.json")
+        with open(path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+        return path
+
+    def summary(self, top=5):
+        """
+        Text table: duration and AWS calls of every phase, the slowest steps and the most called AWS operations.
+        """
+        with self._lock:
+            spans = list(self.spans)
+
+        def phase_of(span):
+            while span.parent != None and span.kind != 'phase':
+                span = span.parent
+            return span
+
+        lines = [f"{'Phase':<44}{'Duration':>12}{'AWS calls':>12}{'AWS time':>12}"]
+        api = [span for span in spans if span.kind == 'api']
+        for phase in [span for span in spans if span.kind == 'phase'] + [self.root]:
+            calls = [span for span in api if phase_of(span) is phase]
+            lines.append(f"{phase.name[:43]:<44}{phase.duration:>11.2f}s{len(calls):>12}{sum(s.duration for s in calls):>11.2f}s")
+
+        steps = sorted((span for span in spans if span.kind == 'step'), key=lambda span: span.duration, reverse=True)
+        if steps:
+            lines.append(f"{'Slowest steps':<44}{'Duration':>12}  Attributes")
+            for span in steps[:top]:
+                attributes = ", ".join(f"{key}={value}" for key, value in span.attributes.items())
+                lines.append(f"{span.name[:43]:<44}{span.duration:>11.2f}s  {attributes}")
+
+        operations = {}
+        for span in api:
+            stats = operations.setdefault(span.name, [0, 0.0, 0.0, 0])
+            stats[0] += 1
+            stats[1] += span.duration
+            stats[2] = max(stats[2], span.duration)
+            stats[3] += span.status == 'error'
+        if operations:
+            lines.append(f"{'AWS operation':<44}{'Calls':>12}{'Total':>12}{'Max':>12}{'Errors':>8}")
+            for name, (count, total, longest, errors) in sorted(operations.items(), key=lambda item: item[1][1], reverse=True)[:top]:
+                lines.append(f"{name[:43]:<44}{count:>12}{total:>11.2f}s{longest:>11.2f}s{errors:>8}")
+        return lines
+
+
+def current_span():
+    return _current.get()
+
+
+def start_span(name, kind='internal', **attributes):
+    """
+    Child of the current span, not made current; finish it with span.finish(). None outside of a trace.
+    """
+    parent = _current.get()
+    if parent == None:
+        return None
+    return parent.trace.start_span(name, kind, parent, attributes)
+
+
+@contextmanager
+def span(name, kind='internal', **attributes):
+    """
+    Time the enclosed block as a child of the current span. Does nothing outside of a trace.
+    """
+    child = start_span(name, kind, **attributes)
+    if child == None:
+        yield None
+        return
+    token = _current.set(child)
+    try:
+        yield child
+    except BaseException as e:
+        child.finish(error=e)
+        raise
+    finally:
+        _current.reset(token)
+        child.finish()
+
+
+def annotate(**attributes):
+    """
+    Add attributes to the current span (if any).
+    """
+    current = _current.get()
+    if current != None:
+        current.set(**attributes)
+
+
+def phase(name, **attributes):
+    """
+    Start the next phase of the current trace: the previous phase ends and everything after this call,
+    up to the next phase() or the end of the trace, is timed under `name`.
+    """
+    current = _current.get()
+    if current == None:
+        return None
+    trace = current.trace
+    if trace.phase != None:
+        trace.phase.finish()
+        logger.info(f"Phase '{trace.phase.name}' done in {trace.phase.duration:0.2f} seconds")
+    trace.phase = trace.start_span(name, 'phase', trace.root, attributes)
+    _current.set(trace.phase)
+    return trace.phase
+
+
+def resource_attributes(values):
+    """
+    resource_id / availability_zone / cidr_block of AWS responses or IDs in `values`, to annotate a step span.
+    """
+    ids, attributes = [], {}
+    for value in values:
+        candidates = [value]
+        if isinstance(value, dict):
+            candidates += [item for item in value.values() if isinstance(item, dict)]
+        for candidate in candidates:
+            if isinstance(candidate, str) and _RESOURCE_ID.match(candidate):
+                ids.append(candidate)
+            elif isinstance(candidate, dict):
+                for key, item in candidate.items():
+                    if isinstance(key, str) and key.endswith('Id') and isinstance(item, str) and _RESOURCE_ID.match(item):
+                        ids.append(item)
+                        break
+                if 'AvailabilityZone' in candidate:
+                    attributes['availability_zone'] = candidate['AvailabilityZone']
+                if 'CidrBlock' in candidate:
+                    attributes['cidr_block'] = candidate['CidrBlock']
+    if ids:
+        attributes['resource_id'] = ",".join(dict.fromkeys(ids))
+    return attributes
+
+
+@contextmanager
+def trace(name, export_dir=TRACE_DIR, **attributes):
+    """
+    Trace the enclosed run. On exit every open span is finished, the JSON trace is written to `export_dir`
+    and the summary table is logged. Yields the Trace.
+    """
+    run_trace = Trace(name, attributes)
+    token = _current.set(run_trace.root)
+    error = None
+    try:
+        yield run_trace
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        _current.reset(token)
+        run_trace.finish(error=error)
+        try:
+            path = run_trace.export(export_dir)
+            logger.info(f"Trace written to '{path}'")
+        except OSError as e:
+            logger.warning(f"Could not write trace: {e}")
+        for line in run_trace.summary():
+            logger.info(line)
+
+
+def install(client, account):
+    """
+    Record every call of `client` as an 'api' span of the calling step.
+    Called by utils.aws_clients for each client it creates.
+    """
+    service = client.meta.service_model.service_name
+    region_name = client.meta.region_name
+
+    def before_call(model, context, **kwargs):
+        call = start_span(f"{service}.{model.name}", 'api', region=region_name)
+        if call != None:
+            context['trace_span'] = call
+
+    def after_call(context, parsed=None, **kwargs):
+        call = context.pop('trace_span', None)
+        if call == None:
+            return
+        metadata = (parsed or {}).get('ResponseMetadata', {})
+        call.set(retries=metadata.get('RetryAttempts'), http_status=metadata.get('HTTPStatusCode'))
+        error = (parsed or {}).get('Error', {}).get('Code')
+        call.finish(error=error)
+
+    def after_call_error(context, exception=None, **kwargs):
+        call = context.pop('trace_span', None)
+        if call != None:
+            call.finish(error=exception or 'error')
+
+    events = client.meta.events
+    events.register('before-call', before_call, unique_id='dotp-tracing-before-call')
+    events.register('after-call', after_call, unique_id='dotp-tracing-after-call')
+    events.register('after-call-error', after_call_error, unique_id='dotp-tracing-after-call-error')
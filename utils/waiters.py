@@ -0,0 +1,205 @@
+import contextvars
+import logging
+import threading
+import time
+from concurrent.futures import Future, wait
+from utils.aws_clients import current_session, get_client, use_session
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Polling: first check after INITIAL_DELAY, then the delay grows by BACKOFF up to MAX_DELAY
+INITIAL_DELAY = 1.0
+BACKOFF = 1.5
+MAX_DELAY = 15.0
+DEFAULT_TIMEOUT = 600
+# The polling thread stops after this many idle seconds and restarts on the next wait_for
+IDLE_TIMEOUT = 30.0
+
+# resource type -> describe operation, id filter, result key, id key, default target state
+RESOURCES = {
+    'vpc': ('describe_vpcs', 'vpc-id', 'Vpcs', 'VpcId', 'available'),
+    'nat_gateway': ('describe_nat_gateways', 'nat-gateway-id', 'NatGateways', 'NatGatewayId', 'available'),
+    'instance': ('describe_instances', 'instance-id', 'Reservations', 'InstanceId', 'running'),
+    'vpc_endpoint': ('describe_vpc_endpoints', 'vpc-endpoint-id', 'VpcEndpoints', 'VpcEndpointId', 'available'),
+    'image': ('describe_images', 'image-id', 'Images', 'ImageId', 'available'),
+}
+# States a resource can't leave to reach the target state
+FAILURE_STATES = {
+    ('nat_gateway', 'available'): ('failed', 'deleting', 'deleted'),
+    ('instance', 'running'): ('shutting-down', 'terminated', 'stopping', 'stopped'),
+    ('instance', 'stopped'): ('shutting-down', 'terminated'),
+    ('vpc_endpoint', 'available'): ('failed', 'rejected', 'deleting', 'deleted'),
+    ('image', 'available'): ('failed', 'invalid', 'error', 'deregistered'),
+}
+# Target states also reached when the resource is not returned anymore
+GONE_STATES = ('deleted', 'terminated')
+
+
+class ResourceStateError(Exception):
+    pass
+
+
+def _state(resource_type, resource):
+    if resource_type == 'instance':
+        return resource['State']['Name']
+    return resource['State'].lower()
+
+
+class _Pending:
+    def __init__(self, resource_type, resource_id, state, timeout):
+        self.resource_type = resource_type
+        self.resource_id = resource_id
+        self.state = state
+        self.deadline = time.monotonic() + timeout
+        self.delay = INITIAL_DELAY
+        self.next_poll = time.monotonic() + INITIAL_DELAY
+        self.future = Future()
+
+
+class ResourceWaiter:
+    """
+    Waits on many resources at once from one background thread.
+    Every tick makes one describe call per resource type for all the resources due for a check,
+    so 2 NAT Gateways and 4 instances cost 2 calls per tick, not 6.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self._pending = []
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def wait_for(self, resource_type, resource_id, state=None, timeout=DEFAULT_TIMEOUT):
+        """
+        Future resolved with the resource description once it reaches `state`
+        (None for resources that are gone), or failed with TimeoutError / ResourceStateError.
+        """
+        pending = _Pending(resource_type, resource_id, state or RESOURCES[resource_type][4], timeout)
+        with self._condition:
+            self._pending.append(pending)
+            if self._thread == None:
+                self._thread = threading.Thread(target=contextvars.Context().run, args=(self._loop,),
+                                                name="resource-waiter", daemon=True)
+                self._thread.start()
+            self._condition.notify()
+        return pending.future
+
+    def _loop(self):
+        with use_session(self.session):
+            while True:
+                with self._condition:
+                    if not self._pending:
+                        self._condition.wait(IDLE_TIMEOUT)
+                        if not self._pending:
+                            self._thread = None
+                            break
+                        continue
+                    now = time.monotonic()
+                    next_poll = min(p.next_poll for p in self._pending)
+                    if next_poll > now:
+                        self._condition.wait(next_poll - now)
+                        continue
+                    due = [p for p in self._pending if p.next_poll <= now]
+
+                by_type = {}
+                for pending in due:
+                    by_type.setdefault(pending.resource_type, []).append(pending)
+                for resource_type, pendings in by_type.items():
+                    try:
+                        self._poll(resource_type, pendings)
+                    except Exception as e:
+                        # e.g. throttling after the client's own retries; try again next tick
+                        logger.warning(f"Polling {resource_type} failed: {e}")
+
+                now = time.monotonic()
+                with self._condition:
+                    for pending in due:
+                        if pending.future.done():
+                            self._pending.remove(pending)
+                        elif now >= pending.deadline:
+                            self._pending.remove(pending)
+                            pending.future.set_exception(TimeoutError(
+                                f"{pending.resource_type} '{pending.resource_id}' not '{pending.state}' in time."))
+                        else:
+                            pending.delay = min(pending.delay * BACKOFF, MAX_DELAY)
+                            pending.next_poll = now + pending.delay
+        # Outside the condition, get_waiter and forget take the module lock first
+        _evict(self)
+
+    def _poll(self, resource_type, pendings):
+        operation, id_filter, result_key, id_key, _ = RESOURCES[resource_type]
+        client = get_client('ec2')
+        ids = sorted(set(p.resource_id for p in pendings))
+
+        # Filters instead of Ids: resources not visible yet (or already gone) don't fail the whole batch
+        found = {}
+        for page in client.get_paginator(operation).paginate(Filters=[{'Name': id_filter, 'Values': ids}]):
+            for item in page[result_key]:
+                for resource in (item['Instances'] if resource_type == 'instance' else [item]):
+                    found[resource[id_key]] = resource
+
+        for pending in pendings:
+            resource = found.get(pending.resource_id)
+            if resource == None:
+                if pending.state in GONE_STATES:
+                    pending.future.set_result(None)
+                continue
+            state = _state(resource_type, resource)
+            if state == pending.state:
+                pending.future.set_result(resource)
+            elif state in FAILURE_STATES.get((resource_type, pending.state), ()):
+                pending.future.set_exception(ResourceStateError(
+                    f"{resource_type} '{pending.resource_id}' is '{state}', expected '{pending.state}'."))
+
+
+_lock = threading.Lock()
+# session -> ResourceWaiter, a waiter drops out when its thread goes idle so the session isn't kept alive
+_waiters = {}
+
+
+def _evict(waiter):
+    with _lock:
+        if _waiters.get(waiter.session) is waiter:
+            del _waiters[waiter.session]
+
+
+def get_waiter():
+    """
+    The ResourceWaiter of the current AWS session.
+    """
+    session = current_session()
+    with _lock:
+        waiter = _waiters.get(session)
+        if waiter == None:
+            waiter = _waiters[session] = ResourceWaiter(session)
+    return waiter
+
+
+def forget(session):
+    """
+    Drop the waiter of `session` unless it is still waiting on something, then it drops out once idle.
+    """
+    with _lock:
+        waiter = _waiters.get(session)
+        if waiter == None:
+            return
+        with waiter._condition:
+            if not waiter._pending:
+                del _waiters[session]
+                # wakes its idle thread, which stops with nothing pending
+                waiter._condition.notify()
+
+
+def wait_for(resource_type, resource_id, state=None, timeout=DEFAULT_TIMEOUT):
+    return get_waiter().wait_for(resource_type, resource_id, state, timeout)
+
+
+def wait_all(resource_type, resource_ids, state=None, timeout=DEFAULT_TIMEOUT):
+    """
+    Block until every resource reached `state`; returns their descriptions in the same order.
+    """
+    futures = [wait_for(resource_type, resource_id, state, timeout) for resource_id in resource_ids]
+    wait(futures)
+    return [future.result() for future in futures]
@@ -0,0 +1,237 @@
+"""
+Warm pool of network stacks (create_dotp.network_steps: VPC, subnets, NAT Gateways, route tables) built ahead of
+the deploys, so a deploy leases a ready network instead of waiting minutes for its NAT Gateways.
+
+    python -m utils.warm_pool --size 2 --region eu-central-1    # fill the pool of a region and wait for it
+    python -m utils.warm_pool --drain --region eu-central-1      # delete its stacks nobody holds a lease on
+
+Every pool stack is built and tagged as a project of its own, '<POOL_PREFIX>-<id>'; its VPC gets POOL_TAG=unleased
+once every step is done. A deploy (DOTP_WARM_POOL > 0) leases one, renames and retags it after its own project,
+and the pool refills in the background. Leases are SSM parameters under LEASE_PARAMETERS (see _claim).
+"""
+import argparse
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import Future, wait
+import boto3
+from utils import clear_vpc, inventory, tracing
+from utils.aws_clients import get_client, use_session
+from utils.engine import Step, run_steps
+
+# logger config
+logger = logging.getLogger()
+logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(levelname)s] %(message)s')
+
+# Unleased stacks kept ready per region, 0 turns the pool off
+POOL_SIZE = int(os.environ.get('DOTP_WARM_POOL', 0))
+POOL_PREFIX = 'dotp-pool'
+POOL_TAG = 'dotp:pool'
+LEASE_TAG = 'dotp:lease'
+# Seconds a lease holds its stack: a process dying before the retag leaves the stack to the next lease after that
+LEASE_TTL = float(os.environ.get('DOTP_WARM_POOL_LEASE_TTL', 600))
+# SSM parameters holding the leases, <LEASE_PARAMETERS>/<vpc id>/<generation>
+LEASE_PARAMETERS = '/dotp/warm-pool'
+# Kinds of resources (see inventory.RESOURCES) a network stack is made of
+NETWORK_KINDS = ['vpcs', 'subnets', 'internet_gateways', 'nat_gateways', 'addresses', 'route_tables', 'vpc_endpoints']
+
+_lock = threading.Lock()
+_lease_lock = threading.Lock()
+# ec2 client (one per credentials and region) -> Futures of the builds this process runs for that pool
+_builds = {}
+
+
+def pool_stacks(states=('unleased',)):
+    """
+    VPCs of the pool stacks of the current region in one of `states` ('unleased', 'leased').
+    """
+    client = get_client('ec2')
+    vpcs = []
+    for page in client.get_paginator('describe_vpcs').paginate(Filters=[{'Name': f"tag:{POOL_TAG}", 'Values': list(states)}]):
+        vpcs += page['Vpcs']
+    return vpcs
+
+
+def build(network_steps):
+    """
+    Build one pool stack with `network_steps` (create_dotp.network_steps) and mark it unleased. Returns its name.
+    A stack that fails half way is deleted.
+    """
+    region_name = get_client('ec2').meta.region_name
+    name = f"{POOL_PREFIX}-{uuid.uuid4().hex[:8]}"
+    with tracing.trace("warm_pool", stack=name, region=region_name):
+        logger.info(f"Warm pool: building network stack '{name}'...")
+        try:
+            network = run_steps(network_steps(name, region_name))
+        except Exception:
+            logger.error(f"Warm pool: building network stack '{name}' failed, deleting it.")
+            run_steps(clear_vpc.project_steps(inventory.discover(name, NETWORK_KINDS)), max_workers=16)
+            raise
+        get_client('ec2').create_tags(Resources=[network['vpc']['Vpc']['VpcId']],
+                                      Tags=[{'Key': POOL_TAG, 'Value': 'unleased'}])
+    logger.info(f"Warm pool: network stack '{name}' ready.")
+    return name
+
+
+def refill_in_background(network_steps, size=None):
+    """
+    Start builds on daemon threads (with the caller's AWS session) until the pool of the current region
+    has `size` (default POOL_SIZE) unleased stacks, the builds this process runs already included.
+    Returns the Futures of the builds started.
+    """
+    size = POOL_SIZE if size == None else size
+    client = get_client('ec2')
+    with _lock:
+        building = _builds[client] = [future for future in _builds.get(client, []) if not future.done()]
+        futures = [Future() for _ in range(size - len(pool_stacks()) - len(building))]
+        building += futures
+
+    for future in futures:
+        def refill(future=future):
+            try:
+                future.set_result(build(network_steps))
+            except Exception as e:
+                logger.error(f"Warm pool: refill failed: {e}")
+                future.set_exception(e)
+
+        threading.Thread(target=contextvars.copy_context().run, args=(refill,), name="warm-pool", daemon=True).start()
+    if futures:
+        logger.info(f"Warm pool: building {len(futures)} network stack(s) in the background.")
+    return futures
+
+
+def retag(name, project):
+    """
+    Rename and retag the resources of pool stack `name` after `project`, as if network_steps(project) built them.
+    Returns them, kind -> descriptions with the new tags.
+    """
+    client = get_client('ec2')
+    live = inventory.discover(name, NETWORK_KINDS)
+
+    def rename(resource_id, resource):
+        tags = [{'Key': inventory.PROJECT_TAG, 'Value': project}]
+        current = inventory.tags(resource).get('Name', '')
+        if current.startswith(name):
+            tags.append({'Key': 'Name', 'Value': project + current[len(name):]})
+        client.create_tags(Resources=[resource_id], Tags=tags)
+        changed = {tag['Key'] for tag in tags}
+        resource['Tags'] = [tag for tag in resource.get('Tags', []) if tag['Key'] not in changed | {POOL_TAG, LEASE_TAG}] + tags
+        return True
+
+    steps = [Step(f"retag/{inventory.resource_id(kind, resource)}",
+                  lambda kind=kind, resource=resource: rename(inventory.resource_id(kind, resource), resource),
+                  provides=[inventory.resource_id(kind, resource)])
+             for kind, resources in live.items() for resource in resources]
+    run_steps(steps, max_workers=16)
+    client.delete_tags(Resources=[vpc['VpcId'] for vpc in live['vpcs']], Tags=[{'Key': POOL_TAG}, {'Key': LEASE_TAG}])
+    return live
+
+
+def _claim(vpc_id, token, generation='0'):
+    """
+    Take the lease of pool VPC `vpc_id` for `token`, True when it is ours.
+    PutParameter without Overwrite is the conditional write: of the processes racing for one generation only one
+    creates its parameter. An expired lease is taken over on the next generation, named after its token.
+    """
+    ssm = get_client('ssm')
+    name = f"{LEASE_PARAMETERS}/{vpc_id}/{generation}"
+    try:
+        ssm.put_parameter(Name=name, Value=json.dumps({'token': token, 'expires': time.time() + LEASE_TTL}),
+                          Type='String', Overwrite=False)
+        return True
+    except ssm.exceptions.ParameterAlreadyExists:
+        pass
+    try:
+        held = json.loads(ssm.get_parameter(Name=name)['Parameter']['Value'])
+    except ssm.exceptions.ParameterNotFound:
+        # Released meanwhile, the stack left the pool
+        return False
+    if held['expires'] > time.time():
+        return False
+    return _claim(vpc_id, token, held['token'])
+
+
+def _release(vpc_id):
+    # The stack left the pool, the parameters of its leases go with it
+    ssm = get_client('ssm')
+    names = [parameter['Name'] for page in ssm.get_paginator('get_parameters_by_path').paginate(Path=f"{LEASE_PARAMETERS}/{vpc_id}")
+             for parameter in page['Parameters']]
+    for start in range(0, len(names), 10):
+        ssm.delete_parameters(Names=names[start:start + 10])
+
+
+def _take(vpc, token):
+    """
+    Lease pool VPC `vpc` for `token` (see _claim). Returns its current description, None when another process holds it
+    or it already left the pool.
+    """
+    if not _claim(vpc['VpcId'], token):
+        return None
+    # Described again after the claim: a stack retagged (and released) meanwhile is no pool stack any more
+    vpc = get_client('ec2').describe_vpcs(VpcIds=[vpc['VpcId']])['Vpcs'][0]
+    if inventory.tags(vpc).get(POOL_TAG) not in ('unleased', 'leased'):
+        _release(vpc['VpcId'])
+        return None
+    get_client('ec2').create_tags(Resources=[vpc['VpcId']], Tags=[{'Key': POOL_TAG, 'Value': 'leased'},
+                                                                   {'Key': LEASE_TAG, 'Value': token}])
+    return vpc
+
+
+def lease(project):
+    """
+    Take a stack of the pool of the current region (an unleased one, or one whose lease expired) and retag it
+    after `project` (see retag). Returns its resources, None when the pool is empty.
+    Within this process leases are taken one at a time.
+    """
+    token = uuid.uuid4().hex
+    with _lease_lock:
+        # Unleased stacks first, the leased ones are only taken over once their lease expired
+        for vpc in sorted(pool_stacks(('unleased', 'leased')), key=lambda vpc: inventory.tags(vpc)[POOL_TAG] != 'unleased'):
+            vpc = _take(vpc, token)
+            if vpc != None:
+                break
+        else:
+            return None
+    name = inventory.tags(vpc)[inventory.PROJECT_TAG]
+    logger.info(f"Warm pool: leased network stack '{name}' (VPC '{vpc['VpcId']}') for project '{project}'.")
+    live = retag(name, project)
+    _release(vpc['VpcId'])
+    return live
+
+
+def drain():
+    """
+    Delete every stack of the pool of the current region nobody holds a lease on.
+    """
+    token = uuid.uuid4().hex
+    for vpc in pool_stacks(('unleased', 'leased')):
+        vpc = _take(vpc, token)
+        if vpc != None:
+            clear_vpc.teardown_project(inventory.tags(vpc)[inventory.PROJECT_TAG])
+            _release(vpc['VpcId'])
+
+
+def main(size=None, region_name=None, drain_pool=False):
+    # network_steps lives with the rest of the deploy
+    from create_dotp import network_steps
+
+    with use_session(boto3.Session(region_name=region_name)):
+        if drain_pool:
+            drain()
+            return
+        futures = refill_in_background(network_steps, size)
+        wait(futures)
+        logger.info(f"Warm pool: {len(pool_stacks())} network stack(s) ready.")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Keep network stacks ready for DevOps Tools Pack deploys.")
+    parser.add_argument('--size', type=int, default=max(POOL_SIZE, 1), help="unleased stacks to keep ready")
+    parser.add_argument('--region', help="AWS region, the default one of ~/.aws/config otherwise")
+    parser.add_argument('--drain', action='store_true', help="delete the stacks nobody holds a lease on instead")
+    args = parser.parse_args()
+    main(size=args.size, region_name=args.region, drain_pool=args.drain)